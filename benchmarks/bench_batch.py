@@ -0,0 +1,81 @@
+''' Compare sequential graph api calls against the same operations sent through graph.Batch
+
+    The stub server sleeps for a fixed latency per HTTP request to model the round trip to facebook.
+
+    Usage: python benchmarks/bench_batch.py [operations] [latency ms]
+'''
+
+import cgi
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from pyfb import graph
+from pyfb import net
+import stub_server
+
+
+class BatchHandler(stub_server.StubHandler):
+    ''' answers single graph GETs and batch POSTs '''
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.reply(200, json.dumps({"id" : self.path}))
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0))
+        form = cgi.parse_qs(self.rfile.read(length))
+        operations = json.loads(form["batch"][0])
+
+        time.sleep(self.server.latency)
+        responses = []
+        for op in operations:
+            responses.append({
+                "code" : 200,
+                "headers" : [{"name" : "Content-Type", "value" : "text/javascript; charset=UTF-8"}],
+                "body" : json.dumps({"id" : op["relative_url"]}),
+            })
+        self.reply(200, json.dumps(responses))
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) / 1000.0 if len(sys.argv) > 2 else 0.02
+
+    (server, base_url, context) = stub_server.start(handler=BatchHandler)
+    server.latency = latency
+    graph.FB_GRAPH_BASE_URL = base_url
+
+    try:
+        ids = [str(i) for i in range(operations)]
+
+        t1 = time.time()
+        for uid in ids:
+            json.loads(net.get("%s/%s?access_token=token" % (base_url, uid)))
+        sequential = time.time() - t1
+
+        t1 = time.time()
+        batch = graph.Batch("token")
+        ops = [batch.get(uid) for uid in ids]
+        batch.execute()
+        results = [op.get_result() for op in ops]
+        batched = time.time() - t1
+        assert len(results) == operations
+
+        print "%d operations, %dms simulated latency" % (operations, latency * 1000)
+        print "sequential: %6.3fs" % sequential
+        print "batched:    %6.3fs  (%d batch requests, %.1fx faster)" % (batched, (operations + graph.MAX_BATCH_SIZE - 1) / graph.MAX_BATCH_SIZE, sequential / batched)
+
+    finally:
+        stub_server.stop(server)
+
+
+if __name__ == "__main__":
+    main()
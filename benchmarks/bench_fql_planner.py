@@ -0,0 +1,68 @@
+''' Compare fql.get_friends as one query against the chunked version run by a planner.ChunkPlanner
+
+    The stub server takes latency ms per request plus row latency ms per friend a query looks at, so one query over
+    every friend takes a long time while chunks of them run side by side.
+
+    Usage: python benchmarks/bench_fql_planner.py [friends] [latency ms] [row latency ms] [repeats]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyfb import fql
+from pyfb import planner
+import fbstub
+import stub_server
+
+TOKEN = "1|stub_user_token"
+
+
+def timed(fn, repeats):
+    ''' (best seconds, result of the last call) '''
+
+    best = None
+    for i in range(repeats):
+        t1 = time.time()
+        result = fn()
+        seconds = time.time() - t1
+        if best is None or seconds < best:
+            best = seconds
+    return (best, result)
+
+def main():
+    friends = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    latency = float(sys.argv[2]) / 1000.0 if len(sys.argv) > 2 else 0.05
+    row_latency = float(sys.argv[3]) / 1000.0 if len(sys.argv) > 3 else 0.0005
+    repeats = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+
+    (server, base_url, context) = fbstub.start()
+    server.friends = friends
+    server.latency = latency
+    server.row_latency = row_latency
+    fql.FQL_BASE_URL = base_url + "/method/fql.query?format=json"
+
+    try:
+        fql.friends_planner = None
+        (single, expected) = timed(lambda: fql.get_friends(TOKEN), repeats)
+
+        chunker = planner.ChunkPlanner()
+        fql.friends_planner = chunker
+        (chunked, rows) = timed(lambda: fql.get_friends(TOKEN), repeats)
+        assert sorted([row["uid"] for row in rows]) == sorted([row["uid"] for row in expected])
+
+        print "%d friends, %dms latency per request, %0.1fms per friend looked at" % (friends, latency * 1000,
+                                                                                      row_latency * 1000)
+        print "single query: %6.3fs  (%d rows)" % (single, len(expected))
+        print "chunked:      %6.3fs  (%.1fx faster)" % (chunked, single / chunked)
+        print "planner: %s" % chunker.stats()
+
+    finally:
+        fql.friends_planner = None
+        stub_server.stop(server)
+
+
+if __name__ == "__main__":
+    main()
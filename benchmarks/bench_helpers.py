@@ -0,0 +1,132 @@
+''' Throughput and latency of the pyfb.graph and pyfb.fql helpers, for each transport, against the fbstub server.
+
+    Each helper is called iterations times from threads threads at once.  Request coalescing is turned off so every
+    call goes to the (stub) network.  The stub answers after latency ms, so that is the floor of every p50.
+
+    Usage: python benchmarks/bench_helpers.py [iterations] [latency ms] [friends] [threads] [error rate]
+'''
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyfb import fql
+from pyfb import graph
+from pyfb import net
+from pyfb import transports
+import fbstub
+import stub_server
+
+TOKEN = "1|stub_user_token"
+USER_ID = str(fbstub.ME_UID)
+
+
+def helpers(friends):
+    ''' list of (name, function making one call) '''
+
+    ids = [str(fbstub.FIRST_FRIEND_UID + i) for i in range(min(friends, 50))]
+
+    def batch():
+        b = graph.Batch(TOKEN)
+        ops = [b.get(uid) for uid in ids[:20]]
+        b.execute()
+        return [op.get_result() for op in ops]
+
+    return [
+        ("graph.get_friends_list", lambda: graph.get_friends_list(USER_ID, TOKEN, ["id", "name"], limit=friends)),
+        ("graph.iter_friends", lambda: list(graph.iter_friends(USER_ID, TOKEN, ["id", "name"]))),
+        ("graph.get_users (50)", lambda: graph.get_users(ids, TOKEN)),
+        ("graph.get_many (20)", lambda: graph.get_many(ids[:20], TOKEN)),
+        ("graph.Batch (20)", batch),
+        ("fql.get_user", lambda: fql.get_user(TOKEN)),
+        ("fql.get_friends", lambda: fql.get_friends(TOKEN)),
+        ("fql.iter_friends", lambda: list(fql.iter_friends(TOKEN))),
+        ("fql.multiquery", lambda: fql.multiquery({"me" : fql.user_query(), "friends" : fql.friend_uid_list_query()},
+                                                  TOKEN)),
+    ]
+
+def run(fn, iterations, threads):
+    ''' call fn iterations times spread over threads threads.  Returns (seconds, sorted latencies, errors) '''
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(iterations))
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                i = next(counter, None)
+            finally:
+                lock.release()
+            if i is None:
+                return
+
+            t1 = time.time()
+            try:
+                fn()
+            except Exception, e:
+                errors.append(e)
+            latencies.append(time.time() - t1)
+
+    t1 = time.time()
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return (time.time() - t1, sorted(latencies), errors)
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    latency = float(sys.argv[2]) / 1000.0 if len(sys.argv) > 2 else 0.01
+    friends = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    threads = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    error_rate = float(sys.argv[5]) if len(sys.argv) > 5 else 0.0
+
+    (server, base_url, context) = fbstub.start()
+    server.latency = latency
+    server.friends = friends
+    server.error_rate = error_rate
+
+    graph.FB_GRAPH_BASE_URL = base_url
+    fql.FQL_BASE_URL = base_url + "/method/fql.query?format=json"
+    fql.FQL_MULTIQUERY_URL = base_url + "/method/fql.multiquery?format=json"
+    net.coalescer = None
+    if error_rate:
+        # injected errors shouldn't trip the circuit breakers and stop the benchmark
+        net.breakers = None
+
+    candidates = [transports.URLLib2Transport(), transports.PooledTransport()]
+    if transports.urlfetch is not None:
+        candidates.append(transports.URLFetchTransport())
+
+    print "%d calls per helper from %d threads, %dms simulated latency, %d friends, error rate %s" % (
+        iterations, threads, latency * 1000, friends, error_rate)
+    print "%-10s %-24s %10s %9s %9s %7s" % ("transport", "helper", "calls/s", "p50 ms", "p99 ms", "errors")
+
+    original = net.transport
+    try:
+        for transport in candidates:
+            net.transport = transport
+            for (name, fn) in helpers(friends):
+                (seconds, latencies, errors) = run(fn, iterations, threads)
+                print "%-10s %-24s %10.1f %9.1f %9.1f %7d" % (transport.name, name, iterations / seconds,
+                    percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, len(errors))
+                if errors:
+                    print "    e.g. %r" % errors[0]
+            transport.close()
+    finally:
+        net.transport = original
+        stub_server.stop(server)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+''' Compare a fresh urllib2 connection per request against the pooled keep-alive transport in pyfb.net
+
+    Usage: python benchmarks/bench_pool.py [requests] [threads] [--http]
+'''
+
+import os
+import sys
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyfb import pool
+import stub_server
+
+
+def run(fetch, url, requests, threads):
+    ''' do requests fetches of url spread over threads threads.  returns elapsed seconds '''
+
+    per_thread = requests / threads
+
+    def worker():
+        for i in xrange(per_thread):
+            fetch(url)
+
+    workers = [threading.Thread(target=worker) for i in xrange(threads)]
+    t1 = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.time() - t1
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    requests = int(args[0]) if len(args) > 0 else 500
+    threads = int(args[1]) if len(args) > 1 else 4
+    use_ssl = "--http" not in sys.argv
+
+    (server, base_url, context) = stub_server.start(use_ssl=use_ssl)
+    url = base_url + "/4?fields=id,name"
+
+    try:
+        def urllib2_get(url):
+            if context:
+                return urllib2.urlopen(url, context=context).read()
+            return urllib2.urlopen(url).read()
+
+        connection_pool = pool.ConnectionPool(ssl_context=context)
+        def pooled_get(url):
+            return connection_pool.request("GET", url)[2]
+
+        for (name, fetch) in (("urllib2", urllib2_get), ("pooled", pooled_get)):
+            elapsed = run(fetch, url, requests, threads)
+            print "%-8s %5d requests, %d threads: %6.2fs  (%7.1f req/s)" % (name, requests, threads, elapsed, requests / elapsed)
+
+        print "pool stats: %s" % connection_pool.stats()
+        connection_pool.close()
+
+    finally:
+        stub_server.stop(server)
+
+
+if __name__ == "__main__":
+    main()
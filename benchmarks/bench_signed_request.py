@@ -0,0 +1,84 @@
+''' Microbenchmark of signed_request verification: signed requests verified per second.
+
+    Compares the original parse (fresh hmac, json decode every time), SignedRequestVerifier with its cache turned off,
+    and SignedRequestVerifier re-verifying the same signed request (the canvas re-post case).
+
+    Usage: python benchmarks/bench_signed_request.py [iterations]
+'''
+
+import base64
+import hmac
+import os
+import sys
+import time
+from hashlib import sha256
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from pyfb import auth
+
+APP_SECRET = "0123456789abcdef0123456789abcdef"
+
+
+def make_signed_request(data, secret):
+    payload = base64.urlsafe_b64encode(json.dumps(data)).rstrip("=")
+    sig = base64.urlsafe_b64encode(hmac.new(secret, payload, sha256).digest()).rstrip("=")
+    return "%s.%s" % (sig, payload)
+
+
+def original_parse(signed_request, app_secret):
+    ''' parse_signed_request as it was before SignedRequestVerifier '''
+
+    (sig, payload) = signed_request.split('.')
+    sig = auth.base64_url_decode(sig)
+    data = json.loads(auth.base64_url_decode(payload))
+    if data['algorithm'].upper() != 'HMAC-SHA256':
+        raise Exception('Unknown algorithm. Expected HMAC-SHA256')
+    expected_sig = hmac.new(app_secret, payload, sha256).digest()
+    if sig != expected_sig:
+        raise Exception('Bad Signed JSON signature!')
+    return data
+
+
+def measure(name, fn, iterations):
+    t1 = time.time()
+    for i in xrange(iterations):
+        fn()
+    elapsed = time.time() - t1
+    print "%-28s %9.0f verifications/s" % (name, iterations / elapsed)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    now = int(time.time())
+    data = {
+        "algorithm" : "HMAC-SHA256",
+        "issued_at" : now,
+        "expires" : now + 3600,
+        "user_id" : "100000123456789",
+        "oauth_token" : "AAAENJAf4kUUBAFnyAOxBpLD2O5nJvG5eD4X2ZBKAaZAl23ZA82qExyRZAtO6yILsVgyw963UPvfiOG9wUiHRCiyK5MXOSO5gbZBBdfaPSPu7liNJA9pG7",
+        "user" : {"country" : "us", "locale" : "en_US", "age" : {"min" : 21}},
+    }
+    signed_request = make_signed_request(data, APP_SECRET)
+
+    uncached = auth.SignedRequestVerifier(APP_SECRET, cache_size=0)
+    cached = auth.SignedRequestVerifier(APP_SECRET)
+
+    measure("original", lambda: original_parse(signed_request, APP_SECRET), iterations)
+    measure("verifier, no cache", lambda: uncached.verify(signed_request), iterations)
+    measure("verifier, repeated request", lambda: cached.verify(signed_request), iterations)
+    print "cache hits=%d misses=%d" % (cached.hits, cached.misses)
+
+
+if __name__ == "__main__":
+    main()
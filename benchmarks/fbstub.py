@@ -0,0 +1,326 @@
+''' Local stand-in for the parts of graph.facebook.com and api.facebook.com that pyfb.graph and pyfb.fql use, so the
+    helpers can be benchmarked (or poked at) without facebook.
+
+    Every user has the same friends, the users with ids from FIRST_FRIEND_UID on (how many is the friends knob).
+    Graph connections are paged with limit/offset and paging.next links like the real thing.  Every user's feed has
+    one post an hour, the newest at feed_time, and can be narrowed down with since / until.  FQL queries are
+    answered by looking at what they select from rather than by parsing them, which is enough for the queries pyfb.fql
+    builds.
+
+    Knobs, set as attributes of the server start() returns:
+
+        latency - seconds every request takes before it is answered
+        row_latency - extra seconds per user an FQL query looks at
+        jitter - up to this many extra seconds, picked at random per request
+        friends - number of friends every user has
+        page_size - default page size of graph connections
+        padding - characters of filler in each free text field, to make rows bigger
+        error_rate - fraction of requests answered with an HTTP 500
+        fb_error_rate - fraction of requests answered with a facebook error, see fb_error_code
+        fb_error_code - the facebook error code injected, e.g. 190 (bad token), 4 or 613 (throttled)
+        feed_time - unix time of the newest post in every feed.  Move it on an hour to add a post.
+        token_users - access token -> user id "me" stands for, ME_UID for tokens it doesn't have
+
+    Usage: python benchmarks/fbstub.py  to run one on its own.
+'''
+
+import cgi
+import random
+import time
+import urllib
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import stub_server
+
+FIRST_FRIEND_UID = 100000
+ME_UID = 4
+FEED_TIME = 1300000000
+POST_INTERVAL = 3600
+
+FIRST_NAMES = ["Mark", "Chris", "Dustin", "Eduardo", "Sheryl", "Andrew", "Priscilla", "Randi", "Sean", "Naomi"]
+LAST_NAMES = ["Zuckerberg", "Hughes", "Moskovitz", "Saverin", "Sandberg", "McCollum", "Chan", "Parker", "Gleit"]
+RELATIONSHIP_STATUSES = ["Single", "In a relationship", "Married", "It's complicated", None]
+
+# user columns that hold free text, padded by the server's padding setting
+TEXT_COLUMNS = ("activities", "interests", "music", "tv", "movies", "books", "about", "religion", "political")
+
+
+class FBStubHandler(stub_server.StubHandler):
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+
+        body = ""
+        length = int(self.headers.get("content-length", 0))
+        if length:
+            body = self.rfile.read(length)
+
+        (path, params) = _split(self.path, body)
+        fql = path.startswith("/method/")
+
+        if random.random() < server.error_rate:
+            server.count("errors")
+            return self.reply(500, json.dumps({"error" : {"message" : "An unknown error has occurred.", "code" : 1}}))
+        if random.random() < server.fb_error_rate:
+            server.count("fb_errors")
+            return self.reply(*fb_error(server.fb_error_code, fql))
+
+        server.count(method)
+        (status, content) = server.answer(method, path, params)
+        self.reply(status, content)
+
+
+class FBStubServer(stub_server.StubServer):
+    ''' StubServer that answers graph and FQL requests, see the module docstring for the knobs '''
+
+    def __init__(self, *args, **kwargs):
+        stub_server.StubServer.__init__(self, *args, **kwargs)
+        self.url = None
+        self.latency = 0.0
+        self.row_latency = 0.0
+        self.jitter = 0.0
+        self.friends = 500
+        self.page_size = 100
+        self.padding = 0
+        self.error_rate = 0.0
+        self.fb_error_rate = 0.0
+        self.fb_error_code = 190
+        self.feed_time = FEED_TIME
+        self.token_users = {}
+        self.counts = {}
+
+    def count(self, counter):
+        # unlocked, so only approximate under concurrent requests
+        self.counts[counter] = self.counts.get(counter, 0) + 1
+
+    def answer(self, method, path, params):
+        ''' (status, content) for a request that isn't failing on purpose '''
+
+        if path == "/method/fql.query":
+            return (200, json.dumps(self.fql_rows(params.get("query", ""))))
+        if path == "/method/fql.multiquery":
+            queries = json.loads(params.get("queries", "{}"))
+            return (200, json.dumps([{"name" : name, "fql_result_set" : self.fql_rows(query)}
+                                     for (name, query) in queries.items()]))
+
+        if method == "DELETE":
+            return (200, "true")
+        if method == "POST":
+            if path == "/" and "batch" in params:
+                return (200, json.dumps(self.batch(json.loads(params["batch"]))))
+            if path.endswith("/friends"):
+                return (200, "true")
+            return (200, json.dumps({"id" : "%d_%d" % (ME_UID, random.randint(1, 10 ** 9))}))
+
+        return self.graph_get(path, params)
+
+    def graph_get(self, path, params):
+        parts = [part for part in path.split("/") if part]
+        if parts and parts[0] == "me":
+            parts[0] = str(self.token_users.get(params.get("access_token"), ME_UID))
+        fields = [field for field in params.get("fields", "").split(",") if field]
+
+        if parts == ["oauth", "access_token"]:
+            return (200, "access_token=%s|stub_app_token" % params.get("client_id", "1"))
+        if not parts and "ids" in params:
+            ids = [uid for uid in params["ids"].split(",") if uid]
+            return (200, json.dumps(dict([(uid, self.graph_user(uid, fields)) for uid in ids])))
+        if len(parts) == 1:
+            return (200, json.dumps(self.graph_user(parts[0], fields)))
+
+        if parts[-1] == "friends":
+            total = self.friends
+            make = lambda i: self.graph_user(FIRST_FRIEND_UID + i, fields or ["id", "name"])
+        elif parts[-1] == "feed":
+            (first, total) = self.feed_range(params)
+            make = lambda i: self.post(parts[0], first + i)
+        elif parts[-1] == "test-users":
+            total = min(self.friends, 500)
+            make = lambda i: {"id" : str(FIRST_FRIEND_UID + i), "access_token" : "%s|test%d" % (parts[0], i)}
+        else:
+            return (404, json.dumps({"error" : {"message" : "Unknown path components: /%s" % parts[-1],
+                                                "type" : "OAuthException", "code" : 2500}}))
+
+        return (200, json.dumps(self.page(path, params, total, make)))
+
+    def page(self, path, params, total, make):
+        ''' one page of a graph connection with total items, make(i) building the i'th '''
+
+        limit = int(params.get("limit", self.page_size))
+        offset = int(params.get("offset", 0))
+        page = {"data" : [make(i) for i in range(offset, min(offset + limit, total))]}
+
+        if offset + limit < total:
+            next_params = dict(params)
+            next_params["offset"] = str(offset + limit)
+            next_params["limit"] = str(limit)
+            page["paging"] = {"next" : "%s%s?%s" % (self.url, path, urllib.urlencode(next_params))}
+        return page
+
+    def graph_user(self, uid, fields=None):
+        user = user_row(uid, self.padding)
+        user["id"] = str(user.pop("uid"))
+        if fields:
+            return dict([(field, user.get(field)) for field in fields])
+        return user
+
+    def feed_range(self, params):
+        ''' (index of the first post, number of posts) of a feed request.  since and until are inclusive. '''
+
+        first = 0
+        last = self.friends - 1
+        if "until" in params:
+            first = max(first, -(-(self.feed_time - int(params["until"])) // POST_INTERVAL))
+        if "since" in params:
+            last = min(last, (self.feed_time - int(params["since"])) // POST_INTERVAL)
+        return (first, max(0, last - first + 1))
+
+    def post(self, user_id, i):
+        # ids go with times, so the same post keeps its id as newer ones arrive
+        created = self.feed_time - i * POST_INTERVAL
+        return {
+            "id" : "%s_%d" % (user_id, created // POST_INTERVAL),
+            "from" : {"id" : str(FIRST_FRIEND_UID + i % max(self.friends, 1)), "name" : _name(i)},
+            "message" : "Post number %d %s" % (created // POST_INTERVAL, "x" * self.padding),
+            "created_time" : time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime(created)),
+        }
+
+    def fql_rows(self, query):
+        ''' rows an FQL query pyfb.fql builds would return '''
+
+        q = query.lower()
+        columns = [column.strip() for column in q.split(" from ", 1)[0].replace("select", "", 1).split(",")]
+
+        if " from friend " in q and " from user " not in q:
+            # friend_uid_list_query
+            return [{"uid1" : str(FIRST_FRIEND_UID + i)} for i in range(self.friends)]
+
+        if " in (" not in q:
+            # one user, e.g. user_query
+            uid = q.rsplit("=", 1)[-1].strip()
+            if uid == "me()":
+                uid = ME_UID
+            return [self.fql_user(uid, columns)]
+
+        listed = q.split(" in (", 1)[1].split(")", 1)[0]
+        if listed.replace(",", "").replace(" ", "").isdigit():
+            # a chunk of uids
+            uids = [int(uid) for uid in listed.split(",")]
+        else:
+            # every friend
+            uids = range(FIRST_FRIEND_UID, FIRST_FRIEND_UID + self.friends)
+
+        users = [user_row(uid, self.padding) for uid in uids]
+        if "is_app_user=1" in q.replace(" ", ""):
+            users = [user for user in users if user["is_app_user"]]
+        if "strpos(lower(name)," in q:
+            needle = q.split("strpos(lower(name),", 1)[1].split(")", 1)[0].strip().strip("\"'")
+            users = [user for user in users if needle in user["name"].lower()]
+        for excluded in q.split("relationship_status != ")[1:]:
+            excluded = excluded.split("'")[1]
+            users = [user for user in users if (user["relationship_status"] or "").lower() != excluded]
+
+        if self.row_latency:
+            # facebook takes longer over queries that look at more rows
+            time.sleep(self.row_latency * len(uids))
+        return [dict([(column, user.get(column)) for column in columns if column]) for user in users]
+
+    def fql_user(self, uid, columns):
+        user = user_row(uid, self.padding)
+        return dict([(column, user.get(column)) for column in columns if column])
+
+    def batch(self, operations):
+        responses = []
+        for op in operations:
+            (path, params) = _split("/" + op["relative_url"], op.get("body", ""))
+            (status, content) = self.answer(op.get("method", "GET"), path, params)
+            responses.append({
+                "code" : status,
+                "headers" : [{"name" : "Content-Type", "value" : "text/javascript; charset=UTF-8"}],
+                "body" : content,
+            })
+        return responses
+
+
+def user_row(uid, padding=0):
+    ''' every column a fake user has, FQL style (uid rather than id) '''
+
+    try:
+        uid = int(uid)
+    except ValueError:
+        # me, or a name
+        uid = ME_UID
+    first = FIRST_NAMES[uid % len(FIRST_NAMES)]
+    last = LAST_NAMES[(uid / len(FIRST_NAMES)) % len(LAST_NAMES)]
+    row = {
+        "uid" : uid,
+        "first_name" : first,
+        "middle_name" : "",
+        "last_name" : last,
+        "name" : "%s %s" % (first, last),
+        "pic_square" : "https://graph.facebook.com/%d/picture?type=square" % uid,
+        "birthday_date" : "%02d/%02d/19%02d" % (uid % 12 + 1, uid % 28 + 1, 60 + uid % 40),
+        "sex" : ("male", "female")[uid % 2],
+        "meeting_sex" : [],
+        "current_location" : None,
+        "relationship_status" : RELATIONSHIP_STATUSES[uid % len(RELATIONSHIP_STATUSES)],
+        "is_app_user" : uid % 3 == 0,
+    }
+    for column in TEXT_COLUMNS:
+        row[column] = "x" * padding
+    return row
+
+def fb_error(code, fql):
+    ''' (status, content) of a facebook error response, the way the FQL and graph apis report them '''
+
+    message = "Injected error %d" % code
+    if fql:
+        return (200, json.dumps({"error_code" : code, "error_msg" : message, "request_args" : []}))
+    return (400, json.dumps({"error" : {"message" : message, "type" : "OAuthException", "code" : code}}))
+
+def _name(i):
+    return "%s %s" % (FIRST_NAMES[i % len(FIRST_NAMES)], LAST_NAMES[i % len(LAST_NAMES)])
+
+def _split(path, body=""):
+    ''' (path, dictionary of query string and form parameters) '''
+
+    (path, query) = urllib.splitquery(path)
+    params = dict([(name, values[0]) for (name, values) in cgi.parse_qs(query or "").items()])
+    if body:
+        params.update([(name, values[0]) for (name, values) in cgi.parse_qs(body).items()])
+    return (path, params)
+
+
+def start(use_ssl=False):
+    ''' start an FBStubServer on a free localhost port.  Returns (server, base url, client ssl context or None), the
+        base url is also server.url.  Call stub_server.stop(server) when done. '''
+
+    (server, url, context) = stub_server.start(FBStubHandler, use_ssl, server_class=FBStubServer)
+    server.url = url
+    return (server, url, context)
+
+
+if __name__ == "__main__":
+    (server, url, context) = start()
+    print "graph api: %s  fql: %s/method/fql.query?format=json  (ctrl-c to stop)" % (url, url)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stub_server.stop(server)
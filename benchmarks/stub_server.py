@@ -0,0 +1,90 @@
+''' Tiny local stand-in for graph.facebook.com / api.facebook.com used by the benchmarks.
+
+    Speaks HTTP/1.1 with keep-alive so connection reuse can be measured.  Pass use_ssl=True to serve HTTPS with a
+    throwaway self-signed certificate (needs the openssl command line tool).
+'''
+
+import BaseHTTPServer
+import os
+import shutil
+import ssl
+import subprocess
+import SocketServer
+import tempfile
+import threading
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1   # buffer each response into one write, otherwise Nagle + delayed ack stalls keep-alive clients
+    disable_nagle_algorithm = True  # responses over 8k still go out in several writes
+
+    def do_GET(self):
+        self.reply(200, self.server.body)
+
+    def reply(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128    # the default listen backlog of 5 drops connections under concurrent load
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on idle keep-alive connections is expected, don't spew tracebacks
+        pass
+
+
+def make_self_signed_cert(directory):
+    ''' create a self-signed cert/key pair for localhost in directory.  returns (cert path, key path) '''
+
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                           "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                          stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    return (cert, key)
+
+
+def start(handler=StubHandler, use_ssl=False, body='{"id": "4", "name": "Mark Zuckerberg"}', server_class=StubServer):
+    ''' start a stub server on a free localhost port in a background thread.
+
+        Returns (server, base url, client ssl context or None).  Call stop(server) when done.
+    '''
+
+    server = server_class(("127.0.0.1", 0), handler)
+    server.body = body
+    server.tmpdir = None
+
+    client_context = None
+    scheme = "http"
+    if use_ssl:
+        server.tmpdir = tempfile.mkdtemp()
+        (cert, key) = make_self_signed_cert(server.tmpdir)
+        server.socket = ssl.wrap_socket(server.socket, certfile=cert, keyfile=key, server_side=True)
+
+        client_context = ssl.create_default_context(cafile=cert)
+        client_context.check_hostname = False
+        scheme = "https"
+
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    url = "%s://127.0.0.1:%d" % (scheme, server.server_address[1])
+    return (server, url, client_context)
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+    if server.tmpdir:
+        shutil.rmtree(server.tmpdir)
@@ -1,9 +1,12 @@
 ''' Facebook API authentication related code. '''
 
+import collections
 import hmac
 
 import logging
 logger = logging.getLogger("pyfb")
+import threading
+import time
 
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseServerError
@@ -19,6 +22,12 @@ except ImportError:
 from base64 import urlsafe_b64decode
 from hashlib import sha256
 
+import instrument
+import tokens
+
+SIGNED_REQUEST_CACHE_SIZE = 1000    # verified signed requests remembered per app secret
+SIGNED_REQUEST_MAX_AGE = 3600       # seconds after issued_at a cached signed request is trusted for
+
 class SignedRequestInfo(object):
     def __init__(self, redirect_url=None, user_id=None, oauth_token=None, expires=None):
         self.redirect_url = redirect_url
@@ -93,6 +102,8 @@ def handle_signed_request(signed_request, app_id, app_secret):
 
     expires = data["expires"]
     
+    tokens.manager.add_user_token(oauth_token, user_id, expires)
+    
     request_info = SignedRequestInfo(user_id=user_id, oauth_token=oauth_token, expires=expires)
     return request_info
     
@@ -107,24 +118,143 @@ def parse_signed_request(signed_request, app_secret):
 
         Padding/signing code is a modified version of the one at:
         https://gist.github.com/670637/d129a1c4b4a1eec8cd6480186da38c3d2223eb35
+        
+        Verification is done by a per app secret SignedRequestVerifier, see get_verifier.
+    '''
+
+    return get_verifier(app_secret).verify(signed_request)
+
+
+class SignedRequestVerifier(object):
+    ''' Verifies and decodes signed requests for one app secret.
+    
+        The HMAC key setup is done once up front and copied for each request, signatures are compared in constant
+        time, and decoded requests are kept in a bounded LRU cache keyed by the raw signed_request string since 
+        facebook re-posts the same one on every canvas load.  A cached request is only trusted until its 'expires'
+        time or max_age seconds after its 'issued_at' time, whichever comes first.
+        
+        cache_size - max number of decoded signed requests to remember.  0 disables the cache.
+        max_age - seconds after issued_at that a cached signed request is trusted for
     '''
+    
+    def __init__(self, app_secret, cache_size=SIGNED_REQUEST_CACHE_SIZE, max_age=SIGNED_REQUEST_MAX_AGE):
+        self._hmac = hmac.new(str(app_secret), digestmod=sha256)
+        self.cache_size = cache_size
+        self.max_age = max_age
+        
+        self._cache = collections.OrderedDict()    # signed_request -> (data, trusted until), least recently used first
+        self._lock = threading.Lock()
+        
+        # stats
+        self.hits = 0
+        self.misses = 0
+        
+    def verify(self, signed_request):
+        ''' Check the signature and return the decoded data.  Raises an Exception if the signature or algorithm is bad. '''
+        
+        now = time.time()
+        
+        if self.cache_size:
+            self._lock.acquire()
+            try:
+                cached = self._cache.pop(signed_request, None)
+                if cached and cached[1] > now:
+                    self._cache[signed_request] = cached
+                    self.hits += 1
+                    data = cached[0]
+                else:
+                    data = None
+                    self.misses += 1
+            finally:
+                self._lock.release()
+                
+            if data is not None:
+                if instrument.enabled:
+                    instrument.observe("auth.verify", "cached", time.time() - now)
+                return dict(data)
 
-    (sig, payload) = signed_request.split('.')
+        data = self._decode(signed_request)
+        
+        if self.cache_size:
+            trusted_until = self._trusted_until(data, now)
+            if trusted_until > now:
+                self._lock.acquire()
+                try:
+                    self._cache[signed_request] = (data, trusted_until)
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+                finally:
+                    self._lock.release()
+            
+        if instrument.enabled:
+            instrument.observe("auth.verify", "verified", time.time() - now)
+        return dict(data)
+        
+    def _decode(self, signed_request):
+        (sig, payload) = signed_request.split('.')
+
+        # check sig before trusting anything in the payload
+        sig = base64_url_decode(sig)
+        
+        mac = self._hmac.copy()
+        mac.update(str(payload))
+        if not constant_time_compare(sig, mac.digest()):
+            raise Exception('Bad Signed JSON signature!')
+
+        # decode data
+        data = json.loads(base64_url_decode(payload))
 
-    # decode data
-    sig = base64_url_decode(sig)
-    data = json.loads(base64_url_decode(payload))
+        if data['algorithm'].upper() != 'HMAC-SHA256':
+            raise Exception('Unknown algorithm. Expected HMAC-SHA256')
 
-    if data['algorithm'].upper() != 'HMAC-SHA256':
-        raise Exception('Unknown algorithm. Expected HMAC-SHA256')
+        return data
+        
+    def _trusted_until(self, data, now):
+        try:
+            trusted_until = int(data.get("issued_at", now)) + self.max_age
+        except (TypeError, ValueError):
+            return 0
+        
+        try:
+            expires = int(data.get("expires") or 0)   # 0 means the token doesn't expire
+        except (TypeError, ValueError):
+            return 0
+        if expires:
+            trusted_until = min(trusted_until, expires)
+            
+        return trusted_until
 
-    # check sig
-    expected_sig = hmac.new(app_secret, payload, sha256).digest()
-    if sig != expected_sig:
-        raise Exception('Bad Signed JSON signature!')
 
-    return data
+_verifiers = {}
+_verifiers_lock = threading.Lock()
 
+def get_verifier(app_secret):
+    ''' Shared SignedRequestVerifier for this app secret '''
+    
+    _verifiers_lock.acquire()
+    try:
+        verifier = _verifiers.get(app_secret)
+        if verifier is None:
+            verifier = _verifiers[app_secret] = SignedRequestVerifier(app_secret)
+        return verifier
+    finally:
+        _verifiers_lock.release()
+        
+        
+def constant_time_compare(a, b):
+    ''' Compare two strings in time that doesn't depend on how much of them matches '''
+    
+    if hasattr(hmac, "compare_digest"):
+        return hmac.compare_digest(a, b)
+        
+    # python < 2.7.7
+    if len(a) != len(b):
+        return False
+    result = 0
+    for (x, y) in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+        
 def base64_url_decode(input):
     ''' Do base 64 URL decoding.  Enforce that the input string is padding to a multiple
         of 4 characters. '''
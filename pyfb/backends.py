@@ -0,0 +1,589 @@
+''' Cache storage shared between processes.
+
+    An ObjectCache on its own lives in one process, so an app with many worker processes on several hosts keeps a copy
+    of the same profiles per process, and every deploy starts them all cold.  Give it (or a resultcache.ResultCache) a
+    backend to keep its objects somewhere else instead:
+
+        LocalBackend - this process's memory.  With serialize=True values are stored serialized, the way memcached
+                       stores them, which makes it a stand-in for MemcachedBackend in tests.
+        MemcachedBackend - memcached, through python-memcached (or App Engine's memcache API), shared by every process
+                           using the same servers.
+        SQLiteBackend - an SQLite database file, which survives restarts.  Shared by the processes on one host.
+        TieredBackend - a small in-process L1 in front of a shared L2 (e.g. LocalBackend in front of MemcachedBackend).
+                        Concurrent L1 misses for the same keys share one L2 read.
+
+    Values are JSON serializable data (None means "not cached").  Serialized values are compact JSON, zlib compressed
+    when that's worthwhile.  Backend errors are logged and count as misses: a cache that is down shouldn't take
+    requests down with it.
+'''
+
+import collections
+import hashlib
+import logging
+logger = logging.getLogger("pyfb")
+import os
+import threading
+import time
+import zlib
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    try:
+        import memcache
+    except ImportError:
+        memcache = None
+
+try:
+    import sqlite3
+except ImportError:
+    # not on app engine
+    sqlite3 = None
+
+import coalesce
+
+DEFAULT_TTL = 3600                  # seconds values are kept when set() isn't told
+DEFAULT_L1_TTL = 60                 # seconds TieredBackend keeps its L1 copies.  Other processes' changes show after this.
+DEFAULT_MAX_ENTRIES = 10000         # LocalBackend: values kept, least recently used are forgotten first
+COMPRESS_THRESHOLD = 1024           # serialized values longer than this many bytes are compressed
+MAX_KEY_LENGTH = 250                # memcached's limit
+MAX_MEMCACHED_TTL = 30 * 24 * 3600  # memcached takes longer times as a timestamp
+DEFAULT_COMPACT_INTERVAL = 3600     # SQLiteBackend: seconds between dropping expired values
+SQLITE_MAX_VARIABLES = 500          # keys per query, SQLite allows 999 parameters
+
+# first byte of a serialized value
+RAW = "j"
+COMPRESSED = "z"
+
+
+def serialize(value, compress_threshold=COMPRESS_THRESHOLD):
+    ''' value as a compact string: JSON without spaces, zlib compressed if it is longer than compress_threshold and
+        that makes it shorter '''
+
+    data = json.dumps(value, separators=(",", ":"))
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    if compress_threshold is not None and len(data) > compress_threshold:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return COMPRESSED + compressed
+    return RAW + data
+
+def deserialize(data):
+    ''' value of a serialized string, or of a buffer over one (as SQLite hands back blobs) '''
+
+    if data[:1] == COMPRESSED:
+        # decompresses straight out of a buffer, without copying it first
+        return json.loads(zlib.decompress(buffer(data, 1)))
+    return json.loads(str(data[1:]))
+
+
+class CacheBackend(object):
+    ''' Interface of the backends.  get_many and set_many are the ones to implement, the rest have defaults built on
+        them. '''
+
+    def get(self, key):
+        ''' value of key, or None if it isn't cached '''
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        ''' dictionary of key -> value for the keys that are cached '''
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key : value}, ttl)
+
+    def set_many(self, values, ttl=None):
+        ''' store a dictionary of key -> value for ttl seconds (or the backend's default) '''
+        raise NotImplementedError()
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def stats(self):
+        return {}
+
+
+class LocalBackend(CacheBackend):
+    ''' Thread safe TTL + LRU cache in this process's memory.
+
+        max_entries - values kept, least recently used are forgotten first
+        default_ttl - seconds values are kept when set() isn't told
+        serialize - store values serialized, so they are copies and have to survive serialization like with memcached
+        compress_threshold - see serialize()
+    '''
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, default_ttl=DEFAULT_TTL, serialize=False,
+                 compress_threshold=COMPRESS_THRESHOLD):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.serialize = serialize
+        self.compress_threshold = compress_threshold
+
+        self._entries = collections.OrderedDict()   # key -> (value, expires), least recently used first
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+
+        self._lock.acquire()
+        try:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is None or entry[1] <= now:
+                    self.misses += 1
+                    continue
+                self._entries[key] = entry
+                self.hits += 1
+                found[key] = entry[0]
+        finally:
+            self._lock.release()
+
+        if self.serialize:
+            found = dict([(key, deserialize(data)) for (key, data) in found.items()])
+        return found
+
+    def set_many(self, values, ttl=None):
+        if ttl is None:
+            ttl = self.default_ttl
+        expires = time.time() + ttl
+        if self.serialize:
+            values = dict([(key, serialize(value, self.compress_threshold)) for (key, value) in values.items()])
+
+        self._lock.acquire()
+        try:
+            for (key, value) in values.items():
+                self._entries.pop(key, None)
+                self._entries[key] = (value, expires)
+                self.sets += 1
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def delete_many(self, keys):
+        self._lock.acquire()
+        try:
+            for key in keys:
+                self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "sets" : self.sets,
+                "evictions" : self.evictions,
+                "entries" : len(self._entries),
+            }
+        finally:
+            self._lock.release()
+
+
+class MemcachedBackend(CacheBackend):
+    ''' Values kept in memcached.
+
+        servers - list of "host:port" strings, for a python-memcached Client
+        client - memcache client to use instead, anything with python-memcached's get_multi / set_multi / delete_multi
+                 / flush_all (e.g. App Engine's memcache module, the default on App Engine)
+        prefix - prepended to every key, so several apps (or versions of one) can share servers
+        default_ttl - seconds values are kept when set() isn't told
+        compress_threshold - see serialize()
+    '''
+
+    def __init__(self, servers=None, client=None, prefix="pyfb:", default_ttl=DEFAULT_TTL,
+                 compress_threshold=COMPRESS_THRESHOLD):
+        if client is None:
+            if memcache is None:
+                raise ImportError("MemcachedBackend needs python-memcached (or App Engine's memcache)")
+            if hasattr(memcache, "Client") and servers is not None:
+                client = memcache.Client(servers)
+            else:
+                client = memcache
+
+        self.client = client
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+        self.compress_threshold = compress_threshold
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.errors = 0             # calls to memcached that failed, and values that wouldn't deserialize
+        self.bytes_written = 0
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        names = dict([(self._name(key), key) for key in keys])
+
+        try:
+            results = self.client.get_multi(names.keys())
+        except Exception, e:
+            self._error("get", e)
+            return {}
+
+        found = {}
+        for (name, data) in results.items():
+            try:
+                found[names[name]] = deserialize(data)
+            except (KeyError, ValueError, zlib.error), e:
+                self._error("deserialize", e)
+
+        self._lock.acquire()
+        try:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        finally:
+            self._lock.release()
+        return found
+
+    def set_many(self, values, ttl=None):
+        if not values:
+            return
+        if ttl is None:
+            ttl = self.default_ttl
+        ttl = max(1, min(int(ttl), MAX_MEMCACHED_TTL))
+
+        data = dict([(self._name(key), serialize(value, self.compress_threshold)) for (key, value) in values.items()])
+        try:
+            failed = self.client.set_multi(data, time=ttl)
+        except Exception, e:
+            self._error("set", e)
+            return
+        if failed:
+            logger.warning("MemcachedBackend: failed to set %d of %d values" % (len(failed), len(data)))
+
+        self._lock.acquire()
+        try:
+            self.sets += len(data)
+            self.bytes_written += sum([len(d) for d in data.values()])
+        finally:
+            self._lock.release()
+
+    def delete_many(self, keys):
+        try:
+            self.client.delete_multi([self._name(key) for key in keys])
+        except Exception, e:
+            self._error("delete", e)
+
+    def clear(self):
+        ''' flushes the servers, including other apps' values if they share them '''
+
+        try:
+            self.client.flush_all()
+        except Exception, e:
+            self._error("flush", e)
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "sets" : self.sets,
+                "errors" : self.errors,
+                "bytes_written" : self.bytes_written,
+            }
+        finally:
+            self._lock.release()
+
+    def _name(self, key):
+        ''' memcached key for key: prefixed, and hashed if it's too long or has characters memcached doesn't allow '''
+
+        name = self.prefix + key
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        if len(name) > MAX_KEY_LENGTH or any([c <= " " or c == "\x7f" for c in name]):
+            name = self.prefix + hashlib.sha1(name).hexdigest()
+        return name
+
+    def _error(self, operation, e):
+        self._lock.acquire()
+        try:
+            self.errors += 1
+        finally:
+            self._lock.release()
+        logger.warning("MemcachedBackend: %s failed: %s" % (operation, e))
+
+
+class SQLiteBackend(CacheBackend):
+    ''' Values kept in an SQLite database file, so they survive restarts.  Several processes on a host can share one
+        file.
+
+        path - database file, created if it doesn't exist
+        default_ttl - seconds values are kept when set() isn't told
+        compress_threshold - see serialize()
+        compact_interval - seconds between automatic compactions (dropping expired values), checked on writes.  None
+                           leaves it to whoever calls compact().
+        timeout - seconds to wait for another process's write to finish
+
+        The database is opened on first use, and again in a child process after a fork, so a backend made before a
+        server forks its workers doesn't share one connection between them.
+    '''
+
+    def __init__(self, path, default_ttl=DEFAULT_TTL, compress_threshold=COMPRESS_THRESHOLD,
+                 compact_interval=DEFAULT_COMPACT_INTERVAL, timeout=5.0):
+        if sqlite3 is None:
+            raise ImportError("SQLiteBackend needs the sqlite3 module")
+
+        self.path = path
+        self.default_ttl = default_ttl
+        self.compress_threshold = compress_threshold
+        self.compact_interval = compact_interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+        # one connection shared by this process's threads, under the lock.  See _connection.
+        self._db = None
+        self._pid = None
+        self._compacted = time.time()
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.errors = 0
+        self.compactions = 0
+        self.expired = 0    # values dropped by compaction
+
+    def get_many(self, keys):
+        keys = list(keys)
+        now = time.time()
+        rows = []
+
+        self._lock.acquire()
+        try:
+            try:
+                db = self._connection()
+                for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                    chunk = keys[i:i + SQLITE_MAX_VARIABLES]
+                    rows.extend(db.execute("SELECT key, value FROM pyfb_cache WHERE expires > ? AND key IN (%s)"
+                                           % ", ".join(["?"] * len(chunk)), [now] + chunk).fetchall())
+            except sqlite3.Error, e:
+                self._error("get", e)
+                return {}
+            self.hits += len(rows)
+            self.misses += len(keys) - len(rows)
+        finally:
+            self._lock.release()
+
+        found = {}
+        for (key, data) in rows:
+            try:
+                found[key] = deserialize(data)
+            except (ValueError, zlib.error), e:
+                self._error("deserialize", e)
+        return found
+
+    def set_many(self, values, ttl=None):
+        if not values:
+            return
+        if ttl is None:
+            ttl = self.default_ttl
+        expires = time.time() + ttl
+        rows = [(key, sqlite3.Binary(serialize(value, self.compress_threshold)), expires)
+                for (key, value) in values.items()]
+
+        self._lock.acquire()
+        try:
+            try:
+                db = self._connection()
+                db.executemany("INSERT OR REPLACE INTO pyfb_cache (key, value, expires) VALUES (?, ?, ?)", rows)
+                db.commit()
+            except sqlite3.Error, e:
+                self._error("set", e)
+                return
+            self.sets += len(rows)
+            compact = (self.compact_interval is not None and time.time() - self._compacted > self.compact_interval)
+        finally:
+            self._lock.release()
+
+        if compact:
+            self.compact()
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        self._lock.acquire()
+        try:
+            try:
+                db = self._connection()
+                db.executemany("DELETE FROM pyfb_cache WHERE key = ?", [(key,) for key in keys])
+                db.commit()
+            except sqlite3.Error, e:
+                self._error("delete", e)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            try:
+                db = self._connection()
+                db.execute("DELETE FROM pyfb_cache")
+                db.commit()
+            except sqlite3.Error, e:
+                self._error("clear", e)
+        finally:
+            self._lock.release()
+
+    def compact(self, vacuum=False):
+        ''' drop expired values.  vacuum also gives the space they took back to the file system, which rewrites the
+            whole file, so it's best left to quiet times. '''
+
+        self._lock.acquire()
+        try:
+            self._compacted = time.time()
+            try:
+                db = self._connection()
+                expired = db.execute("DELETE FROM pyfb_cache WHERE expires <= ?", (time.time(),)).rowcount
+                db.commit()
+                if vacuum:
+                    db.execute("VACUUM")
+            except sqlite3.Error, e:
+                self._error("compact", e)
+                return
+            self.compactions += 1
+            self.expired += expired
+        finally:
+            self._lock.release()
+
+        logger.debug("SQLiteBackend: compacted %s, %d expired values dropped" % (self.path, expired))
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = None
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            try:
+                entries = self._connection().execute("SELECT COUNT(*) FROM pyfb_cache").fetchone()[0]
+            except sqlite3.Error:
+                entries = None
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "sets" : self.sets,
+                "errors" : self.errors,
+                "compactions" : self.compactions,
+                "expired" : self.expired,
+                "entries" : entries,
+            }
+        finally:
+            self._lock.release()
+
+    def _connection(self):
+        ''' this process's connection to the database, opened if need be.  Called with the lock held.  A connection
+            inherited from the parent process is left alone rather than closed, closing it could disturb the parent's
+            use of it. '''
+
+        pid = os.getpid()
+        if self._db is None or self._pid != pid:
+            self._db = None
+            db = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS pyfb_cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS pyfb_cache_expires ON pyfb_cache (expires)")
+            db.commit()
+            self._db = db
+            self._pid = pid
+        return self._db
+
+    def _error(self, operation, e):
+        # called with the lock held
+        self.errors += 1
+        logger.warning("SQLiteBackend: %s on %s failed: %s" % (operation, self.path, e))
+
+
+class TieredBackend(CacheBackend):
+    ''' An in-process l1 in front of a shared l2.  Reads try l1 first, and copy what they find in l2 into l1 for l1_ttl
+        seconds.  Writes and deletes go to both.  Threads missing l1 for the same keys at the same time share one l2
+        read.
+
+        l1 - e.g. LocalBackend(max_entries=1000)
+        l2 - e.g. MemcachedBackend(["cache1:11211", "cache2:11211"])
+        l1_ttl - seconds values are kept in l1.  Changes made by other processes (and their deletes) take up to this
+                 long to show here.
+    '''
+
+    def __init__(self, l1, l2, l1_ttl=DEFAULT_L1_TTL):
+        self.l1 = l1
+        self.l2 = l2
+        self.l1_ttl = l1_ttl
+        self._coalescer = coalesce.Coalescer()
+
+    def get_many(self, keys):
+        found = self.l1.get_many(keys)
+        missing = sorted(set([key for key in keys if key not in found]))
+        if missing:
+            found.update(self._coalescer.do(tuple(missing), lambda: self._get_l2(missing)))
+        return found
+
+    def set_many(self, values, ttl=None):
+        self.l2.set_many(values, ttl)
+        self.l1.set_many(values, self._l1_ttl(ttl))
+
+    def delete_many(self, keys):
+        self.l2.delete_many(keys)
+        self.l1.delete_many(keys)
+
+    def clear(self):
+        self.l2.clear()
+        self.l1.clear()
+
+    def stats(self):
+        return {
+            "l1" : self.l1.stats(),
+            "l2" : self.l2.stats(),
+            "coalesced" : self._coalescer.stats()["saved"],
+        }
+
+    def _get_l2(self, keys):
+        found = self.l2.get_many(keys)
+        if found:
+            self.l1.set_many(found, self.l1_ttl)
+        return found
+
+    def _l1_ttl(self, ttl):
+        if ttl is None:
+            return self.l1_ttl
+        return min(ttl, self.l1_ttl)
@@ -0,0 +1,143 @@
+''' Circuit breakers for facebook endpoints.
+
+    When an endpoint is down, every request to it ties up a thread until it times out.  A circuit breaker notices an
+    endpoint failing over and over and "opens": requests to it then fail straight away for a while instead of piling
+    up.  After reset_timeout one trial request is let through ("half open").  If it succeeds the circuit closes and
+    traffic flows again, otherwise it stays open for another reset_timeout.  So does a trial nobody reports back on
+    within reset_timeout (e.g. an abandoned async request).
+'''
+
+import logging
+logger = logging.getLogger("pyfb")
+import threading
+import time
+
+import instrument
+
+DEFAULT_FAILURE_THRESHOLD = 5   # failures in a row that open a circuit
+DEFAULT_RESET_TIMEOUT = 30      # seconds a circuit stays open before a trial request is let through
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half open"
+
+
+class Circuit(object):
+    ''' state of one endpoint '''
+
+    __slots__ = ("state", "failures", "opened_at", "trial_at")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0       # failures in a row
+        self.opened_at = 0
+        self.trial_at = 0       # when the half open circuit's trial request was let through
+
+
+class CircuitBreakers(object):
+    ''' Thread safe set of circuit breakers, one per key (e.g. endpoint).
+
+        failure_threshold - failures in a row that open a key's circuit
+        reset_timeout - seconds an open circuit fails requests before letting a trial one through
+    '''
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._circuits = {}     # key -> Circuit, only for keys that have failed recently
+        self._lock = threading.Lock()
+
+        # stats
+        self.opened = 0     # times a circuit opened
+        self.rejected = 0   # requests failed fast
+
+    def allow(self, key):
+        ''' True if a request to key may go out.  Call record() with how it went afterwards. '''
+
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(key)
+            if circuit is None or circuit.state == CLOSED:
+                return True
+
+            now = time.time()
+            if circuit.state == HALF_OPEN and now - circuit.trial_at >= self.reset_timeout:
+                # the trial never reported back, count it as failed
+                logger.warning("breaker: trial request to %s was never reported, reopening circuit" % key)
+                circuit.state = OPEN
+                circuit.opened_at = now
+
+            elif circuit.state == OPEN and now - circuit.opened_at >= self.reset_timeout:
+                # let one trial request through
+                circuit.state = HALF_OPEN
+                circuit.trial_at = now
+                return True
+
+            self.rejected += 1
+        finally:
+            self._lock.release()
+
+        if instrument.enabled:
+            instrument.count("net.circuit_open", key)
+        return False
+
+    def record(self, key, success):
+        ''' record the outcome of a request to key '''
+
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(key)
+            if success:
+                if circuit is not None:
+                    if circuit.state != CLOSED:
+                        logger.info("breaker: %s recovered, closing circuit" % key)
+                    # forget it, healthy endpoints don't need tracking
+                    del self._circuits[key]
+                return
+
+            if circuit is None:
+                circuit = self._circuits[key] = Circuit()
+            circuit.failures += 1
+
+            if circuit.state == HALF_OPEN or (circuit.state == CLOSED and circuit.failures >= self.failure_threshold):
+                circuit.state = OPEN
+                circuit.opened_at = time.time()
+                self.opened += 1
+                logger.warning("breaker: %s failed %d times in a row, opening circuit for %s seconds"
+                               % (key, circuit.failures, self.reset_timeout))
+        finally:
+            self._lock.release()
+
+    def state(self, key):
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(key)
+            if circuit is None:
+                return CLOSED
+            return circuit.state
+        finally:
+            self._lock.release()
+
+    def reset(self, key=None):
+        ''' close key's circuit, or all of them '''
+
+        self._lock.acquire()
+        try:
+            if key is None:
+                self._circuits.clear()
+            else:
+                self._circuits.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "opened" : self.opened,
+                "rejected" : self.rejected,
+                "open" : sorted([key for (key, circuit) in self._circuits.items() if circuit.state != CLOSED]),
+            }
+        finally:
+            self._lock.release()
@@ -0,0 +1,277 @@
+''' In-process caching of Facebook objects.
+
+    Profiles change rarely but we ask for the same ones over and over.  ObjectCache keeps the fields of each object
+    separately, so a request for a subset of fields we already have costs no network call, and a request for more
+    fields only has to fetch the ones that are missing.
+
+    By default the objects live in this process.  Give an ObjectCache a backend (see pyfb.backends) to keep them
+    somewhere every worker process can share instead, e.g. memcached behind a small in-process tier.
+'''
+
+import collections
+import logging
+logger = logging.getLogger("pyfb")
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+DEFAULT_TTL = 3600                  # seconds a cached field stays fresh
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024 # approximate memory cap for the cache
+
+ENTRY_OVERHEAD = 200    # rough per-object bookkeeping cost in bytes
+FIELD_OVERHEAD = 100    # rough per-field bookkeeping cost in bytes
+
+# stored for fields facebook left out of a response, so we don't keep asking for them
+ABSENT = object()
+
+
+class ObjectCache(object):
+    ''' Thread safe TTL + LRU cache of object fields, keyed by object id.
+
+        max_bytes - approximate memory cap.  Least recently used objects are evicted to stay under it.
+        default_ttl - seconds a field stays fresh
+        field_ttls - dictionary of per-field TTLs overriding default_ttl, e.g. {"picture" : 600}
+        backend - optional backends.CacheBackend to keep the objects in instead of this process's memory.  max_bytes
+                  is then up to the backend.
+        namespace - prefix of the backend keys, so caches of different kinds of object can share a backend
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, default_ttl=DEFAULT_TTL, field_ttls=None, backend=None,
+                 namespace="object"):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.field_ttls = field_ttls or {}
+        self.backend = backend
+        self.namespace = namespace
+
+        self._entries = collections.OrderedDict()   # object id -> {field : (value, expires)}, least recently used first
+        self._sizes = {}                            # object id -> approximate size in bytes
+        self.size = 0
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0           # lookups served entirely from the cache
+        self.partial_hits = 0   # lookups where some of the fields were cached
+        self.misses = 0         # lookups where none of the fields were cached
+        self.evictions = 0      # objects evicted to stay under max_bytes
+
+    def get(self, object_id, fields):
+        ''' Look up one object.  Returns (cached fields dictionary, list of fields that are missing or expired) '''
+
+        object_id = str(object_id)
+        (found, missing) = self.lookup([object_id], fields)
+        return (found.get(object_id, {}), missing.get(object_id, []))
+
+    def lookup(self, object_ids, fields):
+        ''' Look up several objects.  Returns (found, missing) where found maps object id to a dictionary of its fresh
+            cached fields and missing maps object id to the list of fields that have to be fetched. '''
+
+        object_ids = [str(object_id) for object_id in object_ids]
+        if self.backend is not None:
+            shared = self._get_shared(object_ids)
+
+        found = {}
+        missing = {}
+        now = time.time()
+
+        self._lock.acquire()
+        try:
+            for object_id in object_ids:
+                if self.backend is not None:
+                    entry = shared.get(object_id)
+                else:
+                    entry = self._entries.get(object_id)
+
+                cached = {}
+                needed = []
+                for field in fields:
+                    if entry is not None and field in entry and entry[field][1] > now:
+                        value = entry[field][0]
+                        if value is not ABSENT:
+                            cached[field] = value
+                    else:
+                        needed.append(field)
+
+                if entry is not None and self.backend is None:
+                    # mark as recently used
+                    del self._entries[object_id]
+                    self._entries[object_id] = entry
+
+                if not needed:
+                    self.hits += 1
+                elif len(needed) < len(fields):
+                    self.partial_hits += 1
+                else:
+                    self.misses += 1
+
+                if cached or not needed:
+                    found[object_id] = cached
+                if needed:
+                    missing[object_id] = needed
+        finally:
+            self._lock.release()
+
+        return (found, missing)
+
+    def put(self, object_id, obj, fields=None):
+        ''' Store the fields of obj.  fields is the list of fields that were asked for, any of them missing from obj are
+            remembered as absent.  Defaults to the keys of obj. '''
+
+        object_id = str(object_id)
+        if fields is None:
+            fields = obj.keys()
+
+        if self.backend is not None:
+            return self._put_shared(object_id, obj, fields)
+
+        evicted = []
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(object_id, None)
+            if entry is None:
+                entry = {}
+            self._entries[object_id] = entry
+            self._update(entry, obj, fields)
+
+            size = _entry_size(entry)
+            self.size += size - self._sizes.get(object_id, 0)
+            self._sizes[object_id] = size
+
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                (oldest_id, oldest) = self._entries.popitem(last=False)
+                self.size -= self._sizes.pop(oldest_id)
+                self.evictions += 1
+                evicted.append(oldest_id)
+        finally:
+            self._lock.release()
+
+        if evicted:
+            logger.debug("ObjectCache: evicted %d objects" % len(evicted))
+
+    def invalidate(self, object_id):
+        ''' Forget everything cached about an object '''
+
+        object_id = str(object_id)
+        if self.backend is not None:
+            self.backend.delete(self._key(object_id))
+            return
+
+        self._lock.acquire()
+        try:
+            if self._entries.pop(object_id, None) is not None:
+                self.size -= self._sizes.pop(object_id)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._sizes.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        ''' Snapshot of the cache counters '''
+
+        self._lock.acquire()
+        try:
+            return {
+                "hits" : self.hits,
+                "partial_hits" : self.partial_hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "objects" : len(self._entries),
+                "bytes" : self.size,
+                "backend" : self.backend.stats() if self.backend is not None else None,
+            }
+        finally:
+            self._lock.release()
+
+    def _update(self, entry, obj, fields):
+        now = time.time()
+        for field in fields:
+            ttl = self.field_ttls.get(field, self.default_ttl)
+            entry[field] = (obj.get(field, ABSENT), now + ttl)
+
+        # fields we weren't asked for but got anyway (e.g. id) are worth keeping too
+        for (field, value) in obj.items():
+            if field not in entry:
+                ttl = self.field_ttls.get(field, self.default_ttl)
+                entry[field] = (value, now + ttl)
+
+    def _key(self, object_id):
+        return "%s:%s" % (self.namespace, object_id)
+
+    def _get_shared(self, object_ids):
+        ''' object id -> entry of the objects the backend has '''
+
+        keys = dict([(self._key(object_id), object_id) for object_id in object_ids])
+        stored = self.backend.get_many(keys.keys())
+        return dict([(keys[key], _from_shared(value)) for (key, value) in stored.items()])
+
+    def _put_shared(self, object_id, obj, fields):
+        # read, merge and write back.  If two processes do this for the same object at once, the fields only one of
+        # them wrote get lost and are fetched again next time.
+        key = self._key(object_id)
+        entry = _from_shared(self.backend.get(key)) or {}
+        self._update(entry, obj, fields)
+
+        now = time.time()
+        entry = dict([(field, value) for (field, value) in entry.items() if value[1] > now])
+        if entry:
+            ttl = max([expires for (value, expires) in entry.values()]) - now
+            self.backend.set(key, _to_shared(entry), ttl)
+
+
+def group_missing(missing):
+    ''' Group the missing dictionary returned by ObjectCache.lookup into a list of (fields, object ids) pairs, so each
+        distinct set of missing fields can be fetched with one request. '''
+
+    groups = {}
+    for (object_id, fields) in missing.items():
+        groups.setdefault(tuple(fields), []).append(object_id)
+    return groups.items()
+
+
+def _to_shared(entry):
+    ''' entry as backend friendly data: field -> [expires, value], or [expires] for absent fields '''
+
+    shared = {}
+    for (field, (value, expires)) in entry.items():
+        if value is ABSENT:
+            shared[field] = [expires]
+        else:
+            shared[field] = [expires, value]
+    return shared
+
+def _from_shared(shared):
+    if shared is None:
+        return None
+
+    entry = {}
+    for (field, stored) in shared.items():
+        if len(stored) == 1:
+            entry[field] = (ABSENT, stored[0])
+        else:
+            entry[field] = (stored[1], stored[0])
+    return entry
+
+def _entry_size(entry):
+    ''' approximate size in bytes of a cache entry '''
+
+    size = ENTRY_OVERHEAD
+    for (field, (value, expires)) in entry.items():
+        size += FIELD_OVERHEAD + len(field)
+        if value is not ABSENT:
+            size += len(json.dumps(value))
+    return size
@@ -0,0 +1,118 @@
+''' Single-flight request coalescing.
+
+    When a page gets popular, lots of threads ask for exactly the same url at the same moment.  A Coalescer lets the
+    first caller for a key do the work while everybody else asking for the same key in the meantime waits for and
+    shares its result (or error).  Only use it for idempotent requests.
+'''
+
+import logging
+logger = logging.getLogger("pyfb")
+import sys
+import threading
+
+import engine
+
+DEFAULT_WAIT_TIMEOUT = 30   # seconds a caller waits on somebody else's request before giving up
+
+
+class Coalescer(object):
+    ''' Thread safe map of key -> request in flight.
+
+        wait_timeout - default number of seconds a caller waits for a shared request.  On timeout engine.RPCTimeout
+                       is raised, the shared request itself carries on.
+    '''
+
+    def __init__(self, wait_timeout=DEFAULT_WAIT_TIMEOUT):
+        self.wait_timeout = wait_timeout
+
+        self._calls = {}    # key -> RPC of the request in flight
+        self._lock = threading.Lock()
+
+        # stats
+        self.leaders = 0    # requests actually made
+        self.saved = 0      # callers that shared somebody else's request instead
+        self.timeouts = 0   # callers that gave up waiting on a shared request
+
+    def do(self, key, fn, timeout=None):
+        ''' Return fn(), unless a call for key is already in flight, in which case wait for and return its result.
+
+            timeout - seconds to wait on a shared call, defaults to wait_timeout
+        '''
+
+        self._lock.acquire()
+        try:
+            rpc = self._calls.get(key)
+            leader = rpc is None
+            if leader:
+                rpc = self._calls[key] = engine.RPC()
+                self.leaders += 1
+            else:
+                self.saved += 1
+        finally:
+            self._lock.release()
+
+        if leader:
+            try:
+                result = fn()
+            except:
+                self._forget(key, rpc)
+                rpc.set_exception(sys.exc_info())
+                raise
+            self._forget(key, rpc)
+            rpc.set_result(result)
+            return result
+
+        return self._wait(rpc, timeout)
+
+    def do_async(self, key, start_async):
+        ''' Asynchronous version of do.  start_async() must return an engine.RPC.  Returns the RPC for key, either a
+            new one from start_async() or the one already in flight. '''
+
+        self._lock.acquire()
+        try:
+            rpc = self._calls.get(key)
+            if rpc is not None:
+                self.saved += 1
+                return rpc
+
+            rpc = self._calls[key] = start_async()
+            self.leaders += 1
+        finally:
+            self._lock.release()
+
+        rpc.add_done_callback(lambda rpc: self._forget(key, rpc))
+        return rpc
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "leaders" : self.leaders,
+                "saved" : self.saved,
+                "timeouts" : self.timeouts,
+                "in_flight" : len(self._calls),
+            }
+        finally:
+            self._lock.release()
+
+    def _wait(self, rpc, timeout):
+        if timeout is None:
+            timeout = self.wait_timeout
+
+        try:
+            return rpc.get_result(timeout)
+        except engine.RPCTimeout:
+            self._lock.acquire()
+            try:
+                self.timeouts += 1
+            finally:
+                self._lock.release()
+            raise
+
+    def _forget(self, key, rpc):
+        self._lock.acquire()
+        try:
+            if self._calls.get(key) is rpc:
+                del self._calls[key]
+        finally:
+            self._lock.release()
@@ -0,0 +1,65 @@
+''' Deadline budgets for requests.
+
+    A budget is the time a whole operation may take, retries and all.  It is kept per thread, so it reaches every
+    request made inside it without having to be passed down through each helper:
+
+        with deadlines.budget(2.5):
+            friends = graph.get_friends_list(user_id, token)
+
+    Budgets nest, an inner budget can only shorten the outer one.  Requests made outside any budget each get
+    REQUEST_TIMEOUT seconds.
+'''
+
+import contextlib
+import logging
+logger = logging.getLogger("pyfb")
+import threading
+import time
+
+REQUEST_TIMEOUT = 10    # seconds a single request may take when there's no budget, or the budget is longer
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def budget(seconds):
+    ''' context manager limiting everything done inside it to seconds.  None leaves the current budget alone. '''
+
+    previous = current()
+    if seconds is not None:
+        end = time.time() + seconds
+        if previous is not None:
+            end = min(end, previous)
+        _local.end = end
+    try:
+        yield
+    finally:
+        _local.end = previous
+
+def current():
+    ''' time the calling thread's budget runs out, or None if it doesn't have one '''
+    return getattr(_local, "end", None)
+
+def set_current(end):
+    ''' hand a budget end time from current() over to another thread, e.g. a worker doing a request for the caller '''
+    _local.end = end
+
+def remaining():
+    ''' seconds left of the calling thread's budget (never negative), or None if it doesn't have one '''
+
+    end = current()
+    if end is None:
+        return None
+    return max(end - time.time(), 0)
+
+def expired():
+    end = current()
+    return end is not None and time.time() >= end
+
+def timeout():
+    ''' timeout for a single request: what's left of the budget, but no more than REQUEST_TIMEOUT '''
+
+    left = remaining()
+    if left is None:
+        return REQUEST_TIMEOUT
+    return min(left, REQUEST_TIMEOUT)
@@ -0,0 +1,336 @@
+''' Asynchronous request engine.
+
+    App engine hands back an RPC object from urlfetch.make_fetch_call() and we mirror that model off app engine: work
+    is submitted to a fixed set of worker threads and the caller gets an RPC handle back.  Many hundreds of requests
+    can be in flight through a handful of threads, and each host only gets max_per_host of them at once so one slow
+    endpoint can't hog all of the workers.
+'''
+
+import collections
+import logging
+logger = logging.getLogger("pyfb")
+import Queue
+import sys
+import threading
+
+import deadlines
+
+DEFAULT_WORKERS = 16        # worker threads per engine
+DEFAULT_MAX_PER_HOST = 8    # max concurrent requests to a single host
+
+
+class RPCTimeout(Exception):
+    ''' Raised by RPC.get_result() when the result isn't ready in time '''
+    pass
+
+
+class RPC(object):
+    ''' Handle to an asynchronous request.
+
+        callback - optional function called on the worker thread with the result.  Its return value becomes the
+                   result of the RPC.  It isn't called if the request raised.
+    '''
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._done_callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.isSet()
+
+    def wait(self, timeout=None):
+        ''' Block until the request finishes.  Returns True if it did, False on timeout. '''
+        self._event.wait(timeout)
+        return self._event.isSet()
+
+    def get_result(self, timeout=None):
+        ''' Wait for and return the result, re-raising the request's exception if it failed '''
+
+        if not self.wait(timeout):
+            raise RPCTimeout("RPC did not complete within %s seconds" % timeout)
+
+        if self._exc_info:
+            (t, v, tb) = self._exc_info
+            raise t, v, tb
+
+        return self._result
+
+    def add_done_callback(self, fn):
+        ''' Call fn(rpc) once the request is done.  Called immediately if it already is. '''
+
+        self._lock.acquire()
+        try:
+            if not self._event.isSet():
+                self._done_callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._event.set()
+            callbacks = self._done_callbacks
+            self._done_callbacks = []
+        finally:
+            self._lock.release()
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except:
+                logger.exception("RPC done callback failed")
+
+
+class GroupRPC(RPC):
+    ''' RPC that completes when all of a list of rpcs have.  Its result is the list of their results, or 
+        callback(results) if a callback is given.
+
+        If any of the rpcs can't notify us when they finish (app engine urlfetch rpcs only finish when waited on), the
+        group waits on them in order when it is itself waited on.
+    '''
+
+    def __init__(self, rpcs, callback=None):
+        RPC.__init__(self, callback)
+        self.rpcs = list(rpcs)
+        self._remaining = len(self.rpcs)
+        self._completing = False
+
+        self._lazy = False
+        for rpc in self.rpcs:
+            if not hasattr(rpc, "add_done_callback"):
+                self._lazy = True
+
+        if not self.rpcs:
+            self._complete()
+        elif not self._lazy:
+            for rpc in self.rpcs:
+                rpc.add_done_callback(self._child_done)
+
+    def wait(self, timeout=None):
+        if self._lazy:
+            self._complete()
+        return RPC.wait(self, timeout)
+
+    def _child_done(self, rpc):
+        self._lock.acquire()
+        try:
+            self._remaining -= 1
+            last = self._remaining == 0
+        finally:
+            self._lock.release()
+
+        if last:
+            self._complete()
+
+    def _complete(self):
+        self._lock.acquire()
+        try:
+            if self._completing:
+                return
+            self._completing = True
+        finally:
+            self._lock.release()
+
+        try:
+            results = [rpc.get_result() for rpc in self.rpcs]
+            if self.callback:
+                results = self.callback(results)
+        except:
+            self.set_exception(sys.exc_info())
+        else:
+            self.set_result(results)
+
+
+class BoundedGroupRPC(GroupRPC):
+    ''' GroupRPC over rpcs that are started by calling the functions in starts, no more than max_concurrency of them
+        running at a time: each rpc that finishes starts the next one.  Rpcs that can't notify us when they finish are
+        started as the group waits on them in order instead.
+    '''
+
+    def __init__(self, starts, max_concurrency, callback=None):
+        RPC.__init__(self, callback)
+        self.starts = list(starts)
+        self.rpcs = [None] * len(self.starts)
+        self.max_concurrency = max(1, max_concurrency)
+        self._next = 0
+        self._remaining = len(self.starts)
+        self._completing = False
+        self._lazy = False
+
+        if not self.starts:
+            self._complete()
+        for i in range(min(self.max_concurrency, len(self.starts))):
+            self._start_next()
+
+    def wait(self, timeout=None):
+        if self._lazy:
+            for i in range(len(self.rpcs)):
+                while self._next < min(i + self.max_concurrency, len(self.rpcs)):
+                    self._start_next()
+                self.rpcs[i].wait()
+            self._complete()
+        return RPC.wait(self, timeout)
+
+    def _child_done(self, rpc):
+        GroupRPC._child_done(self, rpc)
+        self._start_next()
+
+    def _start_next(self):
+        self._lock.acquire()
+        try:
+            i = self._next
+            if i >= len(self.starts):
+                return
+            self._next += 1
+        finally:
+            self._lock.release()
+
+        try:
+            rpc = self.starts[i]()
+        except:
+            rpc = RPC()
+            rpc.set_exception(sys.exc_info())
+        self.rpcs[i] = rpc
+
+        if hasattr(rpc, "add_done_callback"):
+            rpc.add_done_callback(self._child_done)
+        else:
+            self._lazy = True
+
+
+class Engine(object):
+    ''' Runs submitted functions on a pool of worker threads with a per-host concurrency limit. '''
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST):
+        self.workers = workers
+        self.max_per_host = max_per_host
+
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._active = {}       # host -> number of requests running
+        self._pending = {}      # host -> deque of tasks waiting for a free slot
+        self._lock = threading.Lock()
+
+    def submit(self, fn, host=None, callback=None):
+        ''' Run fn() in the background.  Returns an RPC handle.
+
+            host - requests with the same host share the max_per_host limit.  None means unlimited.
+            callback - see RPC
+        '''
+
+        rpc = RPC(callback)
+        task = (fn, rpc, host)
+
+        self._lock.acquire()
+        try:
+            self._start_workers()
+
+            if host is not None:
+                active = self._active.get(host, 0)
+                if active >= self.max_per_host:
+                    self._pending.setdefault(host, collections.deque()).append(task)
+                    return rpc
+                self._active[host] = active + 1
+        finally:
+            self._lock.release()
+
+        self._queue.put(task)
+        return rpc
+
+    def stats(self):
+        ''' number of running and queued requests per host '''
+
+        self._lock.acquire()
+        try:
+            return {
+                "active" : dict(self._active),
+                "pending" : dict([(host, len(tasks)) for (host, tasks) in self._pending.items()]),
+            }
+        finally:
+            self._lock.release()
+
+    def _start_workers(self):
+        # called with the lock held
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._work, name="pyfb-engine-%d" % len(self._threads))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            (fn, rpc, host) = self._queue.get()
+            try:
+                self._run(fn, rpc)
+            finally:
+                self._task_finished(host)
+
+    def _run(self, fn, rpc):
+        # tasks start outside any deadline budget, whatever the worker's last task left behind
+        deadlines.set_current(None)
+        try:
+            result = fn()
+            if rpc.callback:
+                result = rpc.callback(result)
+        except:
+            rpc.set_exception(sys.exc_info())
+        else:
+            rpc.set_result(result)
+
+    def _task_finished(self, host):
+        if host is None:
+            return
+
+        next_task = None
+        self._lock.acquire()
+        try:
+            pending = self._pending.get(host)
+            if pending:
+                next_task = pending.popleft()
+                if not pending:
+                    del self._pending[host]
+            else:
+                self._active[host] -= 1
+                if not self._active[host]:
+                    del self._active[host]
+        finally:
+            self._lock.release()
+
+        if next_task:
+            self._queue.put(next_task)
+
+
+def wait_all(rpcs, timeout=None):
+    ''' Wait for all of the RPCs and return their results in order.  Raises the first failure.  timeout is per RPC. '''
+    return [rpc.get_result(timeout) for rpc in rpcs]
+
+
+_default_engine = None
+_default_engine_lock = threading.Lock()
+
+def default_engine():
+    ''' shared engine used by pyfb.net '''
+    global _default_engine
+
+    _default_engine_lock.acquire()
+    try:
+        if _default_engine is None:
+            _default_engine = Engine()
+        return _default_engine
+    finally:
+        _default_engine_lock.release()
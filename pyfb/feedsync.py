@@ -0,0 +1,360 @@
+''' Incremental sync of users' feeds.
+
+    Polling a feed with graph.get_wall_posts downloads the same first page every time, most of it already seen.  A
+    FeedSync keeps a cursor per user (the time and ids of the newest and oldest posts seen so far) and only asks for
+    what is newer, with the graph api's since parameter:
+
+        sync = feedsync.FeedSync()
+        posts = sync.sync(user_id, access_token)        # the newest page the first time, only new posts after that
+        older = sync.backfill(user_id, access_token)    # a page of the posts from before the first sync
+
+    Posts are de-duplicated by id, so a post is returned once however the pages fall.  Cursors live in memory by
+    default, give FeedSync a SQLiteCursorStore to keep them across restarts.
+'''
+
+import calendar
+import logging
+logger = logging.getLogger("pyfb")
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+try:
+    import sqlite3
+except ImportError:
+    # not on app engine
+    sqlite3 = None
+
+import graph
+
+DEFAULT_PAGE_SIZE = 50      # posts per request
+DEFAULT_FIRST_PAGES = 1     # pages the first sync of a user gets, older posts are left to backfill
+DEFAULT_MAX_PAGES = 20      # pages one sync gets at most.  Anything more is left for the next syncs.
+
+
+class MemoryCursorStore(object):
+    ''' Thread safe cursors in this process's memory.  Cursor stores map user id -> cursor, a JSON serializable
+        dictionary. '''
+
+    def __init__(self):
+        self._cursors = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        ''' user's cursor, or None if their feed hasn't been synced '''
+
+        self._lock.acquire()
+        try:
+            cursor = self._cursors.get(str(user_id))
+            if cursor is not None:
+                cursor = dict(cursor)
+            return cursor
+        finally:
+            self._lock.release()
+
+    def put(self, user_id, cursor):
+        self._lock.acquire()
+        try:
+            self._cursors[str(user_id)] = dict(cursor)
+        finally:
+            self._lock.release()
+
+    def delete(self, user_id):
+        self._lock.acquire()
+        try:
+            self._cursors.pop(str(user_id), None)
+        finally:
+            self._lock.release()
+
+
+class SQLiteCursorStore(object):
+    ''' Cursors kept in an SQLite database file, so syncs carry on where they left off after a restart.
+
+        path - database file, created if it doesn't exist.  Can be the same file as a backends.SQLiteBackend's.
+        timeout - seconds to wait for another process's write to finish
+    '''
+
+    def __init__(self, path, timeout=5.0):
+        if sqlite3 is None:
+            raise ImportError("SQLiteCursorStore needs the sqlite3 module")
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pyfb_feed_cursors "
+                         "(user_id TEXT PRIMARY KEY, cursor TEXT, updated REAL)")
+        self._db.commit()
+
+    def get(self, user_id):
+        self._lock.acquire()
+        try:
+            row = self._db.execute("SELECT cursor FROM pyfb_feed_cursors WHERE user_id = ?",
+                                   (str(user_id),)).fetchone()
+        finally:
+            self._lock.release()
+
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, user_id, cursor):
+        self._lock.acquire()
+        try:
+            self._db.execute("INSERT OR REPLACE INTO pyfb_feed_cursors (user_id, cursor, updated) VALUES (?, ?, ?)",
+                             (str(user_id), json.dumps(cursor), time.time()))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def delete(self, user_id):
+        self._lock.acquire()
+        try:
+            self._db.execute("DELETE FROM pyfb_feed_cursors WHERE user_id = ?", (str(user_id),))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+
+class FeedSync(object):
+    ''' Fetches the posts of users' feeds that haven't been seen yet.  Thread safe, as long as each user's feed is only
+        synced by one thread at a time.
+
+        store - cursor store, defaults to a MemoryCursorStore
+        page_size - posts per request
+        first_pages - pages the first sync of a user returns
+        max_pages - pages one sync or backfill fetches at most
+
+        A cursor is a dictionary of
+            newest_time, newest_ids - unix time of the newest post seen, and the ids of the posts seen from then
+            oldest_time, oldest_ids - the same for the oldest post seen
+            complete - True once backfill has reached the start of the feed
+            gaps - posts between syncs that haven't been fetched yet, newest first.  A sync that finds more than
+                   max_pages pages of new posts returns the newest ones and leaves a gap of
+                   {until_time, until_ids, since_time, since_ids} behind them, which later syncs drain.
+    '''
+
+    def __init__(self, store=None, page_size=DEFAULT_PAGE_SIZE, first_pages=DEFAULT_FIRST_PAGES,
+                 max_pages=DEFAULT_MAX_PAGES):
+        if store is None:
+            store = MemoryCursorStore()
+        self.store = store
+        self.page_size = page_size
+        self.first_pages = first_pages
+        self.max_pages = max_pages
+        self._lock = threading.Lock()
+
+        # stats
+        self.syncs = 0
+        self.backfills = 0
+        self.posts = 0          # new posts returned
+        self.duplicates = 0     # posts fetched again and dropped
+
+    def sync(self, user_id, access_token):
+        ''' List of the user's posts newer than any seen before, newest first.  The first time, the newest first_pages
+            pages.  If there are more than max_pages pages of them, the rest come with the next syncs, after the posts
+            new by then. '''
+
+        cursor = self.store.get(user_id)
+        if cursor is None:
+            since = None
+            seen = set()
+            wanted = self.first_pages * self.page_size
+        else:
+            since = cursor["newest_time"]
+            seen = set(cursor["newest_ids"])
+            wanted = self.max_pages * self.page_size
+
+        posts = graph.iter_wall_posts(user_id, access_token, self.page_size, prefetch=False, since=since)
+        (new, exhausted) = self._collect(posts, seen, wanted, lambda t: since is not None and t < since)
+
+        if cursor is not None:
+            gaps = cursor.setdefault("gaps", [])
+            if not exhausted:
+                gap = {
+                    "until_time" : None,
+                    "until_ids" : [],
+                    "since_time" : since,
+                    "since_ids" : list(seen),
+                }
+                _advance(gap, "until", new, min)
+                if gap["until_time"] is None:
+                    logger.warning("feedsync: more than %d new posts for user %s without created times, skipped the "
+                                   "older ones" % (wanted, user_id))
+                else:
+                    logger.info("feedsync: more than %d new posts for user %s, fetching the older ones later" %
+                                (wanted, user_id))
+                    gaps.insert(0, gap)
+            new.extend(self._fill_gaps(user_id, access_token, gaps, wanted - len(new)))
+        else:
+            cursor = {
+                "newest_time" : None,
+                "newest_ids" : [],
+                "oldest_time" : None,
+                "oldest_ids" : [],
+                "complete" : exhausted,
+                "gaps" : [],
+            }
+            _advance(cursor, "oldest", new, min)
+        _advance(cursor, "newest", new, max)
+        self.store.put(user_id, cursor)
+
+        self._count(new, syncs=1)
+        logger.debug("feedsync: %d new posts for user %s" % (len(new), user_id))
+        return new
+
+    def backfill(self, user_id, access_token, pages=1):
+        ''' List of up to pages pages of the user's posts older than any seen before, newest first.  Empty once the
+            start of the feed has been reached.  Syncs first if the user's feed hasn't been synced yet. '''
+
+        cursor = self.store.get(user_id)
+        if cursor is None:
+            return self.sync(user_id, access_token)
+        if cursor["complete"] or cursor["oldest_time"] is None:
+            return []
+
+        until = cursor["oldest_time"]
+        seen = set(cursor["oldest_ids"])
+        wanted = min(pages, self.max_pages) * self.page_size
+
+        posts = graph.iter_wall_posts(user_id, access_token, self.page_size, prefetch=False, until=until)
+        (old, exhausted) = self._collect(posts, seen, wanted, lambda t: t > until)
+
+        _advance(cursor, "oldest", old, min)
+        cursor["complete"] = exhausted
+        self.store.put(user_id, cursor)
+
+        self._count(old, backfills=1)
+        logger.debug("feedsync: backfilled %d posts for user %s" % (len(old), user_id))
+        return old
+
+    def cursor(self, user_id):
+        return self.store.get(user_id)
+
+    def reset(self, user_id):
+        ''' forget the user's cursor, the next sync starts over '''
+        self.store.delete(user_id)
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "syncs" : self.syncs,
+                "backfills" : self.backfills,
+                "posts" : self.posts,
+                "duplicates" : self.duplicates,
+            }
+        finally:
+            self._lock.release()
+
+    def _fill_gaps(self, user_id, access_token, gaps, wanted):
+        ''' up to wanted posts from gaps, newest first.  Drained gaps are removed, the rest moved on past the posts
+            returned. '''
+
+        filled = []
+        while gaps and len(filled) < wanted:
+            gap = gaps[0]
+            until = gap["until_time"]
+            since = gap["since_time"]
+            seen = set(gap["until_ids"]) | set(gap["since_ids"])
+
+            posts = graph.iter_wall_posts(user_id, access_token, self.page_size, prefetch=False, since=since,
+                                          until=until)
+            (old, exhausted) = self._collect(posts, seen, wanted - len(filled),
+                                             lambda t: t > until or (since is not None and t < since))
+            filled.extend(old)
+            if exhausted:
+                gaps.pop(0)
+            else:
+                _advance(gap, "until", old, min)
+
+        return filled
+
+    def _collect(self, posts, seen, wanted, out_of_range):
+        ''' (up to wanted posts whose ids aren't in seen, True if posts ran out first).  Stops at the first post whose
+            time is out_of_range, in case facebook ignored since or until. '''
+
+        new = []
+        ids = set()
+        duplicates = 0
+        for post in posts:
+            created = post_time(post)
+            if created is not None and out_of_range(created):
+                return (new, True)
+
+            post_id = post.get("id")
+            if post_id in seen or post_id in ids:
+                duplicates += 1
+                continue
+            ids.add(post_id)
+            new.append(post)
+            if len(new) >= wanted:
+                self._count([], duplicates=duplicates)
+                return (new, False)
+
+        self._count([], duplicates=duplicates)
+        return (new, True)
+
+    def _count(self, posts, syncs=0, backfills=0, duplicates=0):
+        self._lock.acquire()
+        try:
+            self.posts += len(posts)
+            self.syncs += syncs
+            self.backfills += backfills
+            self.duplicates += duplicates
+        finally:
+            self._lock.release()
+
+
+def post_time(post):
+    ''' unix time a post was created, or None if it doesn't say '''
+
+    created = post.get("created_time")
+    if isinstance(created, (int, long)):
+        return created
+    if not created:
+        return None
+
+    # e.g. 2011-03-17T20:26:40+0000
+    try:
+        t = calendar.timegm(time.strptime(created[:19], "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        logger.warning("feedsync: can't parse created_time %r" % created)
+        return None
+
+    offset = created[19:]
+    if len(offset) == 5 and offset[0] in "+-" and offset[1:].isdigit():
+        seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        if offset[0] == "+":
+            t -= seconds
+        else:
+            t += seconds
+    return t
+
+def _advance(cursor, end, posts, pick):
+    ''' move the newest or oldest (end) time and ids of cursor on to posts' if they go further.  pick is max for the
+        newest end, min for the oldest. '''
+
+    times = [(post_time(post), post.get("id")) for post in posts]
+    times = [(t, post_id) for (t, post_id) in times if t is not None]
+    if not times:
+        return
+
+    t = pick([t for (t, post_id) in times])
+    ids = [post_id for (created, post_id) in times if created == t]
+    current = cursor[end + "_time"]
+    if current is None or pick(t, current) != current:
+        cursor[end + "_time"] = t
+        cursor[end + "_ids"] = ids
+    elif t == current:
+        cursor[end + "_ids"] = list(set(cursor[end + "_ids"]) | set(ids))
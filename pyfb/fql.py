@@ -16,33 +16,167 @@ except ImportError:
 import time
 import urllib
 
+import engine
+import instrument
+import jsonstream
 import net
+import ratelimit
+import records
+import resultcache
+import tokens
+import transports
 
 class InvalidOAuthException(Exception):
     pass
 
+class FQLException(Exception):
+    ''' FQL request came back with an error code, or a response we didn't expect '''
+    
+    def __init__(self, msg, error_code=None):
+        Exception.__init__(self, msg)
+        self.error_code = error_code
+
 # fql api base url
 FQL_BASE_URL = "https://api.facebook.com/method/fql.query?format=json"
+FQL_MULTIQUERY_URL = "https://api.facebook.com/method/fql.multiquery?format=json"
 
-def get_fql(url):
-    ''' Generic helper to execute an FQL request and handle error codes.  '''
+def get_fql(url, deadline=None):
+    ''' Generic helper to execute an FQL request and handle error codes.
+    
+        deadline - seconds the request may take, retries included.  See net.get.
+    '''
     
     # record time to get FQL data.
     t1 = time.time()
     
-    s = net.get(url)
+    check_token(url)
+    s = net.get(url, deadline)
+    o = parse_fql_response(s, url)
+    
+    # success
+
+    t2 = time.time()
+    x = t2 - t1
+    logger.info("get_fql: took %0.2f seconds" % x)
+    if instrument.enabled:
+        instrument.observe("fql.total", instrument.endpoint(url), x)
+
+    return o
+
+def get_many(queries, access_token, max_concurrency=net.DEFAULT_MAX_CONCURRENCY, deadline=None):
+    ''' Run several independent FQL queries concurrently.
+    
+        max_concurrency - max number of requests in flight
+        deadline - overall time limit in seconds
+        
+        Returns a list in the same order as queries.  Each entry is either the decoded result or the exception the
+        query raised (e.g. InvalidOAuthException).
+    '''
+    
+    urls = [get_url(query, access_token) for query in queries]
+    results = net.get_many(urls, max_concurrency, deadline)
+    
+    objects = []
+    for (url, r) in zip(urls, results):
+        if not isinstance(r, Exception):
+            try:
+                r = parse_fql_response(r, url)
+            except Exception, e:
+                r = e
+        objects.append(r)
+        
+    return objects
+
+def get_url(query, access_token):
+    ''' Build the request url for an FQL query string '''
+    
+    url = FQL_BASE_URL
+    url += "&access_token=%s" % access_token
+    url += "&query=%s" % urllib.quote(query)
+    return url
+
+def get_fql_async(url, callback=None):
+    ''' Asynchronous version of get_fql.  Returns an RPC handle whose get_result() returns the decoded FQL result or
+        raises the same errors get_fql would.
+        
+        callback - if given, called with the decoded result.  Its return value becomes the rpc's result.
+    '''
+    
+    check_token(url)
     
+    def result_callback(s):
+        o = parse_fql_response(s, url)
+        if callback:
+            return callback(o)
+        return o
+        
+    return net.get_async(url, result_callback)
+
+def iter_fql(url):
+    ''' Streaming version of get_fql for queries that return lots of rows.  Generator over the result rows, decoded
+        one at a time as the response comes in instead of loading the whole result into memory first.  Raises the
+        same errors get_fql would, before yielding any rows.
+    '''
+
+    check_token(url)
+
+    t1 = time.time()
+    count = 0
+
+    stream = net.get_stream(url)
+    rows = jsonstream.ArrayStream(stream)
+    try:
+        for row in rows:
+            yield row
+            count += 1
+    finally:
+        # the caller may stop part way through the rows
+        stream.close()
+
+    if rows.document is not None:
+        # not a list of rows, most likely an error
+        check_fql_error(rows.document, url)
+        raise FQLException("Unexpected FQL response: %s, url=%s" % (rows.document, url))
+
+    logger.info("iter_fql: %d rows took %0.2f seconds" % (count, time.time() - t1))
+
+def iter_run(query, access_token):
+    ''' Streaming version of run for queries whose result is a list of rows.  Query.parse isn't applied, it works on
+        the whole result. '''
+
+    if isinstance(query, Query):
+        query = query.fql
+
+    logger.debug("fql query = %s" % query)
+    return iter_fql(get_url(query, access_token))
+
+def parse_fql_response(s, url):
+    ''' Decode the body of an FQL response and raise if it's an error.  Returns the decoded result. '''
+
     if not s:
-        raise NetException("Failed to execute FQL request, url=%s" % url)
+        raise net.NetException("Failed to execute FQL request, url=%s" % url)
         
     
     # should have json.  check for error or success now.
-    o = json.loads(s)
+    o = instrument.loads(s, url)
     
     #logger.info("****FQL:")
     #logger.info(o)
     #logger.info("*************")
     
+    check_fql_error(o, url)
+    return o
+    
+def check_token(url):
+    ''' Fail straight away with InvalidOAuthException if the url's access token is one facebook already rejected (or
+        has expired), instead of making a request to find out again. '''
+    
+    if tokens.manager.is_dead(tokens.token_from_url(url)):
+        raise InvalidOAuthException("Invalid auth: access token was already rejected or has expired, url=%s" % url)
+    
+def check_fql_error(o, url):
+    ''' Raise the appropriate exception if the decoded FQL result o is an error '''
+    
     # type checking is ghetto, but FQL will return a JSON dictionary on error and a potentially a list otherwise.  If it's not a dictionary,
     # skip further error checking.
     
@@ -51,28 +185,27 @@ def get_fql(url):
 
             error_code = o["error_code"]
         
-            try:
-                error_msg = o["error_msg"]
-            except KeyError:
-                error_msg = ""
-            
-            if error_code == 190: # Invalid OAuth 2.0 token
-                raise InvalidOAuthException("Invalid auth: error_msg='%s', url=%s" % (error_msg, url))
-        
-            else:
-                raise Exception("FQL error code: %d, error_msg='%s', url=%s" % (error_code, error_msg, url))
-                
         except KeyError:
             # no error.  should have successfully retrieved friends json.
-            pass
+            return
+            
+        try:
+            error_msg = o["error_msg"]
+        except KeyError:
+            error_msg = ""
+            
+        if instrument.enabled:
+            instrument.count("fb.errors", str(error_code))
+        if net.scheduler is not None:
+            # FQL reports throttling in a 200 response, so net can't spot it
+            net.scheduler.report(url, error_code)
         
-    # success
-
-    t2 = time.time()
-    x = t2 - t1
-    logger.info("get_fql: took %0.2f seconds" % x)
-
-    return o
+        if error_code == 190: # Invalid OAuth 2.0 token
+            tokens.manager.mark_dead(tokens.token_from_url(url))
+            raise InvalidOAuthException("Invalid auth: error_msg='%s', url=%s" % (error_msg, url))
+    
+        else:
+            raise FQLException("FQL error code: %d, error_msg='%s', url=%s" % (error_code, error_msg, url), error_code)
 
 
 
@@ -100,105 +233,334 @@ USER_COLUMNS = [
 ]
 USER_COLUMN_CLAUSE = ", ".join(USER_COLUMNS)
 
-def get_user(access_token, uid="me()"):
-    ''' Get top level user information.  Return user's info. '''
-    
-    query = urllib.quote("SELECT %s FROM user WHERE uid = %s" % (USER_COLUMN_CLAUSE, uid))
-    
-    url = FQL_BASE_URL
-    url += "&access_token=%s" % access_token
-    url += "&query=%s" % query
-    
-    logger.debug("get_user fql url = %s" % query)
+# optional cache.ObjectCache for get_user, keyed by uid.  None disables caching.  Note cached columns are shared by
+# every access token, so only enable it if that's acceptable for your app.
+user_cache = None
+
+def get_user(access_token, uid="me()", columns=None):
+    ''' Get top level user information.  Return user's info. 
     
-    o = get_fql(url)
+        columns - list of user table columns to get, defaults to USER_COLUMNS
+    '''
     
-    # user json comes back as a list of length 1 containing the user's info
-    if len(o) != 1:
-        raise FQLException("Weird user response: %s" % o)
+    if not columns:
+        columns = USER_COLUMNS
         
-    user = o[0]
+    if user_cache is None or uid == "me()":
+        # can't cache me() without knowing who it is
+        return _get_user(access_token, uid, columns)
     
+    (user, missing) = user_cache.get(uid, columns)
+    if missing:
+        o = _get_user(access_token, uid, missing)
+        user_cache.put(uid, o, missing)
+        user.update(o)
+        
+    user.setdefault("uid", uid)
     return user
+    
+def _get_user(access_token, uid, columns):
+    return run(user_query(uid, columns), access_token)
 
 def get_friend_app_user_list(access_token, uid="me()"):
     ''' Get list of user's friends who have installed the current application '''
+    return run(friend_app_user_list_query(uid), access_token)
+
+def get_friend_uid_list(access_token, uid="me()"):
+    ''' Get list of users friends with just uids. '''
+    return run(friend_uid_list_query(uid), access_token)
+        
+# optional planner.ChunkPlanner.  With it set, get_friends and iter_friends get the friend uid list first and then the
+# friends' rows in chunks of uids, several at a time.  None sends one query for everything.
+friends_planner = None
+
+def get_friends(access_token, compact=False):
+    ''' Get info about all of the user's friends. 
     
-    friend_query = "SELECT uid1 FROM friend WHERE uid2 = %s" % str(uid)
-    get_app_user_query = "SELECT uid from user where is_app_user=1 and uid in (%s)" % (friend_query)
-    get_app_user_query = urllib.quote(get_app_user_query)
+        This method can be really expensive so break it down into multiple requests.  See friends_planner.
+        
+        compact - return a records.Table instead of a list of dictionaries
+     '''
+
+    if friends_planner is not None:
+        o = list(_iter_friends_chunked(access_token, friends_planner))
+    else:
+        o = run(friends_query(), access_token)
+
+    logger.debug("Got friends: %s" % o)
+    if compact:
+        return records.Table.from_rows(o, USER_COLUMNS)
+    return o
+
+def iter_friends(access_token):
+    ''' Streaming version of get_friends.  Generator over the friend rows, for users with so many friends that
+        decoding the whole result at once is a problem.  With friends_planner set, the rows of each chunk are
+        yielded as soon as it arrives. '''
+
+    if friends_planner is not None:
+        return _iter_friends_chunked(access_token, friends_planner)
+    return iter_run(friends_query(), access_token)
     
-    url = FQL_BASE_URL
-    url += "&access_token=%s" % access_token
-    url += "&query=%s" % get_app_user_query
-    o = get_fql(url)
+def _iter_friends_chunked(access_token, planner):
+    ''' friends_query's rows, fetched in chunks sized by planner.  A chunk that times out or fails on facebook's end
+        is split in two and tried again. '''
+    
+    uids = get_friend_uid_list(access_token)
+    
+    def start(chunk):
+        started = time.time()
+        
+        def result_callback(rows):
+            planner.succeeded(len(chunk), time.time() - started)
+            return rows
+            
+        return get_fql_async(get_url(friends_chunk_query(chunk).fql, access_token), result_callback)
+        
+    pending = planner.split(uids)
+    while pending:
+        chunks = pending
+        pending = []
+        for (i, result) in net.iter_fetch_many(start, [(chunk,) for chunk in chunks], planner.max_concurrency):
+            if isinstance(result, Exception):
+                chunk = chunks[i]
+                if len(chunk) > 1 and _chunk_too_big(result):
+                    planner.failed(len(chunk))
+                    pending.extend(planner.split(chunk, (len(chunk) + 1) / 2))
+                    continue
+                raise result
+                
+            for row in result:
+                yield row
+                
+def _chunk_too_big(e):
+    ''' could a chunk that failed with e succeed if it was smaller? '''
+    
+    if isinstance(e, (net.DeadlineExceeded, net.CircuitOpen)):
+        # out of time, or not even sent
+        return False
+    if isinstance(e, FQLException):
+        # unknown error / service unavailable, which is what facebook says when a query takes too long
+        return e.error_code in (1, 2)
+    if isinstance(e, net.NetException):
+        return e.status is None or e.status >= 500
+    return transports.is_network_error(e)
 
-    # list of dictionary objects containly only 'uid1' as a key for each uid
-    logger.debug(o)
-    uids = [ d["uid"] for d in o]
-    logger.debug(uids)
-    return uids
+# optional nameindex.NameIndex that find_friends_by_name searches instead of sending a query per call.  None disables
+# it.
+name_index = None
 
-def get_friend_uid_list(access_token, uid="me()"):
-    ''' Get list of users friends with just uids. '''
+def find_friends_by_name(access_token, name_query, limit=None):
+    ''' search friends to find those who match the given name substring 
     
-    get_list_query = "SELECT uid1 from friend where uid2 = %s" % str(uid)
-    get_list_query = urllib.quote(get_list_query)
+        limit - max number of friends to return
+        
+        With name_index set, the user's friend list is fetched once (in the background) and searched locally from then
+        on.  Until it has arrived, the search is done by FQL as before.
+    '''
     
-    url = FQL_BASE_URL
-    url += "&access_token=%s" % access_token
-    url += "&query=%s" % get_list_query
-    o = get_fql(url)
+    if name_index is not None:
+        key = _name_index_key(access_token)
+        if name_index.needs_refresh(key):
+            index_friends_async(access_token)
+            
+        o = name_index.search(key, name_query, limit)
+        if o is not None:
+            return o
+    
+    o = run(find_friends_by_name_query(name_query, limit), access_token)
+
+    logger.debug("Found matching friends: %s" % o)
+    return o
     
-    # list of dictionary objects containly only 'uid1' as a key for each uid
-    logger.debug(o)
-    uids = [ d["uid1"] for d in o]
-    logger.debug(uids)
-    return uids
+def index_friends(access_token):
+    ''' Fetch the user's friend list into name_index.  Returns the friend rows. '''
+    
+    key = _name_index_key(access_token)
+    try:
+        o = run(friend_names_query(), access_token)
+    except:
+        name_index.refresh_failed(key)
+        raise
         
-def get_friends(access_token):
-    ''' Get info about all of the user's friends. 
+    name_index.update(key, o)
+    return o
+    
+def index_friends_async(access_token):
+    ''' index_friends on the default engine, at background priority.  Returns an RPC handle. '''
+    
+    def index():
+        with ratelimit.request_priority(ratelimit.BACKGROUND):
+            return index_friends(access_token)
+            
+    return engine.default_engine().submit(index)
+    
+def _name_index_key(access_token):
+    # the user the token belongs to if we know, the token itself otherwise
+    return tokens.manager.get_user_id(access_token) or access_token
+    
     
-        This method can be really expensive so break it down into multiple requests.
+class Query(object):
+    ''' An FQL query plus the function that turns its result rows into what the matching helper returns.  Built by
+        the *_query functions below so the helpers can be run on their own or combined into one multiquery. 
         
-     '''
+        fql - query text
+        parse - optional function of the result rows, defaults to returning the rows
+    '''
+    
+    def __init__(self, fql, parse=None):
+        self.fql = fql
+        self.parse = parse
+        
+    def result(self, rows):
+        if self.parse:
+            return self.parse(rows)
+        return rows
+        
+# optional resultcache.ResultCache for run (and so every helper built on it), keyed by the normalized query and the user
+# behind the access token.  None disables it.
+result_cache = None
+
+def _cacheable_error(e):
+    # a rejected token stays rejected, no point asking again straight away.  Cached for that token only.
+    return isinstance(e, InvalidOAuthException)
 
+def run(query, access_token, deadline=None):
+    ''' Execute a Query (or query string) and return its parsed result.  See get_fql for deadline. '''
+    
+    if not isinstance(query, Query):
+        query = Query(query)
+    
+    logger.debug("fql query = %s" % query.fql)
+    url = get_url(query.fql, access_token)
+    if result_cache is None:
+        return query.result(get_fql(url, deadline))
+        
+    # a token that has been rejected mustn't be answered from what its user's other tokens fetched
+    check_token(url)
+    o = result_cache.get(resultcache.identity(access_token), resultcache.normalize_query(query.fql),
+                         lambda: get_fql(url, deadline), _cacheable_error, resultcache.token_identity(access_token))
+    return query.result(o)
+
+def user_query(uid="me()", columns=None):
+    ''' query for get_user '''
+    
+    if not columns:
+        columns = USER_COLUMNS
+        
+    def parse(o):
+        # user json comes back as a list of length 1 containing the user's info
+        if len(o) != 1:
+            raise FQLException("Weird user response: %s" % o)
+        return o[0]
+    
+    return Query("SELECT %s FROM user WHERE uid = %s" % (", ".join(columns), uid), parse)
+
+def friend_app_user_list_query(uid="me()"):
+    ''' query for get_friend_app_user_list '''
+    
+    friend_query = "SELECT uid1 FROM friend WHERE uid2 = %s" % str(uid)
+    get_app_user_query = "SELECT uid from user where is_app_user=1 and uid in (%s)" % (friend_query)
+    
+    def parse(o):
+        # list of dictionary objects containly only 'uid' as a key for each uid
+        logger.debug(o)
+        uids = [ d["uid"] for d in o]
+        logger.debug(uids)
+        return uids
+        
+    return Query(get_app_user_query, parse)
+
+def friend_uid_list_query(uid="me()"):
+    ''' query for get_friend_uid_list '''
+    
+    get_list_query = "SELECT uid1 from friend where uid2 = %s" % str(uid)
+    
+    def parse(o):
+        # list of dictionary objects containly only 'uid1' as a key for each uid
+        logger.debug(o)
+        uids = [ d["uid1"] for d in o]
+        logger.debug(uids)
+        return uids
+    
+    return Query(get_list_query, parse)
+    
+# filter people who are married or in a relationship
+FRIENDS_FILTER = " and relationship_status != 'In a relationship' and relationship_status != 'Married'"
+
+def friends_query():
+    ''' query for get_friends '''
+    
     get_friends_query = "SELECT uid1 FROM friend WHERE uid2 = me()" # get all of current users's friends
     
     query = "SELECT %s from user" % USER_COLUMN_CLAUSE
     query += " where uid in (%s)" % get_friends_query
+    query += FRIENDS_FILTER
     
-    # filter people who are married or in a relationship
-    query += " and relationship_status != 'In a relationship'"
-    query += " and relationship_status != 'Married'"
+    return Query(query)
     
-    query = urllib.quote(query)
-
-    url = FQL_BASE_URL
-    url += "&access_token=%s" % access_token
-    url += "&query=%s" % query
+def friends_chunk_query(uids):
+    ''' query for one chunk of get_friends with a friends_planner: friends_query for just these uids '''
     
-    o = get_fql(url)
-
-    logger.debug("Got friends: %s" % o)
-    return o
+    query = "SELECT %s from user" % USER_COLUMN_CLAUSE
+    query += " where uid in (%s)" % ", ".join([str(uid) for uid in uids])
+    query += FRIENDS_FILTER
     
-def find_friends_by_name(access_token, name_query):
-    ''' search friends to find those who match the given name substring '''
+    return Query(query)
+    
+FIND_FRIENDS_COLUMN_CLAUSE = "uid, first_name, last_name, name, pic_square, pic_small, pic, pic_big"
+
+def find_friends_by_name_query(name_query, limit=None):
+    ''' query for find_friends_by_name '''
     
     get_friends_query = "SELECT uid1 FROM friend WHERE uid2 = me()" # get all of current users's friends
 
-    query = "SELECT uid, first_name, last_name, name, pic_square, pic_small, pic, pic_big FROM user WHERE uid in (%s) and strpos(lower(name), \"%s\") >= 0" % (get_friends_query, name_query)
+    query = "SELECT %s FROM user WHERE uid in (%s) and strpos(lower(name), \"%s\") >= 0" % (FIND_FRIENDS_COLUMN_CLAUSE, get_friends_query, name_query)
+    if limit:
+        query += " LIMIT %d" % limit
     
-    query = urllib.quote(query)
+    return Query(query)
     
-    url = FQL_BASE_URL
+def friend_names_query():
+    ''' query for index_friends: what find_friends_by_name returns, for every friend '''
+    
+    get_friends_query = "SELECT uid1 FROM friend WHERE uid2 = me()"
+    
+    return Query("SELECT %s FROM user WHERE uid in (%s)" % (FIND_FRIENDS_COLUMN_CLAUSE, get_friends_query))
+    
+    
+def multiquery(queries, access_token):
+    ''' Run several named FQL queries in a single request.  Later queries can use the results of earlier ones by 
+        name, e.g. "SELECT name FROM user WHERE uid IN (SELECT uid1 FROM #friends)".  See:
+        http://developers.facebook.com/docs/reference/rest/fql.multiquery/
+        
+        queries - dictionary of name -> query string or Query (e.g. from user_query(), friend_uid_list_query()...)
+        
+        Returns a dictionary of name -> result.  Results of Query objects are parsed the same way as their helper's.
+        get_fql's error handling applies to the response as a whole and to each result.
+    '''
+    
+    queries = dict(queries)
+    for (name, query) in queries.items():
+        if not isinstance(query, Query):
+            queries[name] = Query(query)
+            
+    encoded = json.dumps(dict([(name, query.fql) for (name, query) in queries.items()]))
+    
+    url = FQL_MULTIQUERY_URL
     url += "&access_token=%s" % access_token
-    url += "&query=%s" % query
+    url += "&queries=%s" % urllib.quote(encoded)
     
     o = get_fql(url)
-
-    logger.debug("Found matching friends: %s" % o)
-    return o
     
-    
\ No newline at end of file
+    results = {}
+    for result in o:
+        name = result["name"]
+        rows = result.get("fql_result_set")
+        check_fql_error(rows, url)
+        results[name] = queries[name].result(rows)
+        
+    missing = set(queries.keys()) - set(results.keys())
+    if missing:
+        raise FQLException("multiquery response is missing results for: %s" % ", ".join(missing))
+        
+    return results
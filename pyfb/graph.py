@@ -8,10 +8,27 @@ try:
 except ImportError:
     from django.utils import simplejson as json
 
+import re
+import sys
+import time
+import urllib
+
+import cache
+import instrument
+import jsonstream
 import net
+import ratelimit
+import records
+import resultcache
+import tokens
 
 FB_GRAPH_BASE_URL = "https://graph.facebook.com"
 
+MAX_BATCH_SIZE = 50     # graph api limit on the number of operations in one batch request
+
+GET_USERS_CHUNK_SIZE = 50       # get_users: max ids per request.  keeps urls short and responses quick.
+GET_USERS_MAX_CONCURRENCY = 4   # get_users: max chunk requests in flight at once
+
 USER_COLUMNS = [
     "id", 
     "first_name", 
@@ -33,6 +50,14 @@ USER_COLUMNS = [
 ]
 USER_COLUMN_CLAUSE = ",".join(USER_COLUMNS)
 
+# optional cache.ObjectCache for get_users, keyed by user id.  None disables caching.  Note cached fields are shared by
+# every access token, so only enable it if that's acceptable for your app.
+user_cache = None
+
+# optional resultcache.ResultCache for the single request reads (get_friends_list, get_users, get_wall_posts,
+# list_test_users), keyed by the url without its access token and the user behind the token.  None disables it.
+result_cache = None
+
 
 def authenticate_app(app_id, app_secret, redirect_url, code):
     ''' Authenticate app.  (last step of server-side flow authentication process) '''
@@ -42,7 +67,8 @@ def authenticate_app(app_id, app_secret, redirect_url, code):
     logger.info("autenticate_app: code='%s'" % code)    
     logger.info("authenticate_app: url=%s" % url)
     
-    s = net.get(url)
+    # the code can only be used once, so a retry would only get "code has been used" back
+    s = net.get(url, retries=False)
     logger.info("authenticate_app: Got '%s'" % s)
     
     # s is a string of the form:
@@ -56,6 +82,7 @@ def authenticate_app(app_id, app_secret, redirect_url, code):
     expires = etok.split("=")[1]
     
     # expires == number of seconds until token expires.
+    tokens.manager.add_user_token(access_token, expires=int(time.time()) + int(expires))
     return (access_token, expires)
 
 
@@ -73,7 +100,7 @@ def create_test_user(app_id, app_access_token, installed=True, permissions=[]):
     else:
         istr = "false"
         # permissions are only valid if installed is true
-        permissions = None
+        permissions = []
         
     permissions = ",".join(permissions)
 
@@ -97,9 +124,9 @@ def delete_test_user(uid, access_token):
     ''' Delete the test user '''
     
     url = FB_GRAPH_BASE_URL
-    url += "/%s?method=delete&access_token=%s" % (uid, access_token)
+    url += "/%s?access_token=%s" % (uid, access_token)
     
-    s = net.get(url)
+    s = net.delete(url)
     
     if s:
         if s == 'true':
@@ -117,9 +144,15 @@ def get_application_access_token(app_id, app_secret):
     ''' Get an application access token, as described here:
         http://developers.facebook.com/docs/authentication/#authenticating-as-an-application 
         
-        Some graph API calls require one of thse.  
+        Some graph API calls require one of thse.  Tokens are cached and refreshed by tokens.manager, so this only
+        goes to facebook the first time (or when the token has been rejected).
     '''
+    
+    return tokens.manager.get_app_token(app_id, app_secret, fetch_application_access_token)
         
+def fetch_application_access_token(app_id, app_secret):
+    ''' Request a new application access token from facebook, bypassing the token cache '''
+    
     url = FB_GRAPH_BASE_URL
     url += "/oauth/access_token?"
     url += "client_id=%s" % app_id
@@ -140,105 +173,322 @@ def get_application_access_token(app_id, app_secret):
         
     else:
         logger.error("Failed to get application access token")
-        return none
+        return None
             
             
     
-def get_friends_list(user_id, access_token, fields=["id"], offset=0, limit=None):
+def get_friends_list(user_id, access_token, fields=["id"], offset=0, limit=None, deadline=None, compact=False):
     ''' Get list of the user's friends
     
         fields - list of fields to retrieve. e.g. (name, id)
+        deadline - seconds the request may take, retries included.  See net.get.
+        compact - return a records.Table instead of a list of dictionaries
     '''
     fields = ",".join(fields)
     
-    url = "FB_GRAPH_BASE_URL"
+    url = FB_GRAPH_BASE_URL
     url += "/%s/friends?access_token=%s&fields=%s" % (user_id, access_token, fields)
     if offset:
         url += "&offset=%d" % offset
     if limit:
         url += "&limit=%d" % limit
         
-    s = net.get(url)
+    o = _get_json(url, access_token, deadline)
 
-    if s:
-        o = json.loads(s)
+    if o:
+        if compact:
+            return records.Table.from_rows(o["data"], fields.split(","))
         return o["data"]    # data element contains a list of dictionary objects repesenting the friends
     else:
         return None
     
 
 
-def get_users(user_ids, access_token, fields=None, callback=None):
-    ''' Get info about a list of users 
+def iter_connection(url, prefetch=True, stream=False):
+    ''' Generator over the items of a paged graph api connection (e.g. friends, feed), starting at url and following
+        the paging.next links lazily.  Only one page is held at a time.
+    
+        prefetch - request page N+1 in the background while the caller works through page N.  If the caller stops
+                   early, at most that one extra page is fetched.
+        stream - decode each page item by item as it arrives instead of reading it whole, for pages big enough that
+                 holding one in memory is a problem.  No prefetch in that case, the next link comes after the data.
+    '''
     
-        callback - if specific, request will be done asynchronously and a handle to the rpc object will be returned
+    if stream:
+        for item in _iter_connection_stream(url):
+            yield item
+        return
+        
+    rpc = None
+    while url:
+        if rpc:
+            s = rpc.get_result()
+        else:
+            s = net.get(url)
+        
+        if not s:
+            return
+        o = instrument.loads(s, url)
+        
+        data = o.get("data", [])
+        url = None
+        if data:
+            # an empty page means we're at the end, even if it has a next link
+            url = o.get("paging", {}).get("next")
+            
+        rpc = None
+        if url and prefetch:
+            rpc = net.get_async(url)
+        
+        for item in data:
+            yield item
+            
+def _iter_connection_stream(url):
+    while url:
+        stream = net.get_stream(url)
+        page = jsonstream.ArrayStream(stream, "data")
+        
+        count = 0
+        try:
+            for item in page:
+                yield item
+                count += 1
+        finally:
+            # the caller may stop part way through a page
+            stream.close()
+            
+        if page.document is not None:
+            raise net.NetException("Unexpected graph api response: %s, url=%s" % (page.document, url))
+            
+        url = None
+        if count:
+            # an empty page means we're at the end, even if it has a next link
+            url = page.members.get("paging", {}).get("next")
+            
+def iter_friends(user_id, access_token, fields=["id"], limit=None, prefetch=True):
+    ''' Iterate over all of the user's friends, a page at a time.  See get_friends_list and iter_connection.
+    
+        limit - page size
     '''
     
-    user_ids = ",".join(user_ids)
+    url = FB_GRAPH_BASE_URL
+    url += "/%s/friends?access_token=%s&fields=%s" % (user_id, access_token, ",".join(fields))
+    if limit:
+        url += "&limit=%d" % limit
+    return iter_connection(url, prefetch)
     
-    if fields:
-        fields = ",".join(fields)
-    else:
-        fields = USER_COLUMN_CLAUSE
+def iter_wall_posts(user_id, access_token, limit=None, prefetch=True, stream=False, since=None, until=None):
+    ''' Iterate over the posts on a user's wall, newest first.  See get_wall_posts and iter_connection.
+    
+        limit - page size
+        stream - decode the pages as they arrive, see iter_connection
+        since, until - only posts created from / up to these unix times.  See feedsync for keeping up with a feed.
+    '''
+    
+    return iter_connection(_wall_posts_url(user_id, access_token, limit, since, until), prefetch, stream)
+    
+def _wall_posts_url(user_id, access_token, limit=None, since=None, until=None):
+    url = FB_GRAPH_BASE_URL
+    url += "/%s/feed?access_token=%s" % (user_id, access_token)
+    if limit:
+        url += "&limit=%d" % limit
+    if since is not None:
+        url += "&since=%d" % since
+    if until is not None:
+        url += "&until=%d" % until
+    return url
+    
+def iter_test_users(app_id, app_access_token, prefetch=True):
+    ''' Iterate over all of the application's test users.  See list_test_users and iter_connection. '''
+    
+    url = FB_GRAPH_BASE_URL
+    url += "/%s/accounts/test-users" % app_id
+    url += "?access_token=%s" % app_access_token
+    return iter_connection(url, prefetch)
     
-    url = "FB_GRAPH_BASE_URL"
-    url += "/?ids=%s&access_token=%s&fields=%s" % (user_ids, access_token, fields)
 
-    logger.debug("get_users: url=%s" % url)
+def get_users(user_ids, access_token, fields=None, callback=None, chunk_size=None, max_concurrency=None, compact=False):
+    ''' Get info about a list of users 
     
-    def result_callback(result):
-        if result:
-            o = json.loads(result)
-            return callback(o)
-        else:
+        callback - if specific, request will be done asynchronously and a handle to the rpc object will be returned
+                   (always goes to the network, user_cache is only used by blocking calls)
+        chunk_size - max number of ids per request (default GET_USERS_CHUNK_SIZE).  Longer lists are split into 
+                     several requests which are fetched concurrently and merged.
+        max_concurrency - max number of chunk requests in flight (default GET_USERS_MAX_CONCURRENCY)
+        compact - the users are records (see records.record_class) with a slot per field instead of dictionaries
+    '''
+    
+    urls = _get_users_urls(user_ids, access_token, fields, chunk_size)
+
+    def result_callback(results):
+        if len(results) == 1 and not results[0]:
             return callback(None)
+            
+        users = {}
+        for (url, result) in zip(urls, results):
+            if result:
+                users.update(instrument.loads(result, url))
+        if compact:
+            users = _compact_users(users, fields)
+        return callback(users)
 
     if callback:
         # async
-        rpc = net.get_async(url, result_callback)
-        return rpc
+        return net.get_many_async(urls, max_concurrency or GET_USERS_MAX_CONCURRENCY, result_callback)
+        
+    elif user_cache is not None:
+        # blocking, only fetch what isn't cached
+        users = _get_users_cached(user_ids, access_token, fields, chunk_size, max_concurrency)
+    
     else:
-        # blocking
-        s = net.get(url)
+        users = _get_users(urls, user_ids, access_token, fields, chunk_size, max_concurrency)
+        
+    if compact:
+        return _compact_users(users, fields)
+    return users
+    
+def _compact_users(users, fields):
+    # id always comes back, asked for or not
+    columns = list(fields or USER_COLUMNS)
+    if "id" not in columns:
+        columns.insert(0, "id")
+    return records.compact_dict(users, columns)
+        
+def _get_users(urls, user_ids, access_token, fields, chunk_size, max_concurrency):
+    ''' blocking part of get_users '''
     
-        if s:
-            o = json.loads(s)
-            return o
-        else:
+    if len(urls) == 1:
+        return _get_json(urls[0], access_token)
+            
+    else:
+        # chunks fetched concurrently
+        users = {}
+        for o in iter_users(user_ids, access_token, fields, chunk_size, max_concurrency):
+            users.update(o)
+        return users
+        
+def _get_users_cached(user_ids, access_token, fields, chunk_size, max_concurrency):
+    ''' get_users through user_cache.  Only the ids and fields that aren't cached are fetched, grouped so that each 
+        distinct set of missing fields is one get_users request. '''
+    
+    fields = list(fields or USER_COLUMNS)
+    (users, missing) = user_cache.lookup(user_ids, fields)
+    
+    for (missing_fields, ids) in cache.group_missing(missing):
+        missing_fields = list(missing_fields)
+        urls = _get_users_urls(ids, access_token, missing_fields, chunk_size)
+        o = _get_users(urls, ids, access_token, missing_fields, chunk_size, max_concurrency)
+        if o is None:
             return None
+            
+        for (uid, user) in o.items():
+            user_cache.put(uid, user, missing_fields)
+            users.setdefault(uid, {}).update(user)
+            
+    for (uid, user) in users.items():
+        user.setdefault("id", uid)
+    return users
+        
+def iter_users(user_ids, access_token, fields=None, chunk_size=None, max_concurrency=None):
+    ''' Streaming version of get_users.  Generator that yields a dictionary of users (keyed by id, same as get_users)
+        for each chunk of user_ids as soon as that chunk's request finishes.  Raises the error of the first chunk 
+        that fails. '''
+    
+    if max_concurrency is None:
+        max_concurrency = GET_USERS_MAX_CONCURRENCY
+        
+    urls = _get_users_urls(user_ids, access_token, fields, chunk_size)
+    for (i, result) in net.iter_get_many(urls, max_concurrency):
+        if isinstance(result, Exception):
+            raise result
+        if result:
+            yield instrument.loads(result, urls[i])
+        
+def _get_users_urls(user_ids, access_token, fields, chunk_size):
+    ''' request urls for get_users, one per chunk of at most chunk_size ids '''
+    
+    if not chunk_size:
+        chunk_size = GET_USERS_CHUNK_SIZE
+    
+    if fields:
+        fields = ",".join(fields)
+    else:
+        fields = USER_COLUMN_CLAUSE
+        
+    user_ids = list(user_ids)
+    urls = []
+    for i in range(0, max(len(user_ids), 1), chunk_size):
+        url = FB_GRAPH_BASE_URL
+        url += "/?ids=%s&access_token=%s&fields=%s" % (",".join(user_ids[i:i+chunk_size]), access_token, fields)
+        logger.debug("get_users: url=%s" % url)
+        urls.append(url)
+        
+    return urls
         
         
 
-def get_wall_posts(user_id, access_token):
+def get_many(object_ids, access_token, fields=None, max_concurrency=net.DEFAULT_MAX_CONCURRENCY, deadline=None):
+    ''' Get several graph objects (or connections, e.g. "me/friends") concurrently.
+    
+        fields - list of fields to retrieve for every object, or None for the defaults
+        max_concurrency - max number of requests in flight
+        deadline - overall time limit in seconds
+        
+        Returns a list in the same order as object_ids.  Each entry is either the decoded object or the exception that
+        fetching it raised.
+    '''
+    
+    urls = []
+    for object_id in object_ids:
+        url = FB_GRAPH_BASE_URL
+        url += "/%s?access_token=%s" % (object_id, access_token)
+        if fields:
+            url += "&fields=%s" % ",".join(fields)
+        urls.append(url)
+        
+    results = net.get_many(urls, max_concurrency, deadline)
+    
+    objects = []
+    for (url, r) in zip(urls, results):
+        if not isinstance(r, Exception):
+            try:
+                r = instrument.loads(r, url)
+            except ValueError, e:
+                r = e
+        objects.append(r)
+        
+    return objects
+
+def get_wall_posts(user_id, access_token, deadline=None, limit=None, since=None, until=None):
     ''' requires read_stream to get non-public posts 
     
         Should return a json dictionary containing:
             data - list of posts (maybe up to 50)
             paging - links to get more "pages" of posts
+            
+        deadline - seconds the request may take, retries included.  See net.get.
+        limit - page size
+        since, until - only posts created from / up to these unix times.  feedsync.FeedSync uses them to fetch only
+                       the posts it hasn't seen.
     '''
     
-    url = "FB_GRAPH_BASE_URL"
-    url += "/%s/feed?access_token=%s" % (user_id, access_token)
-    s = net.get(url)
-    logger.info("Got user's posts: %s" % s)
-    if s:
-        o = json.loads(s)
-        return o
-    else:
-        return None
+    url = _wall_posts_url(user_id, access_token, limit, since, until)
+    o = _get_json(url, access_token, deadline)
+    if o:
+        logger.debug("Got %d of user's posts" % len(o.get("data", [])))
+    return o
         
 def list_test_users(app_id, app_access_token):
     ''' List test users associated with this application '''
     
-    url = "FB_GRAPH_BASE_URL"
+    url = FB_GRAPH_BASE_URL
     url += "/%s/accounts/test-users" % app_id
     url += "?access_token=%s" % app_access_token
         
-    s = net.get(url)
+    o = _get_json(url, app_access_token)
     
-    if s:
-        logger.debug("List test users, response: '%s'" % s)
-        o = json.loads(s)
+    if o:
+        logger.debug("List test users, response: '%s'" % o)
         users = o["data"]
         return users
         
@@ -247,11 +497,26 @@ def list_test_users(app_id, app_access_token):
         return None
 
 
+def _get_json(url, access_token, deadline=None):
+    ''' net.get_json through result_cache, if it is set '''
+    
+    if result_cache is None:
+        return net.get_json(url, deadline)
+    return result_cache.get(resultcache.identity(access_token), resultcache.normalize_url(url),
+                            lambda: net.get_json(url, deadline), _cacheable_error,
+                            resultcache.token_identity(access_token))
+    
+def _cacheable_error(e):
+    # graph api errors (bad token, missing object, no permission) come back as 4xx and will again, except throttling
+    if not isinstance(e, net.NetException) or e.status not in (400, 401, 403, 404):
+        return False
+    return instrument.error_code(e.content) not in ratelimit.THROTTLE_CODES
+    
 def make_test_friends(uid1, user1_access_token, uid2, user2_access_token):
     ''' Make two test users friends. '''
     
     # create friend request from u1 to u2
-    url = "FB_GRAPH_BASE_URL"
+    url = FB_GRAPH_BASE_URL
     url += "/%s/friends/%s" % (uid1, uid2)
     url += "?access_token=%s" % user1_access_token
     
@@ -265,7 +530,7 @@ def make_test_friends(uid1, user1_access_token, uid2, user2_access_token):
     
     
     # confirm friend request to u2
-    url = "FB_GRAPH_BASE_URL"
+    url = FB_GRAPH_BASE_URL
     url += "/%s/friends/%s" % (uid2, uid1)
     url += "?access_token=%s" % user2_access_token
     
@@ -342,3 +607,255 @@ def post_to_wall(access_token, user_id, message, link=None, name=None, descripti
     else:
         logger.error("post_to_wall: failed to post to url: %s" % url)
         return None
+        
+        
+class BatchOperation(object):
+    ''' One operation queued in a Batch.  Once the batch has been executed, status, headers (a dictionary) and body hold
+        the operation's own response.  status is None if facebook didn't return a response for it, e.g. because an
+        operation it depended on failed.  error is the exception the batch request carrying it failed with, or its
+        callback raised, if either did.
+    '''
+    
+    def __init__(self, method, relative_url, body=None, name=None, depends_on=None, callback=None):
+        self.method = method
+        self.relative_url = relative_url
+        self.request_body = body
+        self.name = name
+        self.depends_on = depends_on
+        self.callback = callback
+        
+        self.status = None
+        self.headers = None
+        self.body = None
+        self.error = None
+        
+    def to_dict(self):
+        ''' graph batch api representation of the operation '''
+        
+        d = {
+            "method" : self.method,
+            "relative_url" : self.relative_url,
+        }
+        if self.request_body:
+            d["body"] = urllib.urlencode(self.request_body)
+        if self.name:
+            d["name"] = self.name
+        if self.depends_on:
+            d["depends_on"] = self.depends_on
+        return d
+        
+    def references(self):
+        ''' names of the operations this one depends on, explicitly or through {result=name:$.jsonpath} references '''
+        
+        text = self.relative_url
+        if self.request_body:
+            text += " " + " ".join([str(v) for v in self.request_body.values()])
+        
+        names = set(_BATCH_REFERENCE.findall(text))
+        if self.depends_on:
+            names.add(self.depends_on)
+        return names
+        
+    def get_result(self):
+        ''' decoded response body.  Raises net.NetException if the operation failed or got no response, or the error
+            its batch request failed with. '''
+        
+        if self.error is not None:
+            raise self.error
+        if self.status is None:
+            raise net.NetException("No response for batch operation %s %s" % (self.method, self.relative_url))
+        if self.status != 200:
+            raise net.NetException("Batch operation %s %s failed.  HTTP status code was %d" % (self.method, self.relative_url, self.status), 
+                                   self.status, self.body)
+        return json.loads(self.body)
+
+# matches the operation name in a JSONPath reference to another operation's result, e.g. {result=friends:$.data.*.id}
+_BATCH_REFERENCE = re.compile(r"\{result=([^:}]+):")
+    
+class Batch(object):
+    ''' Queue up graph api operations and send them as batch requests instead of one round trip each.  See:
+        http://developers.facebook.com/docs/reference/api/batch/
+        
+        Operations are split into batches of at most MAX_BATCH_SIZE.  Operations that reference each other by name 
+        (via depends_on or {result=name:$.jsonpath} in the url or body) are always kept in the same batch, since
+        facebook only resolves references within a single batch request.  Batches are sent concurrently.
+        
+        e.g.
+            batch = graph.Batch(access_token)
+            friends = batch.get_friends_list("me", limit=5, name="friends")
+            users = batch.get("?ids={result=friends:$.data.*.id}")
+            batch.execute()
+            users.get_result()
+    '''
+    
+    def __init__(self, access_token):
+        self.access_token = access_token
+        self.operations = []
+        
+    def add(self, method, relative_url, body=None, name=None, depends_on=None, callback=None):
+        ''' Queue an operation.  Returns its BatchOperation.
+        
+            relative_url - graph api path relative to FB_GRAPH_BASE_URL, without the leading /
+            body - dictionary of POST parameters
+            name - name other operations can reference this one's result by
+            depends_on - name of an operation that must complete before this one
+            callback - called with the decoded response body when the batch is executed, if the operation succeeded
+        '''
+        
+        op = BatchOperation(method, relative_url, body, name, depends_on, callback)
+        self.operations.append(op)
+        return op
+        
+    def get(self, relative_url, **kwargs):
+        return self.add("GET", relative_url, **kwargs)
+        
+    def post(self, relative_url, data=None, **kwargs):
+        return self.add("POST", relative_url, body=data, **kwargs)
+        
+    def delete(self, relative_url, **kwargs):
+        return self.add("DELETE", relative_url, **kwargs)
+
+    def get_users(self, user_ids, fields=None, **kwargs):
+        ''' queued version of get_users '''
+        
+        if fields:
+            fields = ",".join(fields)
+        else:
+            fields = USER_COLUMN_CLAUSE
+        return self.get("?ids=%s&fields=%s" % (",".join(user_ids), fields), **kwargs)
+        
+    def get_friends_list(self, user_id, fields=["id"], offset=0, limit=None, **kwargs):
+        ''' queued version of get_friends_list.  The result is the full response, the friends are in its "data" element. '''
+        
+        relative_url = "%s/friends?fields=%s" % (user_id, ",".join(fields))
+        if offset:
+            relative_url += "&offset=%d" % offset
+        if limit:
+            relative_url += "&limit=%d" % limit
+        return self.get(relative_url, **kwargs)
+        
+    def get_wall_posts(self, user_id, **kwargs):
+        ''' queued version of get_wall_posts '''
+        return self.get("%s/feed" % user_id, **kwargs)
+        
+    def list_test_users(self, app_id, **kwargs):
+        ''' queued version of list_test_users.  The users are in the "data" element of the result. '''
+        return self.get("%s/accounts/test-users" % app_id, **kwargs)
+        
+    def delete_test_user(self, uid, **kwargs):
+        ''' queued version of delete_test_user '''
+        return self.delete(str(uid), **kwargs)
+        
+    def post_to_wall(self, user_id, message, fields=None, **kwargs):
+        ''' queued version of post_to_wall.  No wall filtering is done here.
+        
+            fields - dictionary of other post fields, e.g. link, name, description, caption, picture, source
+        '''
+        
+        data = {"message" : message}
+        if fields:
+            data.update(fields)
+        return self.post("%s/feed" % user_id, data, **kwargs)
+        
+    def execute(self):
+        ''' Send all queued operations and fill in their responses.  Returns the list of operations.
+        
+            If a batch request fails, its operations get the error (see BatchOperation.error) and the other batches are
+            still filled in.  So does an operation whose callback raises, and the remaining callbacks still run.  Then
+            the first such error is raised.
+        '''
+        
+        operations = self.operations
+        self.operations = []
+        
+        chunks = self._split(operations)
+        rpcs = []
+        for chunk in chunks:
+            data = {
+                "access_token" : self.access_token,
+                "batch" : json.dumps([op.to_dict() for op in chunk]),
+            }
+            rpcs.append(net.post_async(FB_GRAPH_BASE_URL, data))
+            
+        failure = None
+        for (chunk, rpc) in zip(chunks, rpcs):
+            try:
+                responses = instrument.loads(rpc.get_result(), FB_GRAPH_BASE_URL)
+            except Exception, e:
+                logger.warning("Batch: request with %d operations failed: %s" % (len(chunk), e))
+                for op in chunk:
+                    op.error = e
+                if failure is None:
+                    failure = sys.exc_info()
+                continue
+                
+            logger.debug("Batch: %d operations, %d responses" % (len(chunk), len(responses)))
+            
+            for (op, response) in zip(chunk, responses):
+                if response is None:
+                    continue
+                op.status = response.get("code")
+                op.headers = dict([(h["name"], h["value"]) for h in response.get("headers", [])])
+                op.body = response.get("body")
+                
+            for op in chunk:
+                if op.callback and op.status == 200:
+                    try:
+                        op.callback(op.get_result())
+                    except Exception, e:
+                        logger.warning("Batch: callback of %s %s failed: %s" % (op.method, op.relative_url, e))
+                        op.error = e
+                        if failure is None:
+                            failure = sys.exc_info()
+                
+        if failure is not None:
+            (t, v, tb) = failure
+            raise t, v, tb
+        return operations
+        
+    def _split(self, operations):
+        ''' Split operations into batches of at most MAX_BATCH_SIZE, keeping groups of operations that reference each
+            other together.  Order is preserved within each batch. '''
+        
+        # union the operations that are linked by name into groups
+        group_of = range(len(operations))
+        def find(i):
+            while group_of[i] != i:
+                group_of[i] = group_of[group_of[i]]
+                i = group_of[i]
+            return i
+            
+        by_name = {}
+        for (i, op) in enumerate(operations):
+            if op.name:
+                by_name[op.name] = i
+        for (i, op) in enumerate(operations):
+            for name in op.references():
+                if name not in by_name:
+                    raise ValueError("Batch operation %s %s references unknown operation '%s'" % (op.method, op.relative_url, name))
+                group_of[find(i)] = find(by_name[name])
+        
+        groups = {}
+        order = []
+        for i in range(len(operations)):
+            root = find(i)
+            if root not in groups:
+                groups[root] = []
+                order.append(root)
+            groups[root].append(i)
+            
+        # pack the groups into batches
+        chunks = []
+        current = []
+        for root in order:
+            group = groups[root]
+            if len(group) > MAX_BATCH_SIZE:
+                raise ValueError("%d batch operations depend on each other, the limit for one batch is %d" % (len(group), MAX_BATCH_SIZE))
+            if len(current) + len(group) > MAX_BATCH_SIZE:
+                chunks.append(current)
+                current = []
+            current.extend(group)
+        if current:
+            chunks.append(current)
+            
+        return [[operations[i] for i in sorted(chunk)] for chunk in chunks]
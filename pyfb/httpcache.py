@@ -0,0 +1,177 @@
+''' Conditional request (ETag / Last-Modified) cache for graph api responses.
+
+    Profiles and friend lists rarely change between polls.  HTTPCache keeps the response body and the object decoded
+    from it, so a response can be revalidated with If-None-Match / If-Modified-Since and a 304 answered with the
+    already decoded object instead of downloading and parsing it again.
+'''
+
+import collections
+import logging
+logger = logging.getLogger("pyfb")
+import re
+import threading
+import time
+import urlparse
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024    # approximate memory cap
+DEFAULT_MAX_AGE = 0                     # seconds a response is served without revalidating.  0 always revalidates.
+
+ENTRY_OVERHEAD = 300    # rough per-entry bookkeeping cost in bytes, on top of the body
+
+
+class Entry(object):
+    ''' A cached response '''
+
+    __slots__ = ("body", "parsed", "etag", "last_modified", "stored_at", "max_age", "size")
+
+    def __init__(self, body, parsed, etag, last_modified, max_age):
+        self.body = body
+        self.parsed = parsed
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = time.time()
+        self.max_age = max_age
+
+        # the decoded object is usually a few times the size of the body
+        self.size = ENTRY_OVERHEAD + 3 * len(body)
+
+    def is_fresh(self):
+        return time.time() - self.stored_at < self.max_age
+
+
+class HTTPCache(object):
+    ''' Thread safe, size bounded LRU cache of responses keyed by url.
+
+        max_bytes - approximate memory cap
+        default_max_age - seconds a response is used without revalidating, for urls no policy matches
+        policies - list of (regular expression, max_age) pairs checked in order against the url path, e.g.
+                   [(r"/friends$", 300), (r"/feed$", 0)].  The first match decides how long a response stays fresh.
+
+        Objects handed back from the cache are shared between callers, so treat them as read only.
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, default_max_age=DEFAULT_MAX_AGE, policies=None):
+        self.max_bytes = max_bytes
+        self.default_max_age = default_max_age
+        self.policies = [(re.compile(pattern), max_age) for (pattern, max_age) in (policies or [])]
+
+        self._entries = collections.OrderedDict()   # url -> Entry, least recently used first
+        self.size = 0
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0           # served fresh without a request
+        self.revalidated = 0    # 304 not modified
+        self.misses = 0         # full responses downloaded
+        self.evictions = 0
+
+    def max_age(self, url):
+        ''' freshness lifetime for url according to the policies '''
+
+        path = urlparse.urlsplit(url).path
+        for (pattern, max_age) in self.policies:
+            if pattern.search(path):
+                return max_age
+        return self.default_max_age
+
+    def lookup(self, url):
+        ''' Cached Entry for url or None '''
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self._entries[url] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def conditional_headers(self, entry):
+        ''' request headers to revalidate a cached entry '''
+
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def hit(self, entry):
+        ''' record that a fresh entry was used '''
+        self._count("hits")
+
+    def not_modified(self, url, entry, headers):
+        ''' The server said entry is still good (304).  Restart its freshness lifetime. '''
+
+        entry.stored_at = time.time()
+        entry.etag = headers.get("etag", entry.etag)
+        entry.last_modified = headers.get("last-modified", entry.last_modified)
+        self._count("revalidated")
+
+    def store(self, url, headers, body, parsed):
+        ''' Remember a full 200 response.  Only kept if it can be revalidated or is allowed to be served fresh. '''
+
+        self._count("misses")
+
+        etag = headers.get("etag")
+        last_modified = headers.get("last-modified")
+        max_age = self.max_age(url)
+        if not (etag or last_modified or max_age):
+            return
+
+        entry = Entry(body, parsed, etag, last_modified, max_age)
+        if entry.size > self.max_bytes:
+            return
+
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self.size -= old.size
+            self._entries[url] = entry
+            self.size += entry.size
+
+            while self.size > self.max_bytes:
+                (oldest_url, oldest) = self._entries.popitem(last=False)
+                self.size -= oldest.size
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, url):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self.size -= entry.size
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "hits" : self.hits,
+                "revalidated" : self.revalidated,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "entries" : len(self._entries),
+                "bytes" : self.size,
+            }
+        finally:
+            self._lock.release()
+
+    def _count(self, counter):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
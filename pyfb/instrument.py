@@ -0,0 +1,260 @@
+''' Latency histograms, counters and hooks for the hot paths in pyfb.
+
+    Off by default.  Set pyfb.instrument.enabled = True to start recording.  While it's off every hook in net, pool,
+    graph, fql and auth is a single check of that flag, so leaving the calls in costs next to nothing.
+
+    Measurements go to the in-process registry and to any observers added with add_observer.  Everything is labelled
+    with an endpoint, the url's host and path with ids replaced by {id}, e.g. "graph.facebook.com/{id}/friends".
+
+    Metrics recorded:
+        http.connect          seconds to open a new connection (pooled requests only)
+        http.first_byte       seconds from sending the request to having the response headers
+        http.total            seconds from sending the request to having read the whole body
+        http.response_bytes   size of the (decompressed) response body
+        http.status           counter of non-200 responses, labelled "<endpoint> <status>"
+        json.decode           seconds spent decoding responses
+        fql.total             seconds for get_fql, request and decoding
+        fb.errors             counter of error codes facebook sent back, labelled with the code
+        auth.verify           seconds to verify a signed request, labelled "cached" or "verified"
+'''
+
+import bisect
+import logging
+logger = logging.getLogger("pyfb")
+import re
+import threading
+import time
+import urlparse
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+# set to True to record measurements
+enabled = False
+
+# histogram bucket upper bounds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)    # seconds
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)                 # bytes
+
+# bucket bounds for metrics that aren't measured in seconds
+METRIC_BUCKETS = {
+    "http.response_bytes" : SIZE_BUCKETS,
+}
+
+_ID_SEGMENT = re.compile(r"^[0-9_]+$")
+
+
+class Histogram(object):
+    ''' Fixed bucket histogram.  Not thread safe on its own, the Registry locks around it. '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # the last one counts values above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        ''' estimate of the p'th percentile (0-100), interpolating linearly within the bucket it falls in '''
+
+        if not self.count:
+            return None
+
+        rank = self.count * p / 100.0
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets):
+                    return self.max
+                lower = i and self.buckets[i - 1] or 0
+                upper = self.buckets[i]
+                value = lower + (upper - lower) * (rank - seen) / n
+                return min(max(value, self.min), self.max)
+            seen += n
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count" : self.count,
+            "sum" : self.sum,
+            "min" : self.min,
+            "max" : self.max,
+            "mean" : self.count and self.sum / self.count or None,
+            "p50" : self.percentile(50),
+            "p90" : self.percentile(90),
+            "p99" : self.percentile(99),
+            "buckets" : zip(self.buckets + (None,), self.counts),
+        }
+
+
+class Registry(object):
+    ''' Thread safe collection of histograms and counters, keyed by (metric, label) '''
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric, label, value):
+        key = (metric, label)
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(METRIC_BUCKETS.get(metric, LATENCY_BUCKETS))
+            histogram.observe(value)
+        finally:
+            self._lock.release()
+
+    def count(self, metric, label, n=1):
+        key = (metric, label)
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + n
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        ''' Returns {"histograms" : {metric : {label : histogram snapshot}}, "counters" : {metric : {label : n}}} '''
+
+        self._lock.acquire()
+        try:
+            histograms = {}
+            for ((metric, label), histogram) in self._histograms.items():
+                histograms.setdefault(metric, {})[label] = histogram.snapshot()
+
+            counters = {}
+            for ((metric, label), n) in self._counters.items():
+                counters.setdefault(metric, {})[label] = n
+        finally:
+            self._lock.release()
+
+        return {"histograms" : histograms, "counters" : counters}
+
+    def render_text(self):
+        ''' The registry in the prometheus text exposition format, for scraping '''
+
+        snapshot = self.snapshot()
+        lines = []
+
+        for (metric, labels) in sorted(snapshot["histograms"].items()):
+            name = _metric_name(metric)
+            lines.append("# TYPE %s histogram" % name)
+            for (label, h) in sorted(labels.items()):
+                cumulative = 0
+                for (bound, n) in h["buckets"]:
+                    cumulative += n
+                    le = bound is None and "+Inf" or repr(bound)
+                    lines.append('%s_bucket{label="%s",le="%s"} %d' % (name, _escape(label), le, cumulative))
+                lines.append('%s_sum{label="%s"} %r' % (name, _escape(label), h["sum"]))
+                lines.append('%s_count{label="%s"} %d' % (name, _escape(label), h["count"]))
+
+        for (metric, labels) in sorted(snapshot["counters"].items()):
+            name = _metric_name(metric)
+            lines.append("# TYPE %s counter" % name)
+            for (label, n) in sorted(labels.items()):
+                lines.append('%s{label="%s"} %d' % (name, _escape(label), n))
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._histograms.clear()
+            self._counters.clear()
+        finally:
+            self._lock.release()
+
+
+# default registry everything is recorded in
+registry = Registry()
+
+_observers = []
+
+def add_observer(observer):
+    ''' Call observer(kind, metric, label, value) for every measurement, kind being "observe" for histogram values
+        and "count" for counter increments.  Observers are called on the thread doing the request, so they should be
+        quick, e.g. hand the value to statsd. '''
+
+    _observers.append(observer)
+
+def remove_observer(observer):
+    _observers.remove(observer)
+
+def observe(metric, label, value):
+    ''' record a histogram value '''
+
+    registry.observe(metric, label, value)
+    _notify("observe", metric, label, value)
+
+def count(metric, label, n=1):
+    ''' increment a counter '''
+
+    registry.count(metric, label, n)
+    _notify("count", metric, label, n)
+
+def snapshot():
+    return registry.snapshot()
+
+def render_text():
+    return registry.render_text()
+
+def reset():
+    registry.reset()
+
+def endpoint(url):
+    ''' label for a url: host and path with numeric ids replaced, no query string '''
+
+    parts = urlparse.urlsplit(url)
+    segments = [_ID_SEGMENT.match(s) and "{id}" or s for s in parts.path.split("/")]
+    return (parts.hostname or "") + "/".join(segments)
+
+def loads(s, url):
+    ''' json.loads that records the decode time against url's endpoint '''
+
+    if not enabled:
+        return json.loads(s)
+
+    start = time.time()
+    o = json.loads(s)
+    observe("json.decode", endpoint(url), time.time() - start)
+    return o
+
+def error_code(content):
+    ''' facebook's error code in an error response body, or None '''
+
+    try:
+        o = json.loads(content)
+    except (TypeError, ValueError):
+        return None
+
+    if isinstance(o, dict):
+        if isinstance(o.get("error"), dict):
+            return o["error"].get("code")
+        return o.get("error_code")
+    return None
+
+def _notify(kind, metric, label, value):
+    for observer in list(_observers):
+        try:
+            observer(kind, metric, label, value)
+        except Exception:
+            logger.exception("instrument: observer failed")
+
+def _metric_name(metric):
+    return "pyfb_" + re.sub(r"[^a-zA-Z0-9_]", "_", metric)
+
+def _escape(label):
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,161 @@
+''' Incremental decoding of large JSON responses.
+
+    FQL results and feed pages are one big JSON array (or an object with a "data" array in it).  Rather than reading
+    the whole body and json.loads'ing it into one big list, ArrayStream decodes the array one element at a time as the
+    bytes come in, so a caller can work through thousands of rows holding only a chunk of the body at once.
+'''
+
+import logging
+logger = logging.getLogger("pyfb")
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+WHITESPACE = " \t\n\r"
+COMPACT_SIZE = 65536    # drop consumed input from the buffer once this much has piled up
+
+
+class ArrayStream(object):
+    ''' Iterate over the elements of a JSON array decoded incrementally from an iterable of string chunks.
+
+        key - None if the document itself is the array.  Otherwise the document is expected to be an object and the
+              array is the value of this member, e.g. "data" for graph api connections.  The other members of the
+              object are decoded whole and put in the 'members' dictionary as they go by, so anything after the array
+              (e.g. "paging") is only there once iteration has finished.
+
+        If the document doesn't have the expected shape, say facebook sent back an error object instead of an array,
+        nothing is yielded and the whole decoded document is left in the 'document' attribute.  That is found out
+        from the first byte, so errors are spotted before any rows are processed.
+    '''
+
+    def __init__(self, chunks, key=None):
+        self.key = key
+        self.members = {}
+        self.document = None
+
+        self._chunks = iter(chunks)
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def __iter__(self):
+        c = self._peek()
+        if self.key is None:
+            if c != "[":
+                self._read_document()
+                return
+            for item in self._array():
+                yield item
+
+        else:
+            if c != "{":
+                self._read_document()
+                return
+            self._pos += 1
+
+            c = self._peek()
+            if c == "}":
+                self._pos += 1
+                return
+
+            while True:
+                name = self._value()
+                self._expect(":")
+
+                if name == self.key and self._peek() == "[":
+                    for item in self._array():
+                        yield item
+                else:
+                    self.members[name] = self._value()
+
+                c = self._peek()
+                if not c or c not in ",}":
+                    self._error("expected , or }")
+                self._pos += 1
+                if c == "}":
+                    return
+
+    def _array(self):
+        ''' generator over the elements of the array starting at the current position '''
+
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+
+        while True:
+            yield self._value()
+
+            c = self._peek()
+            if not c or c not in ",]":
+                self._error("expected , or ]")
+            self._pos += 1
+            if c == "]":
+                return
+
+    def _value(self):
+        ''' decode the complete JSON value at the current position, reading more input until it's all there '''
+
+        self._peek()
+        while True:
+            try:
+                (value, end) = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # incomplete, or actually malformed if there's no more input
+                if self._eof:
+                    raise
+                self._read()
+                continue
+
+            if end == len(self._buf) and not self._eof:
+                # a number at the end of the buffer may have more digits to come
+                self._read()
+                continue
+
+            self._pos = end
+            return value
+
+    def _read_document(self):
+        ''' not the shape we expected, decode the rest of the document whole '''
+
+        chunks = [self._buf[self._pos:]]
+        chunks.extend(self._chunks)
+        self._buf = ""
+        self._pos = 0
+        self._eof = True
+        self.document = json.loads("".join(chunks))
+
+    def _peek(self):
+        ''' skip whitespace and return the next character, reading more input if needed.  "" at the end of input '''
+
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if self._eof:
+                return ""
+            self._read()
+
+    def _expect(self, c):
+        if self._peek() != c:
+            self._error("expected %s" % c)
+        self._pos += 1
+
+    def _read(self):
+        ''' append the next chunk of input to the buffer, dropping what has already been consumed '''
+
+        if self._pos > COMPACT_SIZE:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+
+        try:
+            self._buf += self._chunks.next()
+        except StopIteration:
+            self._eof = True
+
+    def _error(self, msg):
+        raise ValueError("Bad JSON stream: %s at offset %d: %r" % (msg, self._pos, self._buf[self._pos:self._pos+50]))
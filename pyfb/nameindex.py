@@ -0,0 +1,253 @@
+''' Local search over friends' names.
+
+    A friend picker type-ahead calls fql.find_friends_by_name on every keystroke, which used to be an FQL round trip
+    each time.  A NameIndex keeps each user's friends in memory, indexed by every 1, 2 and 3 character substring
+    ("gram") of their normalized names, so a substring query is a lookup (queries of up to 3 characters) or an
+    intersection of a few sets followed by a check of the candidates (longer ones).
+
+    Names are normalized by lower casing, dropping accents and collapsing whitespace, so "jose" finds "Jos\u00e9".
+    Turn it on by setting fql.name_index to a NameIndex.
+'''
+
+import collections
+import heapq
+import logging
+logger = logging.getLogger("pyfb")
+import threading
+import time
+import unicodedata
+
+GRAM_SIZE = 3               # longest substrings indexed
+DEFAULT_MAX_USERS = 1000    # users whose friends are indexed, least recently used are forgotten first
+DEFAULT_MAX_AGE = 3600      # seconds before a user's friend list is due to be refreshed
+
+
+def normalize(name):
+    ''' lower case, accents dropped, whitespace collapsed.  Accepts str (utf-8) or unicode, returns unicode. '''
+
+    if not name:
+        return u""
+    if not isinstance(name, unicode):
+        name = name.decode("utf-8", "replace")
+    decomposed = unicodedata.normalize("NFKD", name.lower())
+    return u" ".join(u"".join([c for c in decomposed if not unicodedata.combining(c)]).split())
+
+def grams(text):
+    ''' set of the substrings of text of length 1 to GRAM_SIZE '''
+
+    result = set()
+    for n in range(1, GRAM_SIZE + 1):
+        for i in range(len(text) - n + 1):
+            result.add(text[i:i + n])
+    return result
+
+def word_grams(text):
+    ''' set of the grams of text that start a word '''
+
+    result = set()
+    for word in text.split():
+        for n in range(1, min(len(word), GRAM_SIZE) + 1):
+            result.add(word[:n])
+    return result
+
+
+class FriendIndex(object):
+    ''' One user's friends.  Not thread safe on its own, NameIndex locks around it. '''
+
+    def __init__(self):
+        self.rows = collections.OrderedDict()   # uid -> friend row, in friend list order
+        self.names = {}                         # uid -> normalized name
+        self.postings = {}                      # gram -> set of uids
+        self.word_postings = {}                 # gram -> set of uids with a word in their name starting with it
+        self.positions = {}                     # uid -> position in the friend list
+        self.updated = 0
+
+    def add(self, uid, row):
+        name = normalize(row.get("name"))
+        if uid in self.rows:
+            if self.names[uid] == name:
+                self.rows[uid] = row
+                return
+            self.remove(uid)
+
+        self.rows[uid] = row
+        self.names[uid] = name
+        for gram in grams(name):
+            self.postings.setdefault(gram, set()).add(uid)
+        for gram in word_grams(name):
+            self.word_postings.setdefault(gram, set()).add(uid)
+
+    def remove(self, uid):
+        if self.rows.pop(uid, None) is None:
+            return
+        name = self.names.pop(uid)
+        _unpost(self.postings, grams(name), uid)
+        _unpost(self.word_postings, word_grams(name), uid)
+
+    def replace(self, rows):
+        ''' make the index match the friend list rows, only touching friends that were added, removed or renamed '''
+
+        current = collections.OrderedDict()
+        for row in rows:
+            current[_uid(row)] = row
+
+        for uid in [uid for uid in self.rows if uid not in current]:
+            self.remove(uid)
+        for (uid, row) in current.items():
+            self.add(uid, row)
+
+        # keep friend list order for the results
+        self.rows = collections.OrderedDict([(uid, self.rows[uid]) for uid in current])
+        self.positions = dict([(uid, i) for (i, uid) in enumerate(current)])
+        self.updated = time.time()
+
+    def search(self, query, limit=None):
+        ''' rows of the friends whose normalized name contains the normalized query.  Friends with a word starting with
+            the query come first, then friend list order. '''
+
+        query = normalize(query)
+        if not query:
+            return self.rows.values()[:limit]
+
+        if len(query) <= GRAM_SIZE:
+            uids = self.postings.get(query, ())
+            first = self.word_postings.get(query, ())
+        else:
+            candidates = [self.postings.get(query[i:i + GRAM_SIZE], ()) for i in range(len(query) - GRAM_SIZE + 1)]
+            candidates.sort(key=len)
+            uids = set(candidates[0]).intersection(*candidates[1:])
+            uids = [uid for uid in uids if query in self.names[uid]]
+            word_start = u" " + query
+            first = set([uid for uid in uids if self.names[uid].startswith(query) or word_start in self.names[uid]])
+
+        positions = self.positions
+        n = len(positions)
+        rank = lambda uid: positions[uid] if uid in first else positions[uid] + n
+        if limit is None:
+            matches = sorted(uids, key=rank)
+        else:
+            matches = heapq.nsmallest(limit, uids, key=rank)
+        return [self.rows[uid] for uid in matches]
+
+
+class NameIndex(object):
+    ''' Thread safe set of FriendIndexes, one per user.
+
+        max_users - users indexed at once, the least recently searched are forgotten first
+        max_age - seconds after which a user's index is stale.  Stale indexes are still searched, callers should
+                  refresh them (see fql.find_friends_by_name).
+    '''
+
+    def __init__(self, max_users=DEFAULT_MAX_USERS, max_age=DEFAULT_MAX_AGE):
+        self.max_users = max_users
+        self.max_age = max_age
+
+        self._indexes = collections.OrderedDict()   # user key -> FriendIndex, least recently used first
+        self._refreshing = set()                    # user keys with a refresh in flight
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0       # searches answered from an index
+        self.misses = 0     # searches for users that aren't indexed
+        self.updates = 0    # friend lists indexed
+
+    def search(self, key, query, limit=None):
+        ''' Friend rows of user key matching query, or None if the user's friends aren't indexed. '''
+
+        self._lock.acquire()
+        try:
+            index = self._indexes.pop(key, None)
+            if index is None:
+                self.misses += 1
+                return None
+            self._indexes[key] = index
+            self.hits += 1
+            return index.search(query, limit)
+        finally:
+            self._lock.release()
+
+    def update(self, key, rows):
+        ''' (Re)index user key's friend list.  rows are dictionaries with a uid (or id) and a name, e.g. FQL user rows.
+            Only the friends that changed since the last update are reindexed. '''
+
+        rows = list(rows)
+        self._lock.acquire()
+        try:
+            index = self._indexes.pop(key, None)
+        finally:
+            self._lock.release()
+
+        # searches for this user miss while it is updated, everybody else carries on
+        if index is None:
+            index = FriendIndex()
+        index.replace(rows)
+
+        self._lock.acquire()
+        try:
+            self._indexes[key] = index
+            self._refreshing.discard(key)
+            self.updates += 1
+
+            if len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def needs_refresh(self, key):
+        ''' True if user key's index is missing or stale and nobody is refreshing it yet.  The caller is then expected
+            to refresh it with update() or refresh_failed(). '''
+
+        self._lock.acquire()
+        try:
+            if key in self._refreshing:
+                return False
+            index = self._indexes.get(key)
+            if index is not None and time.time() - index.updated < self.max_age:
+                return False
+            self._refreshing.add(key)
+            return True
+        finally:
+            self._lock.release()
+
+    def refresh_failed(self, key):
+        self._lock.acquire()
+        try:
+            self._refreshing.discard(key)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        ''' forget user key's friends '''
+
+        self._lock.acquire()
+        try:
+            self._indexes.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "updates" : self.updates,
+                "users" : len(self._indexes),
+                "friends" : sum([len(index.rows) for index in self._indexes.values()]),
+            }
+        finally:
+            self._lock.release()
+
+
+def _unpost(postings, grams, uid):
+    for gram in grams:
+        uids = postings[gram]
+        uids.discard(uid)
+        if not uids:
+            del postings[gram]
+
+def _uid(row):
+    uid = row.get("uid")
+    if uid is None:
+        uid = row.get("id")
+    return str(uid)
@@ -1,7 +1,26 @@
 import logging
 logger = logging.getLogger("pyfb")
+import Queue
+import sys
+import threading
+import time
 import urllib
-import urllib2
+import urlparse
+
+try:
+    import json
+except ImportError:
+    # app engine is on python 2.5
+    from django.utils import simplejson as json
+
+import breaker
+import coalesce
+import deadlines
+import engine
+import instrument
+import ratelimit
+import retry
+import transports
 
 # App engine is wonky with respect to using urllib2.  Sometimes perfectly valid URLs raise a 404 if urllib2 is used.  So.  Try to detect if we're on app engine and use
 # its urlfetch api directly if we are...
@@ -15,75 +34,613 @@ except ImportError:
     # not on app engine.
     app_engine = False
     
+
+DEFAULT_MAX_CONCURRENCY = 10 # get_many: max requests in flight at once
+
+# how requests are sent: urlfetch on app engine, httplib over shared keep-alive connections elsewhere.  Set it to
+# another transports.Transport to change that.
+transport = transports.default_transport()
+
+# identical GETs in flight at the same time share one request.  set to None to turn that off.
+coalescer = coalesce.Coalescer()
+
+# optional httpcache.HTTPCache used by get_json to revalidate responses with ETag / Last-Modified.  None disables it.
+http_cache = None
+
+# optional ratelimit.Scheduler every request has to get past before it is sent.  None disables rate limiting.
+scheduler = None
+
+# retries for GETs that fail with a network error or a 5xx, within the deadline budget.  None turns retrying off.
+retry_policy = retry.RetryPolicy()
+
+# optional retry.Hedger that sends a second GET when the first is slower than usual.  Not used on app engine.
+hedger = None
+
+# per endpoint circuit breakers, so requests to an endpoint that keeps failing fail fast.  None turns them off.
+breakers = breaker.CircuitBreakers()
+
+class NetException(Exception):
+    ''' Request failed or came back with an unexpected HTTP status '''
+    
+    def __init__(self, msg, status=None, content=None):
+        Exception.__init__(self, msg)
+        self.status = status
+        self.content = content
+    
+class DeadlineExceeded(NetException):
+    ''' Request didn't finish before its deadline '''
+    pass
+    
+class CircuitOpen(NetException):
+    ''' Request wasn't sent because its endpoint keeps failing, see breakers '''
+    pass
     
-def app_engine_get(url):
-    ''' do a HTTP get using app engine's urlfetch interface directly '''
     
+def request(method, url, body=None, headers=None):
+    ''' Low level request through the transport that doesn't check the status code.  Returns (status, headers,
+        content), headers being a dictionary keyed by lower case header name. '''
+    
+    _before_request(url, body)
     try:
-        response = urlfetch.fetch(url, method="GET", deadline=10) # 10 second deadline
-        if not response.status_code == 200:
-            logger.debug(response.content)
-            raise Exception("Failed to get %s via urlfetch.  HTTP status code was %d" % (url, response.status_code))
+        response = transport.request(method, url, body, headers, deadlines.timeout())
+    except Exception, e:
+        _request_failed(url, e)
+        logger.error("Failed to %s %s via %s" % (method, url, transport.name))
+        raise
+        
+    _after_request(url, response[0], response[2], body)
+    if instrument.enabled and response[0] != 200:
+        _count_error(response[2])
+    return response
+    
+def checked_request(method, url, body=None, headers=None):
+    ''' request that raises NetException unless the status is 200.  Returns the content. '''
+    
+    (status, headers, content) = request(method, url, body, headers)
+    
+    if status != 200:
+        logger.debug(content)
+        raise NetException("%s %s via %s failed.  HTTP status code was %d" % (method, url, transport.name, status),
+                           status, content)
+                           
+    return content
+    
+# the original per-platform helpers.  They go through the transport like everything else now.
+def app_engine_get(url):
+    return checked_request("GET", url)
+        
+def app_engine_post(url, data=None):
+    return _post_form(url, data)
+    
+def standard_lib_get(url):
+    return checked_request("GET", url)
+    
+def _post_form(url, data):
+    form_data = urllib.urlencode(data or {})
+    return checked_request("POST", url, form_data, {'Content-Type': 'application/x-www-form-urlencoded'})
+    
+def _count_error(content):
+    ''' count the facebook error code in an error response '''
+    
+    code = instrument.error_code(content)
+    if code is not None:
+        instrument.count("fb.errors", str(code))
+        
+def _before_request(url, body=None):
+    ''' Checks before a request goes out: there's time left in the deadline budget, the rate limiting scheduler lets
+        it go and the endpoint's circuit isn't open.  The circuit comes last because letting a request through a half
+        open circuit commits the caller to reporting how it went, with _after_request or _request_failed. '''
+    
+    if deadlines.expired():
+        raise DeadlineExceeded("Deadline expired before request to %s was sent" % url)
+        
+    if scheduler is not None:
+        try:
+            scheduler.acquire(url, body)
+        except ratelimit.QueueTimeout:
+            if deadlines.expired():
+                raise DeadlineExceeded("Deadline expired waiting for the rate limiter to send request to %s" % url)
+            raise
+        if deadlines.expired():
+            raise DeadlineExceeded("Deadline expired waiting for the rate limiter to send request to %s" % url)
             
-        return response.content
+    if breakers is not None and not breakers.allow(instrument.endpoint(url)):
+        raise CircuitOpen("Not sending request to %s, the endpoint keeps failing" % url)
         
-    except:
-        logger.error("Failed to GET %s via urlfetch" % url)
-        raise
+def _after_request(url, status, content, body=None):
+    ''' let the circuit breakers and scheduler know how a request went '''
+    
+    if breakers is not None:
+        # a 4xx still means the endpoint is up
+        breakers.record(instrument.endpoint(url), status < 500)
         
-def app_engine_post(url, data):
-    ''' do a HTTP post using app engine's urlfetch interface directly '''
+    if scheduler is not None:
+        if status == 200:
+            scheduler.report(url, None, body)
+        else:
+            scheduler.report(url, instrument.error_code(content), body)
+            
+def _request_failed(url, e=None):
+    ''' A request didn't get a response at all.  If the deadline budget has run out, that's why, so DeadlineExceeded
+        is raised instead of whatever the transport raised. '''
     
-    logger.debug("app_engine_post: " + url)
-    try:
-        #logger.debug("POST data: ")
-        #logger.debug(data)
+    if breakers is not None:
+        breakers.record(instrument.endpoint(url), False)
+        
+    if deadlines.expired():
+        raise DeadlineExceeded("Request to %s did not finish within the deadline (%s)" % (url, e))
         
-        form_data = urllib.urlencode(data)
-        response = urlfetch.fetch(url=url, method="POST", payload=form_data, headers={'Content-Type': 'application/x-www-form-urlencoded'}, deadline=10) # 10 second deadline
+def _retryable(e):
+    ''' Is a request that failed with e worth trying again?  Network trouble and server errors are.  Client errors
+        and our own deadline, circuit breaker and rate limiter refusing to send it aren't. '''
+    
+    if isinstance(e, (DeadlineExceeded, CircuitOpen)):
+        return False
+    if isinstance(e, NetException):
+        return e.status is None or e.status >= 500
+    return transports.is_network_error(e)
+    
+def _with_retries(fn):
+    ''' fn() retried according to retry_policy.  Only for idempotent requests. '''
+    
+    if retry_policy is None:
+        return fn()
+    return retry_policy.call(fn, _retryable)
 
-        if response.status_code != 200:
-            raise Exception("POST to %s failed with status code %d and content='%s" % (url, response.status_code, response.content))
+    
+def get(url, deadline=None, retries=True):
+    ''' do a simple synchronous get request for this URL.  Concurrent GETs of the same url share one request, see 
+        coalescer.  Failures are retried according to retry_policy.
+        
+        deadline - seconds the whole thing may take, retries included.  Defaults to the calling thread's budget, see
+                   pyfb.deadlines.
+        retries - False to send the request once, neither retried nor hedged, for GETs that must not be repeated (e.g.
+                  exchanging a one-time OAuth code, which fails the second time and hides why the first one did)
+    '''
+    
+    logger.debug("GET %s" % url)
+    if retries:
+        fetch = lambda: _get(url)
+    else:
+        fetch = lambda: checked_request("GET", url)
+        
+    with deadlines.budget(deadline):
+        if coalescer is not None:
+            return _coalesced(url, fetch)
+        return fetch()
+        
+def _get(url):
+    return _with_retries(lambda: _get_once(url))
+    
+def _get_once(url):
+    if hedger is not None and not transport.native_async:
+        return _hedged_get(url)
+    return checked_request("GET", url)
+        
+def _hedged_get(url):
+    # the attempts get threads of their own rather than engine workers: this may already be running on a worker, and
+    # waiting on others for the same host could hold every one of its slots while nothing gets to run
+    try:
+        return hedger.call(instrument.endpoint(url), lambda: _start_thread(lambda: checked_request("GET", url)))
+    except engine.RPCTimeout:
+        raise DeadlineExceeded("GET %s did not finish within the deadline" % url)
+        
+def _start_thread(fn):
+    ''' run fn on a thread of its own, with the calling thread's rate limiting priority and deadline budget.  Returns
+        an engine.RPC. '''
+    
+    priority = ratelimit.get_priority()
+    end = deadlines.current()
+    rpc = engine.RPC()
+    
+    def run():
+        previous = (ratelimit.get_priority(), deadlines.current())
+        ratelimit.set_priority(priority)
+        deadlines.set_current(end)
+        try:
+            result = fn()
+        except:
+            rpc.set_exception(sys.exc_info())
+            return
+        finally:
+            ratelimit.set_priority(previous[0])
+            deadlines.set_current(previous[1])
+        rpc.set_result(result)
+        
+    thread = threading.Thread(target=run, name="pyfb-hedge")
+    thread.daemon = True
+    thread.start()
+    return rpc
+        
+def _coalesced(key, fn):
+    ''' coalescer.do, waiting on a shared request no longer than the deadline budget '''
+    
+    try:
+        return coalescer.do(key, fn, deadlines.remaining())
+    except engine.RPCTimeout:
+        raise DeadlineExceeded("Shared request for %s did not finish within the deadline" % (key,))
+        
+def post(url, data=None, deadline=None):
+    ''' synchronous form encoded URL POST.  Not retried.  See get for deadline. '''
 
-        #logger.debug("POST response code: %s" % response.status_code)
-        #logger.debug("POST response content: %s" % response.content)
+    logger.debug("POST %s" % url)
+    with deadlines.budget(deadline):
+        return _post_form(url, data)
 
-        return response.content
+def get_json(url, deadline=None):
+    ''' GET a url and return the JSON decoded response, or None if the response was empty.
+    
+        If http_cache is set, responses are revalidated with conditional requests and a 304 (or a response that is 
+        still fresh according to the cache's policy) is answered with the previously decoded object.  Those objects 
+        are shared, so treat them as read only.
         
-    except:
-        logger.error("Failed to POST %s via urlfetch" % url)
-        raise
+        See get for deadline.
+    '''
     
-def standard_lib_get(url):
-    ''' do an HTTP get using python's urllib2 package '''
+    if http_cache is None:
+        return _decode_json(get(url, deadline), url)
+        
+    logger.debug("GET (json) %s" % url)
+    with deadlines.budget(deadline):
+        if coalescer is not None:
+            return _coalesced(("json", url), lambda: _get_json_cached(url))
+        return _get_json_cached(url)
+    
+def _get_json_cached(url):
+    cache = http_cache
+    entry = cache.lookup(url)
+    if entry is not None and entry.is_fresh():
+        cache.hit(entry)
+        return entry.parsed
+        
+    request_headers = {}
+    if entry is not None:
+        request_headers = cache.conditional_headers(entry)
+        
+    def conditional_get():
+        response = request("GET", url, headers=request_headers)
+        if response[0] >= 500:
+            raise NetException("GET %s failed.  HTTP status code was %d" % (url, response[0]), response[0], response[2])
+        return response
+        
+    (status, headers, content) = _with_retries(conditional_get)
+    
+    if status == 304 and entry is not None:
+        logger.debug("GET %s: not modified" % url)
+        cache.not_modified(url, entry, headers)
+        return entry.parsed
+        
+    if status != 200:
+        logger.debug(content)
+        raise NetException("GET %s failed.  HTTP status code was %d" % (url, status), status, content)
+        
+    o = _decode_json(content, url)
+    cache.store(url, headers, content, o)
+    return o
+    
+def _decode_json(content, url):
+    if not content:
+        return None
+    return instrument.loads(content, url)
+
+def get_stream(url):
+    ''' GET a url and return a ResponseStream over the chunks of the response body as they arrive, rather than
+        reading it all into one string.  Raises NetException unless the status is 200.  Feed the chunks to
+        jsonstream.ArrayStream to decode a big response as it comes in, and close() the stream when done with it.
 
+        Streams aren't coalesced or cached.  Transports that can't stream (urlfetch on app engine) yield the whole
+        body at once.
+    '''
+
+    logger.debug("GET (stream) %s" % url)
+    _before_request(url)
     try:
-        result = urllib2.urlopen(url)
-        return result.read()
+        response = transport.open("GET", url, timeout=deadlines.timeout())
+    except Exception, e:
+        _request_failed(url, e)
+        logger.error("Failed to GET %s via %s" % (url, transport.name))
+        raise
+
+    if response.status != 200:
+        content = response.read()
+        logger.debug(content)
+        _after_request(url, response.status, content)
+        if instrument.enabled:
+            _count_error(content)
+        raise NetException("GET %s via %s failed.  HTTP status code was %d" % (url, transport.name, response.status),
+                           response.status, content)
+
+    return ResponseStream(url, response)
+
+class ResponseStream(object):
+    ''' Iterator over the body of a get_stream response.  How the request went is only known once the body has been
+        read, so that's when the circuit breakers and scheduler hear about it: success at the end of the body, failure
+        if reading it raises.
+
+        close() is for callers that stop before the end: the response gets the connection back to the pool if it can,
+        and the request counts as a success since what arrived was fine.  Does nothing once the stream is finished.
+    '''
+
+    def __init__(self, url, response):
+        self.url = url
+        self._response = response
+        self._chunks = iter(response)
+        self._finished = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._finished:
+            raise StopIteration()
+        try:
+            return self._chunks.next()
+        except StopIteration:
+            self._finished = True
+            _after_request(self.url, 200, None)
+            raise
+        except Exception, e:
+            self._finished = True
+            logger.error("Failed to read the response to GET %s via %s" % (self.url, transport.name))
+            _request_failed(self.url, e)
+            raise
+
+    def close(self):
+        if self._finished:
+            return
+        self._finished = True
+        self._response.close()
+        _after_request(self.url, 200, None)
 
-    except urllib2.URLError, e:
-        logger.error("Failed to get %s via urllib2" % url)
+def get_async(url, callback=None):
+    ''' asynchronous GET.  Returns an RPC handle, call get_result() on it to wait for the response content.
+    
+        callback - if given, called with the response content when it arrives.  Its return value becomes the rpc's result.
+    '''
+
+    logger.debug("GET (async) %s" % url)
+    if transport.native_async:
+        return _start("GET", url, callback=callback)
+    elif coalescer is not None:
+        # share the request with any other GET of this url in flight.  callbacks are per caller.
+        shared = coalescer.do_async(url, lambda: _submit(lambda: _get(url), url))
+        
+        def result_callback(results):
+            if callback:
+                return callback(results[0])
+            return results[0]
+            
+        return gather([shared], result_callback)
+    else:
+        return _submit(lambda: _get(url), url, callback)
+
+def post_async(url, data=None, callback=None):
+    ''' asynchronous POST.  See get_async '''
+
+    logger.debug("POST (async) %s" % url)
+    if transport.native_async:
+        form_data = urllib.urlencode(data or {})
+        return _start("POST", url, form_data, {'Content-Type': 'application/x-www-form-urlencoded'}, callback)
+    else:
+        return _submit(lambda: post(url, data), url, callback)
+
+def _start(method, url, body=None, headers=None, callback=None):
+    ''' start a request with the transport's own rpcs '''
+    
+    _before_request(url, body)
+    try:
+        rpc = transport.start(method, url, body, headers, deadlines.timeout())
+    except Exception, e:
+        _request_failed(url, e)
         raise
+    return TransportRPC(rpc, method, url, callback, body)
 
+def _submit(fn, url, callback=None):
+    ''' run fn on the default engine.  The request keeps the calling thread's rate limiting priority and deadline
+        budget, which are only lent to the worker: the next task it runs mustn't inherit them. '''
     
-def get(url):
-    ''' do a simple synchronous get request for this URL '''
+    priority = ratelimit.get_priority()
+    end = deadlines.current()
     
-    logger.debug("GET %s" % url)
-    if app_engine:
-        return app_engine_get(url)
-    else:
-        return standard_lib_get(url)
+    def run():
+        previous = (ratelimit.get_priority(), deadlines.current())
+        ratelimit.set_priority(priority)
+        deadlines.set_current(end)
+        try:
+            return fn()
+        finally:
+            ratelimit.set_priority(previous[0])
+            deadlines.set_current(previous[1])
         
-def post(url, data):
-    ''' synchronost URL POST '''
+    return engine.default_engine().submit(run, host=_host(url), callback=callback)
+
+def get_many(urls, max_concurrency=DEFAULT_MAX_CONCURRENCY, deadline=None):
+    ''' GET a list of urls concurrently, at most max_concurrency at a time.
+    
+        Returns a list with one entry per url, in the same order as urls.  Each entry is either the response content or
+        the exception that fetching that url raised, so one failure doesn't lose the other results.
+        
+        deadline - overall time limit in seconds.  Urls that haven't finished by then get a DeadlineExceeded entry.
+    '''
+    
+    return fetch_many(get_async, [(url,) for url in urls], max_concurrency, deadline)
+    
+def get_many_async(urls, max_concurrency=DEFAULT_MAX_CONCURRENCY, callback=None):
+    ''' asynchronous get_many.  Returns an RPC handle whose result is the list of responses, in the same order as urls,
+        or callback(responses) if a callback is given.  Fails with the first failure, like gather.  At most
+        max_concurrency of the requests are in flight at a time, each one that finishes sends the next. '''
+    
+    # the later requests are sent from whichever thread finished an earlier one, so they carry the caller's priority
+    # and deadline budget over explicitly
+    priority = ratelimit.get_priority()
+    end = deadlines.current()
+    
+    def start(url):
+        previous = (ratelimit.get_priority(), deadlines.current())
+        ratelimit.set_priority(priority)
+        deadlines.set_current(end)
+        try:
+            return get_async(url)
+        finally:
+            ratelimit.set_priority(previous[0])
+            deadlines.set_current(previous[1])
+    
+    return engine.BoundedGroupRPC([lambda url=url: start(url) for url in urls], max_concurrency, callback)
+    
+def iter_get_many(urls, max_concurrency=DEFAULT_MAX_CONCURRENCY, deadline=None):
+    ''' Like get_many, but a generator of (index, result) pairs in the order the requests finish, so callers can start
+        on the fast responses while the slow ones are still in flight.  Stopping early stops new requests being sent. '''
+    
+    return iter_fetch_many(get_async, [(url,) for url in urls], max_concurrency, deadline)
+
+def fetch_many(start_async, arg_list, max_concurrency=DEFAULT_MAX_CONCURRENCY, deadline=None):
+    ''' Generic driver behind get_many: calls start_async(*args) for each entry of arg_list, keeping at most 
+        max_concurrency rpcs outstanding, and collects the results (or exceptions) in order. '''
+    
+    results = [None] * len(arg_list)
+    for (i, result) in iter_fetch_many(start_async, arg_list, max_concurrency, deadline):
+        results[i] = result
+    return results
+    
+def iter_fetch_many(start_async, arg_list, max_concurrency=DEFAULT_MAX_CONCURRENCY, deadline=None):
+    ''' Generator behind fetch_many, yields (index, result or exception) pairs as the rpcs complete. '''
+    
+    n = len(arg_list)
+    finished = [False] * n
+    
+    end = None
+    if deadline is not None:
+        end = time.time() + deadline
+
+    def remaining():
+        if end is None:
+            return None
+        return max(end - time.time(), 0)
+
+    def collect(i, rpc):
+        finished[i] = True
+        try:
+            return (i, rpc.get_result())
+        except Exception, e:
+            return (i, e)
+
+    next_index = 0
+    if transport.native_async:
+        # urlfetch rpcs only complete when waited on, so wait on them in order.  they still run concurrently.
+        in_flight = []
+        while next_index < n or in_flight:
+            while next_index < n and len(in_flight) < max_concurrency:
+                in_flight.append((next_index, start_async(*arg_list[next_index])))
+                next_index += 1
+                
+            if remaining() == 0:
+                break
+            (i, rpc) = in_flight.pop(0)
+            yield collect(i, rpc)
 
-    logger.debug("POST %s" % url)
-    if app_engine:
-        return app_engine_post(url, data)
     else:
-        raise Exception("Non app-engine POST is not yet implemented")
+        done = Queue.Queue()
+        in_flight = 0
+        while next_index < n or in_flight:
+            while next_index < n and in_flight < max_concurrency:
+                rpc = start_async(*arg_list[next_index])
+                rpc.add_done_callback(lambda rpc, i=next_index: done.put((i, rpc)))
+                in_flight += 1
+                next_index += 1
 
-def delete(url):
-    ''' synchronost URL POST '''
-    raise Exception("Not yet implemented")
+            timeout = remaining()
+            if timeout == 0:
+                break
+            try:
+                (i, rpc) = done.get(True, timeout)
+            except Queue.Empty:
+                break
+            in_flight -= 1
+            yield collect(i, rpc)
+            
+    for i in range(n):
+        if not finished[i]:
+            yield (i, DeadlineExceeded("Request did not finish within the %s second deadline" % deadline))
+
+def gather(rpcs, callback=None):
+    ''' Combine several rpcs into one whose result is the list of their results, or callback(results) if a callback
+        is given.  Fails with the first failure among rpcs. '''
+    return engine.GroupRPC(rpcs, callback)
+
+class TransportRPC(object):
+    ''' Wraps an rpc from Transport.start (e.g. an app engine urlfetch rpc) so it behaves like an engine.RPC:
+        get_result() returns the content (or the callback's return value) and raises on a non-200 status. '''
+    
+    def __init__(self, rpc, method, url, callback=None, body=None):
+        self.rpc = rpc
+        self.method = method
+        self.url = url
+        self.callback = callback
+        self.body = body
+        
+    def wait(self, timeout=None):
+        return self.rpc.wait(timeout)
+        
+    def get_result(self, timeout=None):
+        try:
+            (status, headers, content) = self.rpc.get_result(timeout)
+        except Exception, e:
+            _request_failed(self.url, e)
+            raise
+        _after_request(self.url, status, content, self.body)
+        if status != 200:
+            logger.debug(content)
+            raise NetException("%s %s via %s failed.  HTTP status code was %d" % (self.method, self.url, transport.name, status), 
+                               status, content)
+        
+        if self.callback:
+            return self.callback(content)
+        return content
+
+def _host(url):
+    return urlparse.urlsplit(url).netloc
+
+def transport_stats():
+    ''' the transport's counters, for the default httplib transport the connection pool's: hits, new_connections,
+        evictions and idle '''
+    return transport.stats()
+    
+# old name
+pool_stats = transport_stats
+
+def coalesce_stats():
+    ''' request coalescing counters: leaders (requests made), saved (requests avoided), timeouts and in_flight '''
+    if coalescer is None:
+        return None
+    return coalescer.stats()
+
+def scheduler_stats():
+    ''' rate limiter counters: queued, max_queued, granted, waited, wait_time, timeouts and throttled '''
+    if scheduler is None:
+        return None
+    return scheduler.stats()
+
+def retry_stats():
+    ''' retry counters: calls, retries and recovered '''
+    if retry_policy is None:
+        return None
+    return retry_policy.stats()
+    
+def hedge_stats():
+    ''' hedging counters: calls, hedged, won and endpoints '''
+    if hedger is None:
+        return None
+    return hedger.stats()
+    
+def breaker_stats():
+    ''' circuit breaker counters: opened, rejected and the list of open endpoints '''
+    if breakers is None:
+        return None
+    return breakers.stats()
+
+def delete(url, deadline=None):
+    ''' synchronous URL DELETE.  See get for deadline. '''
+    
+    logger.debug("DELETE %s" % url)
+    with deadlines.budget(deadline):
+        return checked_request("DELETE", url)
@@ -0,0 +1,123 @@
+''' Adaptive chunking of queries over long lists of ids.
+
+    One FQL query for every column of a few thousand friends is slow, and liable to time out altogether.  The same rows
+    come back much sooner as several "uid in (...)" queries over chunks of the ids run side by side.  How big a chunk
+    should be depends on how fast facebook is answering, so a ChunkPlanner sizes them to take about target_seconds,
+    going by how long recent chunks took per id, and halves the size when a chunk times out or fails.
+
+    Turn it on for fql.get_friends and fql.iter_friends by setting fql.friends_planner to a ChunkPlanner.
+'''
+
+import logging
+logger = logging.getLogger("pyfb")
+import threading
+
+import instrument
+
+DEFAULT_TARGET_SECONDS = 1.0    # how long a chunk should take
+DEFAULT_CHUNK_SIZE = 100        # ids per chunk until we know better
+MIN_CHUNK_SIZE = 10
+MAX_CHUNK_SIZE = 250            # keeps query urls a sane length
+DEFAULT_MAX_CONCURRENCY = 4     # chunks in flight at once
+SMOOTHING = 0.3                 # weight of the newest observation in the per id time average
+MAX_GROWTH = 2                  # chunk size grows at most this much per observation
+
+
+class ChunkPlanner(object):
+    ''' Thread safe chunk sizing.  Call split() to chunk a list of ids, then succeeded() or failed() with how each
+        chunk went.
+
+        target_seconds - how long a chunk should take
+        initial_size - chunk size before any chunk has finished
+        min_size, max_size - bounds on the chunk size
+        max_concurrency - chunks a caller should have in flight at once
+    '''
+
+    def __init__(self, target_seconds=DEFAULT_TARGET_SECONDS, initial_size=DEFAULT_CHUNK_SIZE,
+                 min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_concurrency = max_concurrency
+
+        self.size = max(min_size, min(initial_size, max_size))
+        self.seconds_per_id = None  # moving average
+        self._lock = threading.Lock()
+
+        # stats
+        self.chunks = 0     # chunks that succeeded
+        self.failures = 0   # chunks that failed and shrank the chunk size
+
+    def chunk_size(self):
+        self._lock.acquire()
+        try:
+            return self.size
+        finally:
+            self._lock.release()
+
+    def split(self, ids, size=None):
+        ''' ids in chunks of the current chunk size, or of size if that is smaller.  Chunks are small enough that
+            there are at least max_concurrency of them (as long as they stay min_size), so none of the concurrency
+            goes to waste. '''
+
+        ids = list(ids)
+        chunk = min(self.chunk_size(), max(self.min_size, -(-len(ids) // self.max_concurrency)))
+        if size is not None:
+            chunk = min(chunk, size)
+        chunk = max(1, chunk)
+        return [ids[i:i + chunk] for i in range(0, len(ids), chunk)]
+
+    def succeeded(self, ids, seconds):
+        ''' a chunk of ids ids took seconds '''
+
+        if ids <= 0:
+            return
+
+        self._lock.acquire()
+        try:
+            self.chunks += 1
+            per_id = seconds / ids
+            if self.seconds_per_id is None:
+                self.seconds_per_id = per_id
+            else:
+                self.seconds_per_id = SMOOTHING * per_id + (1 - SMOOTHING) * self.seconds_per_id
+
+            if self.seconds_per_id > 0:
+                wanted = int(self.target_seconds / self.seconds_per_id)
+            else:
+                wanted = self.max_size
+            self.size = max(self.min_size, min(wanted, self.size * MAX_GROWTH, self.max_size))
+            size = self.size
+        finally:
+            self._lock.release()
+
+        if instrument.enabled:
+            instrument.observe("planner.chunk", "ok", seconds)
+        logger.debug("planner: %d ids took %0.3f seconds, chunk size now %d" % (ids, seconds, size))
+
+    def failed(self, ids):
+        ''' a chunk of ids ids timed out or failed in a way a smaller one might not '''
+
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            self.size = max(self.min_size, min(self.size, ids) / 2)
+            size = self.size
+        finally:
+            self._lock.release()
+
+        if instrument.enabled:
+            instrument.count("planner.failures", str(ids))
+        logger.warning("planner: chunk of %d ids failed, chunk size now %d" % (ids, size))
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "chunk_size" : self.size,
+                "seconds_per_id" : self.seconds_per_id,
+                "chunks" : self.chunks,
+                "failures" : self.failures,
+            }
+        finally:
+            self._lock.release()
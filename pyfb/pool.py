@@ -0,0 +1,339 @@
+''' Keep-alive HTTP connection pool used by pyfb.net when we're not on app engine.
+
+    urllib2 opens a brand new socket (and does a full TLS handshake) for every request, which is most of the latency
+    of a graph.facebook.com / api.facebook.com call.  The pool keeps finished connections around per host so the next
+    request to the same host can reuse them.
+'''
+
+import httplib
+import logging
+logger = logging.getLogger("pyfb")
+import socket
+import threading
+import time
+import urlparse
+import zlib
+
+import instrument
+
+DEFAULT_MAX_PER_HOST = 10   # max idle connections kept per (scheme, host, port)
+DEFAULT_IDLE_TIMEOUT = 60   # seconds an idle connection is kept before it is thrown away
+READ_CHUNK_SIZE = 16384     # bytes read from the socket at a time
+MAX_DRAIN_BYTES = 65536     # unread body PooledResponse.close() will read off so the connection can be reused
+
+# requests it is safe to send again when a reused connection fails: the server may have acted on the first one before
+# the connection went, and a repeated POST would e.g. post to a wall twice
+RESEND_METHODS = ("GET", "HEAD")
+
+
+class ConnectionPool(object):
+    ''' Thread safe pool of persistent httplib connections, keyed by (scheme, host, port).
+
+        max_per_host - maximum number of idle connections kept for each host.  Extra connections are closed on release.
+        idle_timeout - idle connections older than this many seconds are closed rather than reused.
+        timeout - socket timeout handed to new connections (None means the socket default)
+        ssl_context - optional ssl.SSLContext for https connections (e.g. to trust a local test certificate)
+    '''
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=None, ssl_context=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+
+        self._idle = {}     # key -> list of (connection, last used time), most recently used last
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0               # requests that reused an idle connection
+        self.new_connections = 0    # connections opened
+        self.evictions = 0          # idle connections closed because they were stale or the pool was full
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        ''' Do an HTTP request over a pooled connection.  Returns a (status, headers, content) tuple, where headers is
+            a dictionary keyed by lower case header name.  gzip encoded responses are decompressed as they are read,
+            ask for them by sending an Accept-Encoding: gzip header.
+
+            timeout - socket timeout for this request, defaults to the pool's
+        '''
+
+        response = self.open(method, url, body, headers, timeout)
+        content = response.read()
+        return (response.status, response.headers, content)
+
+    def open(self, method, url, body=None, headers=None, timeout=None):
+        ''' Like request, but returns a PooledResponse as soon as the headers are in, so the body can be streamed. '''
+
+        (key, path) = self._split(url)
+        if headers is None:
+            headers = {}
+        if timeout is None:
+            timeout = self.timeout
+
+        label = None
+        if instrument.enabled:
+            label = instrument.endpoint(url)
+            start = time.time()
+
+        (conn, reused) = self._acquire(key)
+        try:
+            response = self._send(conn, method, path, body, headers, timeout, label)
+        except socket.timeout:
+            # the server is slow rather than gone, trying again would just double the wait
+            conn.close()
+            raise
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused or method.upper() not in RESEND_METHODS:
+                raise
+
+            # the server may have closed an idle keep-alive connection under us.  retry once on a fresh socket.
+            logger.debug("pool: reused connection to %s:%s failed, reconnecting" % key[1:])
+            conn = self._connect(key)
+            try:
+                response = self._send(conn, method, path, body, headers, timeout, label)
+            except:
+                conn.close()
+                raise
+
+        if label is None:
+            return PooledResponse(self, key, conn, response)
+
+        instrument.observe("http.first_byte", label, time.time() - start)
+        if response.status != 200:
+            instrument.count("http.status", "%s %d" % (label, response.status))
+        return PooledResponse(self, key, conn, response, label, start)
+
+    def stats(self):
+        ''' Snapshot of the pool counters '''
+
+        self._lock.acquire()
+        try:
+            idle = sum([len(conns) for conns in self._idle.values()])
+            return {
+                "hits" : self.hits,
+                "new_connections" : self.new_connections,
+                "evictions" : self.evictions,
+                "idle" : idle,
+            }
+        finally:
+            self._lock.release()
+
+    def close(self):
+        ''' Close all idle connections '''
+
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+        for conns in idle.values():
+            for (conn, last_used) in conns:
+                conn.close()
+
+    def _split(self, url):
+        ''' split a url into its pool key and the request path '''
+
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https"):
+            raise ValueError("Unsupported url scheme: %s" % url)
+
+        port = parts.port
+        if not port:
+            if scheme == "https":
+                port = httplib.HTTPS_PORT
+            else:
+                port = httplib.HTTP_PORT
+
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        return ((scheme, parts.hostname, port), path)
+
+    def _acquire(self, key):
+        ''' Get an idle connection for this host if there is a usable one, otherwise open a new one.  Returns
+            (connection, reused) '''
+
+        stale = []
+        conn = None
+
+        self._lock.acquire()
+        try:
+            conns = self._idle.get(key)
+            now = time.time()
+            while conns:
+                (c, last_used) = conns.pop()
+                if now - last_used > self.idle_timeout:
+                    stale.append(c)
+                    self.evictions += 1
+                else:
+                    conn = c
+                    self.hits += 1
+                    break
+        finally:
+            self._lock.release()
+
+        for c in stale:
+            c.close()
+
+        if conn:
+            return (conn, True)
+
+        return (self._connect(key), False)
+
+    def _release(self, key, conn):
+        ''' Return a connection to the pool, closing it if the host already has enough idle connections '''
+
+        self._lock.acquire()
+        try:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_per_host:
+                conns.append((conn, time.time()))
+                conn = None
+            else:
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+        if conn:
+            conn.close()
+
+    def _connect(self, key):
+        (scheme, host, port) = key
+
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs["timeout"] = self.timeout
+
+        if scheme == "https":
+            if self.ssl_context is not None:
+                kwargs["context"] = self.ssl_context
+            conn = httplib.HTTPSConnection(host, port, **kwargs)
+        else:
+            conn = httplib.HTTPConnection(host, port, **kwargs)
+
+        self._lock.acquire()
+        try:
+            self.new_connections += 1
+        finally:
+            self._lock.release()
+
+        return conn
+
+    def _send(self, conn, method, path, body, headers, timeout=None, label=None):
+        # a reused connection may have been left with somebody else's timeout
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+
+        if label is not None and conn.sock is None:
+            # connect explicitly rather than inside request() so the handshake can be timed on its own
+            start = time.time()
+            conn.connect()
+            instrument.observe("http.connect", label, time.time() - start)
+
+        conn.request(method, path, body, headers)
+        return conn.getresponse()
+
+
+class PooledResponse(object):
+    ''' Response from ConnectionPool.open.  Iterating over it yields the (decompressed) body a chunk at a time.  The
+        connection goes back to the pool once the body has been read to the end, or is closed if it is abandoned
+        part way through.  Call close() when done with a response that might not have been read to the end, rather
+        than leaving the connection to the garbage collector. '''
+
+    def __init__(self, pool, key, conn, response, label=None, start=None):
+        self.status = response.status
+        self.headers = dict(response.getheaders())
+
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._label = label     # instrument endpoint label, None if not instrumented
+        self._start = start
+        self._chunks = None
+
+    def __iter__(self):
+        if self._chunks is None:
+            self._chunks = self._read_chunks()
+        return self._chunks
+
+    def _read_chunks(self):
+        conn = self._conn
+        if conn is None:
+            # already read
+            return
+        self._conn = None
+
+        finished = False
+        size = 0
+        try:
+            for chunk in iter_content(self._response):
+                size += len(chunk)
+                yield chunk
+            finished = True
+
+            if self._label is not None:
+                instrument.observe("http.total", self._label, time.time() - self._start)
+                instrument.observe("http.response_bytes", self._label, size)
+        finally:
+            if finished and not self._response.will_close:
+                self._pool._release(self._key, conn)
+            else:
+                conn.close()
+
+    def read(self):
+        ''' read the whole body '''
+        return "".join(self)
+
+    def close(self):
+        ''' Done with the response.  Whatever is left of the body is read off, as long as it is no more than
+            MAX_DRAIN_BYTES (typically the tail of a JSON document the caller stopped decoding once it had what it
+            wanted), and the connection goes back to the pool.  A connection with more than that left on it is closed
+            instead.  Does nothing if the body has already been read to the end.
+        '''
+
+        chunks = iter(self)
+        drained = 0
+        try:
+            for chunk in chunks:
+                drained += len(chunk)
+                if drained > MAX_DRAIN_BYTES:
+                    break
+        except Exception, e:
+            # the connection has already been closed
+            logger.debug("PooledResponse: reading the rest of the body failed: %s" % e)
+        # closes the connection if we stopped part way through
+        chunks.close()
+
+
+def iter_content(response):
+    ''' Generator over the body of an httplib response, read a chunk at a time and gunzipped on the fly if the server
+        gzip encoded it. '''
+
+    decompressor = None
+    if response.getheader("content-encoding", "").lower() == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)   # 16 + MAX_WBITS: expect a gzip header
+
+    while True:
+        chunk = response.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+            if not chunk:
+                continue
+        yield chunk
+
+    if decompressor:
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
@@ -0,0 +1,332 @@
+''' Client side rate limiting for facebook requests.
+
+    Facebook throttles calls per application and per access token, and once you're over the limit every call fails
+    with a throttling error until it lets up.  A Scheduler keeps us under the limits in the first place: every request
+    takes a token from its app's bucket and from its access token's bucket, and waits in a queue when either is empty
+    instead of going out anyway.  Waiting requests are served by priority, so interactive (canvas) requests go ahead
+    of background crawls, and first come first served within a priority.
+
+    When facebook does throttle us anyway, the bucket concerned slows down and blocks for a while, backing off
+    further each time it happens again, and speeds back up as requests succeed.
+
+    Turn it on by setting pyfb.net.scheduler to a Scheduler.  Set the priority of the requests made by a thread with
+    set_priority or the request_priority context manager, e.g.
+
+        with ratelimit.request_priority(ratelimit.BACKGROUND):
+            crawl_friends()
+'''
+
+import bisect
+import collections
+import contextlib
+import itertools
+import logging
+logger = logging.getLogger("pyfb")
+import threading
+import time
+import urlparse
+
+import deadlines
+import instrument
+import tokens
+
+# request priorities, lower goes first
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
+# facebook error codes that mean we're being throttled, and which bucket they're about
+APP_THROTTLE_CODES = (4,)               # application request limit reached
+TOKEN_THROTTLE_CODES = (17, 341, 613)   # user request limit, feed action limit, calls within one second
+THROTTLE_CODES = APP_THROTTLE_CODES + TOKEN_THROTTLE_CODES
+
+DEFAULT_APP_RATE = 50.0     # requests per second per application
+DEFAULT_APP_BURST = 100
+DEFAULT_TOKEN_RATE = 1.0    # requests per second per access token, facebook allows roughly 600 per 600 seconds
+DEFAULT_TOKEN_BURST = 20
+DEFAULT_MAX_WAIT = 60       # seconds a request waits in the queue before giving up
+
+INITIAL_BACKOFF = 1         # seconds a bucket blocks for the first time it's throttled
+MAX_BACKOFF = 300           # cap on the backoff, which doubles each time in a row it's throttled
+MIN_RATE_FRACTION = 0.05    # throttling never slows a bucket below this fraction of its configured rate
+RECOVERY_FRACTION = 0.05    # fraction of the configured rate regained per successful request
+
+POLL_INTERVAL = 0.1         # seconds between queue checks for a request that is waiting on others ahead of it
+
+MAX_TOKEN_BUCKETS = 10000   # access token buckets remembered, least recently used are forgotten first
+
+DEFAULT_APP = "default"     # app bucket for access tokens that don't say which app they belong to
+
+
+class QueueTimeout(Exception):
+    ''' A request waited longer than the scheduler's max_wait, or the rest of its deadline budget, for its turn '''
+    pass
+
+
+class TokenBucket(object):
+    ''' rate tokens a second, up to burst of them saved up.  Not thread safe on its own, the Scheduler locks around
+        it. '''
+
+    def __init__(self, rate, burst):
+        self.base_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.backoff = INITIAL_BACKOFF
+
+    def delay(self, now):
+        ''' seconds until a token is available, 0 if one is available now '''
+
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def throttled(self, now):
+        ''' facebook throttled us: slow down and block for a while '''
+
+        self.rate = max(self.rate / 2, self.base_rate * MIN_RATE_FRACTION)
+        self.tokens = 0
+        self.updated = now
+        self.blocked_until = max(self.blocked_until, now + self.backoff)
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    def succeeded(self):
+        self.backoff = INITIAL_BACKOFF
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * RECOVERY_FRACTION)
+
+    def is_idle(self, now):
+        ''' True if the bucket is back to its resting state, so forgetting it loses nothing '''
+
+        return now >= self.blocked_until and self.rate == self.base_rate and self.delay(now) == 0 \
+               and self.tokens >= self.burst
+
+
+class Scheduler(object):
+    ''' Thread safe token bucket rate limiter with a priority queue of waiting requests.
+
+        app_rate, app_burst - requests per second and burst size allowed per application
+        token_rate, token_burst - requests per second and burst size allowed per access token
+        max_wait - seconds a request waits for its turn before QueueTimeout is raised.  Requests inside a deadline budget
+                   (see pyfb.deadlines) give up when it runs out, if that's sooner.
+
+        The application is taken from the access token ("app_id|..." tokens), tokens that don't carry it share the
+        DEFAULT_APP bucket.
+    '''
+
+    def __init__(self, app_rate=DEFAULT_APP_RATE, app_burst=DEFAULT_APP_BURST, token_rate=DEFAULT_TOKEN_RATE,
+                 token_burst=DEFAULT_TOKEN_BURST, max_wait=DEFAULT_MAX_WAIT):
+        self.app_rate = app_rate
+        self.app_burst = app_burst
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+        self.max_wait = max_wait
+
+        self._app_buckets = {}                              # app id -> TokenBucket
+        self._token_buckets = collections.OrderedDict()     # access token -> TokenBucket, least recently used first
+        self._waiting = []                                  # sorted list of (priority, sequence number, buckets)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+
+        # stats
+        self.granted = 0        # requests let through
+        self.waited = 0         # requests that had to queue
+        self.wait_time = 0.0    # total seconds spent queueing
+        self.max_queued = 0     # longest the queue has been
+        self.timeouts = 0       # requests that gave up waiting
+        self.throttled = 0      # throttling errors reported by facebook
+
+    def acquire(self, url, body=None, priority=None):
+        ''' Wait until a request to url may go out.
+
+            body - form encoded request body, checked for an access_token if the url doesn't have one
+            priority - defaults to the calling thread's priority, see set_priority
+        '''
+
+        if priority is None:
+            priority = get_priority()
+        (app_id, access_token) = _request_identity(url, body)
+
+        start = time.time()
+        deadline = start + self.max_wait
+        budget_end = deadlines.current()
+        if budget_end is not None and budget_end < deadline:
+            deadline = budget_end
+
+        self._cond.acquire()
+        try:
+            buckets = [self._app_bucket(app_id)]
+            if access_token:
+                buckets.append(self._token_bucket(access_token))
+
+            waiter = (priority, self._sequence.next(), buckets)
+            bisect.insort(self._waiting, waiter)
+            queued = False
+
+            try:
+                while True:
+                    now = time.time()
+                    delay = max([bucket.delay(now) for bucket in buckets])
+                    if delay == 0 and not self._blocked(waiter, now):
+                        for bucket in buckets:
+                            bucket.take()
+                        break
+
+                    if now >= deadline:
+                        self.timeouts += 1
+                        if deadline == budget_end:
+                            raise QueueTimeout("Deadline budget ran out while request to %s waited to be sent" % url)
+                        raise QueueTimeout("Request to %s waited more than %s seconds to be sent" % (url, self.max_wait))
+
+                    # wait for a token, or for whoever is ahead of us to go
+                    if not queued:
+                        queued = True
+                        self.max_queued = max(self.max_queued, len(self._waiting))
+                    self._cond.wait(min(delay or POLL_INTERVAL, deadline - now))
+            finally:
+                self._waiting.remove(waiter)
+                self._cond.notifyAll()
+
+            self.granted += 1
+            waited = time.time() - start
+            if queued:
+                self.waited += 1
+                self.wait_time += waited
+        finally:
+            self._cond.release()
+
+        if instrument.enabled:
+            instrument.observe("ratelimit.wait", str(priority), waited)
+
+    def report(self, url, error_code=None, body=None):
+        ''' Tell the scheduler how a request went.  error_code is facebook's error code if it failed, None if it
+            succeeded. '''
+
+        if error_code is not None and error_code not in THROTTLE_CODES:
+            return
+
+        (app_id, access_token) = _request_identity(url, body)
+        now = time.time()
+
+        self._cond.acquire()
+        try:
+            if error_code is None:
+                self._app_bucket(app_id).succeeded()
+                if access_token:
+                    self._token_bucket(access_token).succeeded()
+                return
+
+            self.throttled += 1
+            if error_code in APP_THROTTLE_CODES or not access_token:
+                bucket = self._app_bucket(app_id)
+            else:
+                bucket = self._token_bucket(access_token)
+            bucket.throttled(now)
+            backoff = bucket.blocked_until - now
+        finally:
+            self._cond.release()
+
+        logger.warning("ratelimit: throttled by facebook (error code %s), backing off for %0.1f seconds" % (error_code, backoff))
+
+    def stats(self):
+        self._cond.acquire()
+        try:
+            return {
+                "queued" : len(self._waiting),
+                "max_queued" : self.max_queued,
+                "granted" : self.granted,
+                "waited" : self.waited,
+                "wait_time" : self.wait_time,
+                "timeouts" : self.timeouts,
+                "throttled" : self.throttled,
+            }
+        finally:
+            self._cond.release()
+
+    def _blocked(self, waiter, now):
+        ''' True if a request ahead of waiter in the queue has first claim on one of its buckets, i.e. shares a bucket
+            with it and isn't held up by a bucket of its own.  A request that is waiting on its own access token
+            doesn't hold up the others behind it.  Called with the lock held. '''
+
+        buckets = waiter[2]
+        for ahead in self._waiting:
+            if ahead is waiter:
+                return False
+
+            shared = False
+            ready = True
+            for bucket in ahead[2]:
+                if bucket in buckets:
+                    shared = True
+                elif bucket.delay(now) > 0:
+                    ready = False
+            if shared and ready:
+                return True
+        return False
+
+    def _app_bucket(self, app_id):
+        bucket = self._app_buckets.get(app_id)
+        if bucket is None:
+            bucket = self._app_buckets[app_id] = TokenBucket(self.app_rate, self.app_burst)
+        return bucket
+
+    def _token_bucket(self, access_token):
+        bucket = self._token_buckets.pop(access_token, None)
+        if bucket is None:
+            bucket = TokenBucket(self.token_rate, self.token_burst)
+        self._token_buckets[access_token] = bucket
+
+        if len(self._token_buckets) > MAX_TOKEN_BUCKETS:
+            # forget the least recently used bucket, unless it's still limiting somebody
+            (oldest_token, oldest) = self._token_buckets.popitem(last=False)
+            if not oldest.is_idle(time.time()):
+                self._token_buckets[oldest_token] = oldest
+        return bucket
+
+
+_local = threading.local()
+
+def get_priority():
+    ''' priority of requests made by the calling thread '''
+    return getattr(_local, "priority", NORMAL)
+
+def set_priority(priority):
+    ''' set the priority of requests made by the calling thread '''
+    _local.priority = priority
+
+@contextlib.contextmanager
+def request_priority(priority):
+    ''' context manager that sets the calling thread's request priority, and restores it afterwards '''
+
+    previous = get_priority()
+    set_priority(priority)
+    try:
+        yield
+    finally:
+        set_priority(previous)
+
+def _request_identity(url, body=None):
+    ''' (app id, access token) a request is made with '''
+
+    access_token = tokens.token_from_url(url)
+    if not access_token and body:
+        try:
+            access_token = urlparse.parse_qs(body).get("access_token", [None])[0]
+        except (TypeError, ValueError):
+            access_token = None
+
+    app_id = DEFAULT_APP
+    if access_token and "|" in access_token:
+        app_id = access_token.split("|", 1)[0]
+    return (app_id, access_token)
@@ -0,0 +1,332 @@
+''' Compact representations of user and friend result sets.
+
+    A friend list is normally a list of dictionaries that all repeat the same keys, which costs around a kilobyte per
+    friend before the values.  Two more compact forms, asked for with compact=True on fql.get_friends,
+    graph.get_friends_list and graph.get_users:
+
+        Table - a columnar list of rows: one list (or array, for integer columns) per column, with repeated strings
+                shared.  Filtering works a column at a time, e.g.
+                    friends.exclude("relationship_status", ["Married", "In a relationship"])
+        record classes - objects with __slots__ for a fixed set of columns, made by record_class(), for keyed results
+                         like graph.get_users'.
+
+    Both convert back to dictionaries with to_dicts() / to_dict(), and rows read like dictionaries (row["name"]).
+'''
+
+import array
+import itertools
+import logging
+logger = logging.getLogger("pyfb")
+import threading
+
+# marks a column a row didn't have, as opposed to one it had with a null value
+MISSING = object()
+
+MAX_RECORD_CLASSES = 100    # record classes remembered by record_class
+
+
+class Record(object):
+    ''' Base of the classes made by record_class.  Reads like a read only dictionary of its columns, leaving out the
+        ones the row didn't have. '''
+
+    __slots__ = ()
+    columns = ()
+
+    @classmethod
+    def from_dict(cls, d):
+        record = cls()
+        for column in cls.columns:
+            object.__setattr__(record, column, _share(d.get(column, MISSING)))
+        return record
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def items(self):
+        result = []
+        for column in self.columns:
+            value = getattr(self, column, MISSING)
+            if value is not MISSING:
+                result.append((column, value))
+        return result
+
+    def keys(self):
+        return [column for (column, value) in self.items()]
+
+    def get(self, column, default=None):
+        value = getattr(self, column, MISSING) if column in self.columns else MISSING
+        if value is MISSING:
+            return default
+        return value
+
+    def __getitem__(self, column):
+        value = self.get(column, MISSING)
+        if value is MISSING:
+            raise KeyError(column)
+        return value
+
+    def __contains__(self, column):
+        return self.get(column, MISSING) is not MISSING
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        # the classes are made on the fly, so pickle how to make them again
+        return (_unpickle_record, (self.__class__.__name__, self.columns, self.to_dict()))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.to_dict())
+
+
+_record_classes = {}
+_record_classes_lock = threading.Lock()
+
+def record_class(columns, name="UserRecord"):
+    ''' Record subclass with __slots__ for columns.  Classes are shared between callers asking for the same columns. '''
+
+    columns = tuple(columns)
+    key = (name, columns)
+
+    _record_classes_lock.acquire()
+    try:
+        cls = _record_classes.get(key)
+        if cls is None:
+            clashes = set(columns) & set(dir(Record))
+            if clashes:
+                raise ValueError("Columns can't be record attributes: %s" % ", ".join(sorted(clashes)))
+            if len(_record_classes) >= MAX_RECORD_CLASSES:
+                _record_classes.clear()
+            cls = _record_classes[key] = type(name, (Record,), {"__slots__" : columns, "columns" : columns})
+        return cls
+    finally:
+        _record_classes_lock.release()
+
+def _unpickle_record(name, columns, d):
+    return record_class(columns, name).from_dict(d)
+
+def compact_dict(objects, columns=None, name="UserRecord"):
+    ''' dictionary of key -> object dictionary (e.g. from graph.get_users) with the objects turned into records.
+        columns defaults to every key the objects have. '''
+
+    if objects is None:
+        return None
+    if columns is None:
+        columns = _union_keys(objects.values())
+    cls = record_class(columns, name)
+    return dict([(key, cls.from_dict(o)) for (key, o) in objects.items()])
+
+
+class Table(object):
+    ''' Read only columnar list of rows.
+
+        columns - list of column names
+        data - dictionary of column name -> sequence of values, all the same length.  MISSING marks columns a row
+               didn't have.
+        rows - positions in data of this table's rows, None for all of them.  Filtered tables share their parent's
+               columns and only keep which rows they have.
+
+        Use from_rows to build one from dictionaries.  Indexing and iteration give dictionaries.
+    '''
+
+    def __init__(self, columns, data, rows=None):
+        self.columns = list(columns)
+        self._data = data
+        self._rows = rows
+        if rows is not None:
+            self._length = len(rows)
+        elif self.columns:
+            self._length = len(data[self.columns[0]])
+        else:
+            self._length = 0
+
+    @classmethod
+    def from_rows(cls, rows, columns=None):
+        ''' Table of a list of dictionaries.  columns defaults to every key the rows have, in the order first seen. '''
+
+        if rows is None:
+            return None
+        rows = list(rows)
+        if columns is None:
+            columns = _union_keys(rows)
+
+        strings = {}
+        data = {}
+        for column in columns:
+            values = [_share(row.get(column, MISSING), strings) for row in rows]
+            data[column] = _pack(values)
+        return cls(columns, data)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(range(*i.indices(self._length)))
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError("Table index out of range")
+        if self._rows is not None:
+            i = self._rows[i]
+        return self._row(i)
+
+    def __iter__(self):
+        for i in self._positions():
+            yield self._row(i)
+
+    def __eq__(self, other):
+        if isinstance(other, Table):
+            other = other.to_dicts()
+        return self.to_dicts() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Table(%d rows, columns=%r)" % (self._length, self.columns)
+
+    def __getstate__(self):
+        # only this table's rows, and MISSING doesn't survive pickling so keep where it was separately
+        state = {}
+        for column in self.columns:
+            values = self._values(column)
+            missing = [i for (i, value) in enumerate(values) if value is MISSING]
+            if missing:
+                values = [(value if value is not MISSING else None) for value in values]
+            state[column] = (values, missing)
+        return (self.columns, state)
+
+    def __setstate__(self, state):
+        (columns, columns_state) = state
+        data = {}
+        for column in columns:
+            (values, missing) = columns_state[column]
+            if missing:
+                values = list(values)
+                for i in missing:
+                    values[i] = MISSING
+            data[column] = values
+        self.__init__(columns, data)
+
+    def column(self, name):
+        ''' the values of column name, None where a row didn't have it '''
+        return [(value if value is not MISSING else None) for value in self._values(name)]
+
+    def to_dicts(self):
+        return list(self)
+
+    def records(self, name="UserRecord"):
+        ''' the rows as record_class records '''
+
+        cls = record_class(self.columns, name)
+        result = []
+        for i in self._positions():
+            record = cls()
+            for column in self.columns:
+                object.__setattr__(record, column, self._data[column][i])
+            result.append(record)
+        return result
+
+    def take(self, indexes):
+        ''' Table of the rows at indexes '''
+
+        if self._rows is not None:
+            indexes = [self._rows[i] for i in indexes]
+        return Table(self.columns, self._data, array.array("l", indexes))
+
+    def where(self, column, predicate):
+        ''' Table of the rows whose value of column satisfies predicate(value).  Rows without the column are tested
+            with None. '''
+
+        values = self._data[column]
+        return self._select([i for i in self._positions()
+                             if predicate(values[i] if values[i] is not MISSING else None)])
+
+    def isin(self, column, values):
+        ''' Table of the rows whose value of column is one of values '''
+
+        wanted = set(values)
+        values = self._data[column]
+        return self._select([i for i in self._positions() if values[i] in wanted])
+
+    def exclude(self, column, values):
+        ''' Table of the rows whose value of column isn't one of values '''
+
+        unwanted = set(values)
+        values = self._data[column]
+        return self._select([i for i in self._positions() if values[i] not in unwanted])
+
+    def extend(self, rows):
+        ''' Table of these rows followed by rows (dictionaries or another Table with the same columns) '''
+
+        if not isinstance(rows, Table):
+            rows = Table.from_rows(rows, self.columns)
+
+        data = {}
+        for column in self.columns:
+            data[column] = _pack(list(itertools.chain(self._values(column), rows._values(column))))
+        return Table(self.columns, data)
+
+    def _positions(self):
+        if self._rows is None:
+            return xrange(self._length)
+        return self._rows
+
+    def _values(self, column):
+        values = self._data[column]
+        if self._rows is None:
+            return values
+        return [values[i] for i in self._rows]
+
+    def _select(self, positions):
+        return Table(self.columns, self._data, array.array("l", positions))
+
+    def _row(self, i):
+        row = {}
+        for column in self.columns:
+            value = self._data[column][i]
+            if value is not MISSING:
+                row[column] = value
+        return row
+
+
+def _union_keys(rows):
+    columns = []
+    seen = set()
+    for row in rows:
+        for key in row:
+            if key not in seen:
+                seen.add(key)
+                columns.append(key)
+    return columns
+
+def _share(value, strings=None):
+    ''' one copy of equal strings: interned for str, from strings (a dictionary) for unicode '''
+
+    if isinstance(value, str):
+        return intern(value)
+    if strings is not None and isinstance(value, unicode):
+        return strings.setdefault(value, value)
+    return value
+
+def _pack(values):
+    ''' array of values if they are all integers that fit in a C long, otherwise the list '''
+
+    if values and all([type(value) in (int, long) for value in values]):
+        try:
+            return array.array("l", values)
+        except OverflowError:
+            pass
+    return values
@@ -0,0 +1,383 @@
+''' Cache of FQL query and graph api read results, with stale-while-revalidate.
+
+    The same queries (a user's friend uid list, their friends using the app...) get run again on every page view.  A
+    ResultCache keeps each result for a TTL, keyed by the normalized query text (or graph url without its token) and
+    the identity behind the access token, so two tokens of the same user share entries and a user's entries can be
+    dropped together when something of theirs changes.
+
+    Once an entry's TTL is up it is still served for a further stale_ttl seconds while a background request refreshes
+    it, so callers only wait on facebook for results that aren't cached at all.  Empty results and errors the caller
+    marks as cacheable (e.g. an invalid access token) are kept for the shorter negative_ttl.
+
+    Given a backend (see pyfb.backends), results are also written there, so other processes, and this one after a
+    restart, can start from them instead of from nothing.  Results read back from the backend are served at once and
+    (with revalidate_loaded) refreshed in the background like stale ones.
+
+    Turn it on by setting fql.result_cache and / or graph.result_cache to a ResultCache.  Results handed back are
+    shared between callers, so treat them as read only.
+'''
+
+import collections
+import hashlib
+import logging
+logger = logging.getLogger("pyfb")
+import re
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+import engine
+import instrument
+import ratelimit
+import tokens
+
+DEFAULT_TTL = 300           # seconds a result is fresh
+DEFAULT_STALE_TTL = 3600    # seconds after that it is served while being refreshed
+DEFAULT_NEGATIVE_TTL = 30   # seconds empty results and cacheable errors are kept
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class Entry(object):
+    ''' A cached result, or the error fetching it raised '''
+
+    __slots__ = ("value", "exc_info", "identity", "fresh_until", "stale_until")
+
+    def __init__(self, value, exc_info, identity, ttl, stale_ttl):
+        now = time.time()
+        self.value = value
+        self.exc_info = exc_info
+        self.identity = identity
+        self.fresh_until = now + ttl
+        self.stale_until = self.fresh_until + stale_ttl
+
+    def result(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class ResultCache(object):
+    ''' Thread safe LRU cache of results keyed by (identity, key).
+
+        default_ttl - seconds a result stays fresh, for keys no policy matches
+        policies - list of (regular expression, ttl) pairs checked in order against the key text (a normalized query
+                   or url), e.g. [(r"from friend ", 3600), (r"/feed\b", 60)].  The first match sets the TTL.
+        stale_ttl - seconds an expired result is still served while it is refreshed in the background.  0 turns
+                    stale-while-revalidate off.
+        negative_ttl - seconds empty results and cacheable errors are kept
+        max_entries - results kept, least recently used are forgotten first
+        backend - optional backends.CacheBackend results are also kept in, e.g. a SQLiteBackend to survive restarts.
+                  Only results are kept there, not empty results or errors.
+        revalidate_loaded - refresh results read from the backend in the background, even if they are still fresh
+    '''
+
+    def __init__(self, default_ttl=DEFAULT_TTL, policies=None, stale_ttl=DEFAULT_STALE_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, max_entries=DEFAULT_MAX_ENTRIES, backend=None,
+                 revalidate_loaded=True):
+        self.default_ttl = default_ttl
+        self.policies = [(re.compile(pattern), ttl) for (pattern, ttl) in (policies or [])]
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self.revalidate_loaded = revalidate_loaded
+
+        self._entries = collections.OrderedDict()   # (identity, key) -> Entry, least recently used first
+        self._by_identity = {}                      # identity -> set of keys
+        self._refreshing = set()                    # (identity, key) with a background refresh in flight
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0           # fresh results served
+        self.stale_hits = 0     # expired results served while being refreshed
+        self.negative_hits = 0  # cached empty results and errors served
+        self.misses = 0         # results fetched while the caller waited
+        self.refreshes = 0      # background refreshes
+        self.evictions = 0
+        self.loaded = 0         # results read from the backend
+
+    def ttl(self, key):
+        ''' how long the result for key stays fresh according to the policies '''
+
+        for (pattern, ttl) in self.policies:
+            if pattern.search(key):
+                return ttl
+        return self.default_ttl
+
+    def get(self, identity, key, fetch, cacheable_error=None, error_identity=None):
+        ''' The result for key on behalf of identity: cached if it's fresh (or stale and being refreshed), otherwise
+            fetch()'s, which is then cached.
+
+            identity - who the result is for, see identity()
+            key - normalized query or url, see normalize_query() and normalize_url()
+            cacheable_error - optional function of an exception fetch() raised, True if the error should be cached
+                              (for negative_ttl) rather than retried by the next caller
+            error_identity - who cached errors are for, defaults to identity.  Errors that belong to one access token
+                             (e.g. it has expired) should be kept under token_identity(), so the same user's other
+                             tokens don't get them.
+        '''
+
+        if error_identity is None:
+            error_identity = identity
+        cache_key = (identity, key)
+        now = time.time()
+
+        self._lock.acquire()
+        try:
+            refresh = False
+            entry = None
+            if error_identity != identity:
+                error = self._entries.get((error_identity, key))
+                if error is not None and now < error.fresh_until:
+                    entry = error
+                    self.negative_hits += 1
+
+            if entry is None:
+                entry = self._entries.get(cache_key)
+                if entry is not None and now < entry.stale_until:
+                    self._entries[cache_key] = self._entries.pop(cache_key)
+                    if now < entry.fresh_until:
+                        if entry.exc_info is not None or _is_empty(entry.value):
+                            self.negative_hits += 1
+                        else:
+                            self.hits += 1
+                    else:
+                        self.stale_hits += 1
+                        if cache_key not in self._refreshing:
+                            self._refreshing.add(cache_key)
+                            refresh = True
+                else:
+                    entry = None
+        finally:
+            self._lock.release()
+
+        if entry is None and self.backend is not None:
+            entry = self._load(identity, key, now)
+            if entry is not None:
+                self._lock.acquire()
+                try:
+                    self.loaded += 1
+                    if now >= entry.fresh_until and cache_key not in self._refreshing:
+                        self._refreshing.add(cache_key)
+                        refresh = True
+                finally:
+                    self._lock.release()
+
+        if entry is not None:
+            if refresh:
+                self._refresh_async(identity, key, fetch, cacheable_error, error_identity)
+            if instrument.enabled:
+                instrument.count("resultcache", refresh and "stale" or "hit")
+            return entry.result()
+
+        self._lock.acquire()
+        try:
+            self.misses += 1
+        finally:
+            self._lock.release()
+        if instrument.enabled:
+            instrument.count("resultcache", "miss")
+        return self._fetch(identity, key, fetch, cacheable_error, error_identity).result()
+
+    def invalidate(self, identity, key):
+        self._lock.acquire()
+        try:
+            self._remove((identity, key))
+        finally:
+            self._lock.release()
+
+        if self.backend is not None:
+            self.backend.delete(_backend_key(identity, key))
+
+    def invalidate_user(self, user_id):
+        ''' forget every result cached for a user, e.g. after they changed something '''
+        self.invalidate_identity(str(user_id))
+
+    def invalidate_identity(self, identity):
+        self._lock.acquire()
+        try:
+            for key in list(self._by_identity.get(identity, ())):
+                self._remove((identity, key))
+        finally:
+            self._lock.release()
+
+        if self.backend is not None:
+            # the backend can't list an identity's results, so remember when they were invalidated instead, for as
+            # long as any of them could still be there
+            longest = max([self.default_ttl] + [ttl for (pattern, ttl) in self.policies]) + self.stale_ttl
+            self.backend.set(_invalidated_key(identity), time.time(), longest)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._by_identity.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "hits" : self.hits,
+                "stale_hits" : self.stale_hits,
+                "negative_hits" : self.negative_hits,
+                "misses" : self.misses,
+                "refreshes" : self.refreshes,
+                "evictions" : self.evictions,
+                "loaded" : self.loaded,
+                "entries" : len(self._entries),
+                "backend" : self.backend.stats() if self.backend is not None else None,
+            }
+        finally:
+            self._lock.release()
+
+    def _fetch(self, identity, key, fetch, cacheable_error, error_identity):
+        ''' call fetch() and cache what it returns or raises.  Returns the new Entry. '''
+
+        try:
+            value = fetch()
+        except Exception, e:
+            if cacheable_error is None or not cacheable_error(e):
+                raise
+            entry = Entry(None, sys.exc_info(), error_identity, self.negative_ttl, 0)
+            self._store((error_identity, key), entry)
+            return entry
+        else:
+            if _is_empty(value):
+                entry = Entry(value, None, identity, self.negative_ttl, 0)
+            else:
+                entry = Entry(value, None, identity, self.ttl(key), self.stale_ttl)
+
+        self._store((identity, key), entry)
+
+        if self.backend is not None and entry.exc_info is None and not _is_empty(entry.value):
+            stored = {
+                "value" : entry.value,
+                "fresh_until" : entry.fresh_until,
+                "stale_until" : entry.stale_until,
+                "stored" : time.time(),
+            }
+            self.backend.set(_backend_key(identity, key), stored, entry.stale_until - time.time())
+        return entry
+
+    def _load(self, identity, key, now):
+        ''' the backend's Entry for key, stored here too, or None if it doesn't have one we can use '''
+
+        names = (_backend_key(identity, key), _invalidated_key(identity))
+        found = self.backend.get_many(names)
+        stored = found.get(names[0])
+        if stored is None or now >= stored["stale_until"]:
+            return None
+        invalidated = found.get(names[1])
+        if invalidated is not None and stored["stored"] <= invalidated:
+            return None
+
+        entry = Entry(stored["value"], None, identity, 0, 0)
+        entry.fresh_until = stored["fresh_until"]
+        entry.stale_until = stored["stale_until"]
+        if self.revalidate_loaded:
+            entry.fresh_until = min(entry.fresh_until, now)
+        self._store((identity, key), entry)
+        return entry
+
+    def _refresh_async(self, identity, key, fetch, cacheable_error, error_identity):
+        def refresh():
+            try:
+                # in the background, so without the caller's deadline
+                with ratelimit.request_priority(ratelimit.BACKGROUND):
+                    self._fetch(identity, key, fetch, cacheable_error, error_identity)
+            except Exception, e:
+                # keep serving the stale result until it runs out
+                logger.warning("resultcache: refreshing %s failed: %s" % (key, e))
+            finally:
+                self._lock.acquire()
+                try:
+                    self._refreshing.discard((identity, key))
+                    self.refreshes += 1
+                finally:
+                    self._lock.release()
+
+        engine.default_engine().submit(refresh)
+
+    def _store(self, cache_key, entry):
+        self._lock.acquire()
+        try:
+            self._remove(cache_key)
+            self._entries[cache_key] = entry
+            self._by_identity.setdefault(cache_key[0], set()).add(cache_key[1])
+
+            while len(self._entries) > self.max_entries:
+                self._remove(iter(self._entries).next())
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def _remove(self, cache_key):
+        ''' called with the lock held '''
+
+        if self._entries.pop(cache_key, None) is None:
+            return
+        (identity, key) = cache_key
+        keys = self._by_identity.get(identity)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_identity[identity]
+
+
+def identity(access_token):
+    ''' Who results fetched with access_token are for: the user id if tokens.manager knows whose token it is, "app:"
+        and the app id for app tokens it handed out, otherwise a hash of the token (so the token itself isn't kept
+        around).  An "app_id|..." token isn't taken for an app token on its looks, old style user tokens look the same
+        and would share one identity. '''
+
+    if not access_token:
+        return "anonymous"
+
+    user_id = tokens.manager.get_user_id(access_token)
+    if user_id:
+        return str(user_id)
+    app_id = tokens.manager.get_app_id(access_token)
+    if app_id:
+        return "app:%s" % app_id
+    return token_identity(access_token)
+
+def token_identity(access_token):
+    ''' identity of access_token itself rather than of who it belongs to, for results only that token gets (errors
+        about the token) '''
+
+    if not access_token:
+        return "anonymous"
+    return "token:%s" % hashlib.sha1(access_token).hexdigest()
+
+def normalize_query(query):
+    ''' FQL query text with whitespace collapsed and lower cased outside of string literals '''
+
+    parts = re.split(r"""("[^"]*"|'[^']*')""", query.strip())
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i].lower())
+    return "".join(parts)
+
+def normalize_url(url):
+    ''' url path and sorted query parameters, without the access token '''
+
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+    params = sorted([(name, value) for (name, value) in urlparse.parse_qsl(query, True) if name != "access_token"])
+    if params:
+        return "%s?%s" % (path or "/", urllib.urlencode(params))
+    return path or "/"
+
+def _backend_key(identity, key):
+    return "result:%s:%s" % (identity, key)
+
+def _invalidated_key(identity):
+    return "result-invalidated:%s" % identity
+
+def _is_empty(value):
+    return value is None or value == [] or value == {}
@@ -0,0 +1,227 @@
+''' Retries and hedged requests for idempotent reads.
+
+    RetryPolicy retries a failed call with jittered exponential backoff, as long as the deadline budget (see
+    pyfb.deadlines) has time left for another go.  Hedger cuts the tail latency of a call: if the first request
+    hasn't answered by the time most requests to that endpoint have (say the 95th percentile), a second identical
+    request is sent and whichever answers first wins.  Hedging costs a few percent more requests, so only use it for
+    reads that matter.
+'''
+
+import collections
+import logging
+logger = logging.getLogger("pyfb")
+import Queue
+import random
+import threading
+import time
+
+import deadlines
+import instrument
+
+DEFAULT_MAX_ATTEMPTS = 3    # tries in total, including the first
+DEFAULT_BASE_DELAY = 0.1    # seconds, backoff before the first retry is up to this
+DEFAULT_MAX_DELAY = 2.0     # seconds, cap on the backoff
+
+DEFAULT_HEDGE_PERCENTILE = 95   # hedge requests that are slower than this percentile of recent ones
+DEFAULT_MIN_SAMPLES = 20        # don't hedge an endpoint until we've seen this many of its requests
+DEFAULT_WINDOW = 200            # recent latencies remembered per endpoint
+DEFAULT_HEDGE_MAX_WAIT = 2 * deadlines.REQUEST_TIMEOUT  # seconds a hedged call waits when there's no deadline budget
+MAX_ENDPOINTS = 1000            # endpoints tracked
+
+
+class RetryPolicy(object):
+    ''' Retry with "full jitter" exponential backoff: the n'th retry waits a random time between 0 and
+        min(max_delay, base_delay * 2^n).
+
+        max_attempts - tries in total, including the first.  1 turns retrying off.
+    '''
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+
+        # stats
+        self.calls = 0
+        self.retries = 0        # extra attempts made
+        self.recovered = 0      # calls that failed at first but succeeded on a retry
+
+    def backoff(self, retry):
+        ''' seconds to wait before the retry'th retry (0 based) '''
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+    def call(self, fn, retryable):
+        ''' Return fn(), retrying it while it raises an exception retryable(exception) is True for, there are
+            attempts left and the deadline budget has room for the backoff plus another try. '''
+
+        self._count("calls")
+        attempt = 0
+        while True:
+            try:
+                result = fn()
+            except Exception, e:
+                attempt += 1
+                if attempt >= self.max_attempts or not retryable(e):
+                    raise
+
+                delay = self.backoff(attempt - 1)
+                left = deadlines.remaining()
+                if left is not None and left <= delay:
+                    # no time for another go
+                    raise
+
+                logger.debug("retry: attempt %d failed (%s), retrying in %0.2f seconds" % (attempt, e, delay))
+                self._count("retries")
+                if instrument.enabled:
+                    instrument.count("net.retries", e.__class__.__name__)
+                time.sleep(delay)
+                continue
+
+            if attempt:
+                self._count("recovered")
+            return result
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "calls" : self.calls,
+                "retries" : self.retries,
+                "recovered" : self.recovered,
+            }
+        finally:
+            self._lock.release()
+
+    def _count(self, counter):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
+
+
+class Hedger(object):
+    ''' Sends a second request when the first is slower than usual for its endpoint.
+
+        percentile - hedge once the first request has taken longer than this percentile of recent requests
+        min_samples - requests to an endpoint seen before hedging it
+        window - recent request latencies remembered per endpoint
+        max_wait - seconds a call waits for its requests when the caller has no deadline budget.  engine.RPCTimeout is
+                   raised after that.
+    '''
+
+    def __init__(self, percentile=DEFAULT_HEDGE_PERCENTILE, min_samples=DEFAULT_MIN_SAMPLES, window=DEFAULT_WINDOW,
+                 max_wait=DEFAULT_HEDGE_MAX_WAIT):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.max_wait = max_wait
+
+        self._latencies = collections.OrderedDict()  # endpoint -> deque of recent latencies, least recently used first
+        self._lock = threading.Lock()
+
+        # stats
+        self.calls = 0
+        self.hedged = 0     # calls that sent a second request
+        self.won = 0        # hedged calls where the second request answered first
+
+    def delay(self, key):
+        ''' seconds to wait before hedging a request to key, or None if we don't know enough about it yet '''
+
+        self._lock.acquire()
+        try:
+            latencies = self._latencies.get(key)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            ordered = sorted(latencies)
+        finally:
+            self._lock.release()
+
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))]
+
+    def record(self, key, seconds):
+        self._lock.acquire()
+        try:
+            latencies = self._latencies.pop(key, None)
+            if latencies is None:
+                latencies = collections.deque(maxlen=self.window)
+            latencies.append(seconds)
+            self._latencies[key] = latencies
+            if len(self._latencies) > MAX_ENDPOINTS:
+                self._latencies.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def call(self, key, start_async):
+        ''' Return the result of the rpc start_async() returns, calling it a second time if the first doesn't finish
+            within delay(key).  The first rpc to succeed wins, the call only fails if both do.  start_async must
+            return rpcs that support add_done_callback (engine.RPC), and mustn't need the calling thread to finish.
+            Waits no longer than the deadline budget, or max_wait without one. '''
+
+        self._count("calls")
+        wait = self.delay(key)
+        left = deadlines.remaining()
+        if left is None:
+            left = self.max_wait
+
+        start = time.time()
+        end = start + left
+        first = start_async()
+        if wait is None or left <= wait or first.wait(wait):
+            result = first.get_result(max(0, end - time.time()))
+            self.record(key, time.time() - start)
+            return result
+
+        self._count("hedged")
+        if instrument.enabled:
+            instrument.count("net.hedged", key)
+        logger.debug("hedge: %s slower than %0.3f seconds, sending a second request" % (key, wait))
+
+        finished = Queue.Queue()
+        first.add_done_callback(lambda rpc: finished.put((rpc, start)))
+        second_start = time.time()
+        second = start_async()
+        second.add_done_callback(lambda rpc: finished.put((rpc, second_start)))
+
+        error = None
+        for i in range(2):
+            try:
+                (rpc, started) = finished.get(True, max(0, end - time.time()))
+            except Queue.Empty:
+                break
+            try:
+                result = rpc.get_result()
+            except Exception, e:
+                error = e
+                continue
+
+            self.record(key, time.time() - started)
+            if rpc is second:
+                self._count("won")
+            return result
+
+        if error is not None:
+            raise error
+        # out of time, let the first request report it
+        return first.get_result(0)
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "calls" : self.calls,
+                "hedged" : self.hedged,
+                "won" : self.won,
+                "endpoints" : len(self._latencies),
+            }
+        finally:
+            self._lock.release()
+
+    def _count(self, counter):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
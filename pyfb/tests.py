@@ -0,0 +1,700 @@
+''' Behavior tests for pyfb, run against the fbstub server from benchmarks/.
+
+    Usage, from the directory above pyfb:  python -m unittest pyfb.tests
+'''
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from pyfb import backends
+from pyfb import breaker
+from pyfb import coalesce
+from pyfb import deadlines
+from pyfb import engine
+from pyfb import feedsync
+from pyfb import graph
+from pyfb import instrument
+from pyfb import net
+from pyfb import pool
+from pyfb import ratelimit
+from pyfb import resultcache
+from pyfb import retry
+from pyfb import tokens
+import fbstub
+import stub_server
+
+TOKEN = "1|stub_user_token"
+
+
+class FBStubTest(unittest.TestCase):
+    ''' starts an fbstub server for the test case, and points graph at it.  net's module level settings are put back
+        after each test. '''
+
+    @classmethod
+    def setUpClass(cls):
+        (cls.server, cls.base_url, context) = fbstub.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        # hang up the keep-alive connections first, so the server's handler threads finish
+        net.transport.close()
+        stub_server.stop(cls.server)
+
+    def setUp(self):
+        self.server.latency = 0.0
+        self.server.jitter = 0.0
+        self.server.error_rate = 0.0
+        self.server.feed_time = fbstub.FEED_TIME
+        self.server.token_users = {}
+        self.server.counts = {}
+
+        self.saved = dict([(name, getattr(net, name)) for name in
+                           ("coalescer", "hedger", "breakers", "scheduler", "retry_policy")])
+        self.saved_base_url = graph.FB_GRAPH_BASE_URL
+        graph.FB_GRAPH_BASE_URL = self.base_url
+
+    def tearDown(self):
+        for (name, value) in self.saved.items():
+            setattr(net, name, value)
+        graph.FB_GRAPH_BASE_URL = self.saved_base_url
+
+    def user_url(self, uid):
+        return "%s/%s?access_token=%s" % (self.base_url, uid, TOKEN)
+
+
+class EngineTest(unittest.TestCase):
+
+    def testSubmit(self):
+        rpc = engine.default_engine().submit(lambda: 6 * 7, callback=lambda result: result + 1)
+        self.assertEqual(43, rpc.get_result(5))
+
+    def testExceptionReachesCaller(self):
+        def fail():
+            raise ValueError("boom")
+        rpc = engine.default_engine().submit(fail)
+        self.assertRaises(ValueError, rpc.get_result, 5)
+
+    def testPerHostLimit(self):
+        e = engine.Engine(workers=4, max_per_host=2)
+        lock = threading.Lock()
+        running = [0, 0]    # now, most at once
+
+        def task():
+            lock.acquire()
+            running[0] += 1
+            running[1] = max(running)
+            lock.release()
+            time.sleep(0.02)
+            lock.acquire()
+            running[0] -= 1
+            lock.release()
+
+        engine.wait_all([e.submit(task, host="graph.facebook.com") for i in range(8)], 5)
+        self.assertEqual(2, running[1])
+
+    def testBoundedGroup(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def start(i):
+            def task():
+                lock.acquire()
+                running[0] += 1
+                running[1] = max(running)
+                lock.release()
+                time.sleep(0.02)
+                lock.acquire()
+                running[0] -= 1
+                lock.release()
+                return i
+            return engine.default_engine().submit(task)
+
+        rpc = engine.BoundedGroupRPC([lambda i=i: start(i) for i in range(10)], 3, sum)
+        self.assertEqual(45, rpc.get_result(5))
+        self.assertTrue(running[1] <= 3)
+
+
+class HedgerTest(FBStubTest):
+
+    def testSlowFirstRequestIsHedged(self):
+        hedger = retry.Hedger(min_samples=1)
+        hedger.record("key", 0.01)
+        delays = [0.5, 0.0]
+
+        def start():
+            delay = delays.pop(0)
+            return engine.default_engine().submit(lambda: time.sleep(delay) or delay)
+
+        self.assertEqual(0.0, hedger.call("key", start))
+        self.assertEqual(1, hedger.stats()["hedged"])
+        self.assertEqual(1, hedger.stats()["won"])
+
+    def testFailedFirstRequestLosesToHedge(self):
+        hedger = retry.Hedger(min_samples=1)
+        hedger.record("key", 0.01)
+        attempts = []
+
+        def attempt():
+            attempts.append(1)
+            if len(attempts) == 1:
+                time.sleep(0.05)
+                raise net.NetException("first attempt failed")
+            time.sleep(0.1)
+            return "second"
+
+        start = lambda: engine.default_engine().submit(attempt)
+        self.assertEqual("second", hedger.call("key", start))
+
+    def testWaitIsBoundedByBudget(self):
+        hedger = retry.Hedger(min_samples=1)
+        hedger.record("key", 0.01)
+        start = lambda: engine.default_engine().submit(lambda: time.sleep(1))
+
+        t = time.time()
+        with deadlines.budget(0.1):
+            self.assertRaises(engine.RPCTimeout, hedger.call, "key", start)
+        self.assertTrue(time.time() - t < 0.5)
+
+    def testHedgedGetsFromEngineWorkers(self):
+        # every request hedges, and they all start on engine workers: the hedges mustn't wait on workers of their own
+        net.coalescer = None
+        net.hedger = retry.Hedger(min_samples=1)
+        self.server.latency = 0.02
+        urls = [self.user_url(fbstub.FIRST_FRIEND_UID + i) for i in range(2 * engine.DEFAULT_WORKERS)]
+        for url in urls:
+            net.hedger.record(instrument.endpoint(url), 0.001)
+
+        rpcs = [net.get_async(url) for url in urls]
+        for rpc in rpcs:
+            self.assertTrue(rpc.get_result(10))
+        self.assertTrue(net.hedger.stats()["hedged"] > 0)
+
+        # and the engine is still free afterwards
+        self.assertTrue(net.get_async(urls[0]).get_result(5))
+
+
+class RetryTest(FBStubTest):
+
+    def setUp(self):
+        FBStubTest.setUp(self)
+        net.breakers = None
+        net.coalescer = None
+        net.retry_policy = retry.RetryPolicy(base_delay=0.01)
+        self.server.error_rate = 1.0
+
+    def testGetsAreRetried(self):
+        self.assertRaises(net.NetException, net.get, self.user_url(fbstub.ME_UID))
+        self.assertEqual(retry.DEFAULT_MAX_ATTEMPTS, self.server.counts.get("errors"))
+
+    def testOptingOutSendsOnce(self):
+        self.assertRaises(net.NetException, net.get, self.user_url(fbstub.ME_UID), retries=False)
+        self.assertEqual(1, self.server.counts.get("errors"))
+
+    def testOAuthCodeIsExchangedOnce(self):
+        self.assertRaises(net.NetException, graph.authenticate_app, "1", "secret", "http://localhost/", "code")
+        self.assertEqual(1, self.server.counts.get("errors"))
+
+
+class TaskIsolationTest(FBStubTest):
+    ''' what one request lends an engine worker (its deadline budget and priority) mustn't reach the worker's next
+        task '''
+
+    def setUp(self):
+        FBStubTest.setUp(self)
+        # one worker, so the next task runs on the same thread
+        self.saved_engine = engine._default_engine
+        engine._default_engine = engine.Engine(workers=1)
+        net.coalescer = None
+
+    def tearDown(self):
+        engine._default_engine = self.saved_engine
+        FBStubTest.tearDown(self)
+
+    def testDeadlineDoesNotLeakToNextTask(self):
+        with deadlines.budget(0.5):
+            self.assertTrue(net.get_async(self.user_url(fbstub.ME_UID)).get_result(5))
+
+        rpc = engine.default_engine().submit(deadlines.current)
+        self.assertEqual(None, rpc.get_result(5))
+
+    def testPriorityDoesNotLeakToNextTask(self):
+        with ratelimit.request_priority(ratelimit.INTERACTIVE):
+            self.assertTrue(net.get_async(self.user_url(fbstub.ME_UID)).get_result(5))
+
+        rpc = engine.default_engine().submit(ratelimit.get_priority)
+        self.assertEqual(ratelimit.NORMAL, rpc.get_result(5))
+
+    def testTasksStartWithoutBudget(self):
+        e = engine.default_engine()
+        e.submit(lambda: deadlines.set_current(time.time())).get_result(5)
+        self.assertEqual(None, e.submit(deadlines.current).get_result(5))
+
+
+class BadGzipHandler(stub_server.StubHandler):
+    ''' 200 with a body that claims to be gzipped but isn't, so reading it fails part way '''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+
+class BreakerTest(FBStubTest):
+
+    def testOpensAfterThreshold(self):
+        breakers = breaker.CircuitBreakers(failure_threshold=3, reset_timeout=60)
+        for i in range(2):
+            breakers.record("key", False)
+        self.assertTrue(breakers.allow("key"))
+        breakers.record("key", False)
+        self.assertEqual(breaker.OPEN, breakers.state("key"))
+        self.assertFalse(breakers.allow("key"))
+
+    def testHalfOpenRecovery(self):
+        breakers = breaker.CircuitBreakers(failure_threshold=1, reset_timeout=0.05)
+        breakers.record("key", False)
+        self.assertFalse(breakers.allow("key"))
+
+        time.sleep(0.06)
+        self.assertTrue(breakers.allow("key"))
+        self.assertEqual(breaker.HALF_OPEN, breakers.state("key"))
+        # one trial at a time
+        self.assertFalse(breakers.allow("key"))
+
+        breakers.record("key", True)
+        self.assertEqual(breaker.CLOSED, breakers.state("key"))
+        self.assertTrue(breakers.allow("key"))
+
+    def testFailedTrialReopens(self):
+        breakers = breaker.CircuitBreakers(failure_threshold=1, reset_timeout=0.05)
+        breakers.record("key", False)
+        time.sleep(0.06)
+        self.assertTrue(breakers.allow("key"))
+        breakers.record("key", False)
+        self.assertEqual(breaker.OPEN, breakers.state("key"))
+        self.assertFalse(breakers.allow("key"))
+
+    def testAbandonedTrialReopens(self):
+        breakers = breaker.CircuitBreakers(failure_threshold=1, reset_timeout=0.05)
+        breakers.record("key", False)
+        time.sleep(0.06)
+        self.assertTrue(breakers.allow("key"))
+
+        # the trial never reports back
+        time.sleep(0.06)
+        self.assertFalse(breakers.allow("key"))
+        self.assertEqual(breaker.OPEN, breakers.state("key"))
+        time.sleep(0.06)
+        self.assertTrue(breakers.allow("key"))
+
+    def testEndpointRecovers(self):
+        net.coalescer = None
+        net.retry_policy = None
+        net.breakers = breaker.CircuitBreakers(failure_threshold=2, reset_timeout=0.1)
+        url = self.user_url(fbstub.ME_UID)
+
+        self.server.error_rate = 1.0
+        for i in range(2):
+            self.assertRaises(net.NetException, net.get, url)
+        self.assertRaises(net.CircuitOpen, net.get, url)
+
+        self.server.error_rate = 0.0
+        time.sleep(0.11)
+        self.assertTrue(net.get(url))
+        self.assertEqual(breaker.CLOSED, net.breakers.state(instrument.endpoint(url)))
+
+    def testQueueTimeoutDoesNotLeakTrial(self):
+        # the scheduler is asked before the breaker, so a request that times out queueing hasn't taken the trial
+        net.coalescer = None
+        net.retry_policy = None
+        net.breakers = breaker.CircuitBreakers(failure_threshold=1, reset_timeout=0.05)
+        net.scheduler = ratelimit.Scheduler(app_rate=0.01, app_burst=1, max_wait=0.05)
+        url = self.user_url(fbstub.ME_UID)
+        net.breakers.record(instrument.endpoint(url), False)
+        net.scheduler.acquire(url)
+
+        time.sleep(0.06)
+        self.assertRaises(ratelimit.QueueTimeout, net.get, url)
+        self.assertEqual(breaker.OPEN, net.breakers.state(instrument.endpoint(url)))
+
+        net.scheduler = None
+        self.assertTrue(net.get(url))
+        self.assertEqual(breaker.CLOSED, net.breakers.state(instrument.endpoint(url)))
+
+    def testStreamReportsOnceBodyIsRead(self):
+        net.breakers = breaker.CircuitBreakers(failure_threshold=1, reset_timeout=0.05)
+        url = self.user_url(fbstub.ME_UID)
+        net.breakers.record(instrument.endpoint(url), False)
+        time.sleep(0.06)
+
+        stream = net.get_stream(url)
+        self.assertEqual(breaker.HALF_OPEN, net.breakers.state(instrument.endpoint(url)))
+        self.assertTrue("".join(stream))
+        self.assertEqual(breaker.CLOSED, net.breakers.state(instrument.endpoint(url)))
+
+    def testBrokenStreamIsAFailure(self):
+        (server, url, context) = stub_server.start(BadGzipHandler)
+        self.addCleanup(stub_server.stop, server)
+        net.breakers = breaker.CircuitBreakers(failure_threshold=1, reset_timeout=60)
+
+        stream = net.get_stream(url + "/4")
+        self.assertRaises(pool.zlib.error, list, stream)
+        self.assertEqual(breaker.OPEN, net.breakers.state(instrument.endpoint(url + "/4")))
+
+
+class CoalescerTest(FBStubTest):
+
+    def run_together(self, n, fn):
+        results = [None] * n
+        def run(i):
+            try:
+                results[i] = fn()
+            except Exception, e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        return results
+
+    def testConcurrentCallsShareOne(self):
+        c = coalesce.Coalescer()
+        calls = []
+        def fetch():
+            calls.append(1)
+            time.sleep(0.1)
+            return "result"
+
+        results = self.run_together(5, lambda: c.do("key", fetch))
+        self.assertEqual(["result"] * 5, results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(4, c.stats()["saved"])
+        self.assertEqual(0, c.stats()["in_flight"])
+
+    def testErrorIsShared(self):
+        c = coalesce.Coalescer()
+        def fetch():
+            time.sleep(0.1)
+            raise net.NetException("boom")
+
+        results = self.run_together(3, lambda: c.do("key", fetch))
+        self.assertEqual([net.NetException] * 3, [type(result) for result in results])
+
+        # and isn't remembered
+        self.assertEqual("ok", c.do("key", lambda: "ok"))
+
+    def testConcurrentGetsShareOneRequest(self):
+        net.coalescer = coalesce.Coalescer()
+        self.server.latency = 0.1
+        url = self.user_url(fbstub.ME_UID)
+
+        results = self.run_together(5, lambda: net.get(url))
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual(1, self.server.counts.get("GET"))
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def fetch(self, result):
+        def fetch():
+            self.calls.append(1)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return fetch
+
+    def testEmptyResultsUseNegativeTTL(self):
+        c = resultcache.ResultCache(default_ttl=60, negative_ttl=0.05)
+        self.assertEqual([], c.get("user", "q", self.fetch([])))
+        self.assertEqual([], c.get("user", "q", self.fetch([])))
+        self.assertEqual(1, len(self.calls))
+
+        time.sleep(0.06)
+        self.assertEqual([1], c.get("user", "q", self.fetch([1])))
+        self.assertEqual(2, len(self.calls))
+        self.assertEqual(1, c.stats()["negative_hits"])
+
+    def testCacheableErrorsAreCached(self):
+        c = resultcache.ResultCache(negative_ttl=60)
+        error = net.NetException("bad token", 400, "")
+        for i in range(2):
+            self.assertRaises(net.NetException, c.get, "user", "q", self.fetch(error), lambda e: True)
+        self.assertEqual(1, len(self.calls))
+
+    def testOtherErrorsAreRetried(self):
+        c = resultcache.ResultCache(negative_ttl=60)
+        error = net.NetException("server error", 500, "")
+        for i in range(2):
+            self.assertRaises(net.NetException, c.get, "user", "q", self.fetch(error), lambda e: False)
+        self.assertEqual(2, len(self.calls))
+
+    def testTokenErrorsDontPoisonUsersOtherTokens(self):
+        c = resultcache.ResultCache(negative_ttl=60)
+        error = net.NetException("token expired", 400, "")
+        old = resultcache.token_identity("old token")
+        new = resultcache.token_identity("new token")
+
+        self.assertRaises(net.NetException, c.get, "user:4", "q", self.fetch(error), lambda e: True, old)
+        self.assertRaises(net.NetException, c.get, "user:4", "q", self.fetch([1]), lambda e: True, old)
+        self.assertEqual([1], c.get("user:4", "q", self.fetch([1]), lambda e: True, new))
+        self.assertEqual(2, len(self.calls))
+
+
+class ResultCacheIdentityTest(FBStubTest):
+
+    def setUp(self):
+        FBStubTest.setUp(self)
+        self.saved_result_cache = graph.result_cache
+        self.saved_manager = tokens.manager
+        graph.result_cache = resultcache.ResultCache()
+        tokens.manager = tokens.TokenManager()
+
+    def tearDown(self):
+        graph.result_cache = self.saved_result_cache
+        tokens.manager = self.saved_manager
+        FBStubTest.tearDown(self)
+
+    def testUserTokensWithAppPrefixAreNotShared(self):
+        # old style user tokens start with the app id, like app tokens do
+        self.server.token_users = {"1|session_a|sig" : 100001, "1|session_b|sig" : 100002}
+
+        posts_a = graph.get_wall_posts("me", "1|session_a|sig")["data"]
+        posts_b = graph.get_wall_posts("me", "1|session_b|sig")["data"]
+        self.assertTrue(posts_a[0]["id"].startswith("100001_"))
+        self.assertTrue(posts_b[0]["id"].startswith("100002_"))
+        self.assertEqual(2, self.server.counts.get("GET"))
+
+    def testAppTokensShareAppIdentity(self):
+        token = tokens.manager.get_app_token("1", "secret", lambda app_id, app_secret: "1|stub_app_token")
+        self.assertEqual("app:1", resultcache.identity(token))
+        self.assertTrue(resultcache.identity("1|stub_user_token").startswith("token:"))
+
+
+class StaleConnectionHandler(stub_server.StubHandler):
+    ''' answers as if the connection stays open, then hangs up on it '''
+
+    def do_GET(self):
+        self.server.methods.append("GET")
+        self.reply(200, self.server.body)
+        self.close_connection = 1
+
+    def do_POST(self):
+        self.server.methods.append("POST")
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        self.reply(200, "true")
+        self.close_connection = 1
+
+
+class PoolTest(unittest.TestCase):
+
+    def start(self, handler=stub_server.StubHandler):
+        (server, url, context) = stub_server.start(handler)
+        server.methods = []
+        self.addCleanup(stub_server.stop, server)
+        p = pool.ConnectionPool(timeout=5)
+        self.addCleanup(p.close)
+        return (server, url, p)
+
+    def testConnectionsAreReused(self):
+        (server, url, p) = self.start()
+        for i in range(5):
+            (status, headers, content) = p.request("GET", url + "/4")
+            self.assertEqual(200, status)
+            self.assertEqual(server.body, content)
+
+        stats = p.stats()
+        self.assertEqual(1, stats["new_connections"])
+        self.assertEqual(4, stats["hits"])
+        self.assertEqual(1, stats["idle"])
+
+    def testClosedResponseGoesBackToPool(self):
+        (server, url, p) = self.start()
+        p.open("GET", url + "/4").close()
+        self.assertEqual(1, p.stats()["idle"])
+
+        # too much left to read off, the connection is closed instead
+        server.body = "[%s]" % ",".join(["1"] * pool.MAX_DRAIN_BYTES)
+        response = p.open("GET", url + "/4")
+        iter(response).next()
+        response.close()
+        self.assertEqual(0, p.stats()["idle"])
+        self.assertEqual(1, p.stats()["new_connections"])
+
+    def testGetIsResentOnStaleConnection(self):
+        (server, url, p) = self.start(StaleConnectionHandler)
+        p.request("GET", url + "/4")
+        time.sleep(0.05)
+
+        (status, headers, content) = p.request("GET", url + "/4")
+        self.assertEqual(200, status)
+        self.assertEqual(2, p.stats()["new_connections"])
+        self.assertEqual(["GET", "GET"], server.methods)
+
+    def testPostIsNotResent(self):
+        (server, url, p) = self.start(StaleConnectionHandler)
+        p.request("GET", url + "/4")
+        time.sleep(0.05)
+
+        self.assertRaises((pool.httplib.HTTPException, socket.error), p.request, "POST", url + "/4/feed", "message=hi",
+                          {"Content-Type" : "application/x-www-form-urlencoded"})
+        self.assertEqual(["GET"], server.methods)
+        self.assertEqual(1, p.stats()["new_connections"])
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def testWaitStopsAtDeadline(self):
+        scheduler = ratelimit.Scheduler(app_rate=0.01, app_burst=1)
+        url = "http://graph.facebook.com/4?access_token=%s" % TOKEN
+        scheduler.acquire(url)
+
+        t = time.time()
+        with deadlines.budget(0.1):
+            self.assertRaises(ratelimit.QueueTimeout, scheduler.acquire, url)
+        self.assertTrue(time.time() - t < 1)
+
+    def testNetRaisesDeadlineExceeded(self):
+        saved = net.scheduler
+        net.scheduler = ratelimit.Scheduler(app_rate=0.01, app_burst=1)
+        try:
+            url = "http://graph.facebook.com/4?access_token=%s" % TOKEN
+            net.scheduler.acquire(url)
+            with deadlines.budget(0.1):
+                self.assertRaises(net.DeadlineExceeded, net._before_request, url)
+        finally:
+            net.scheduler = saved
+
+
+class TokenManagerTest(unittest.TestCase):
+
+    def testFailedRefreshBacksOff(self):
+        manager = tokens.TokenManager(refresh_interval=0, refresh_retry=60)
+        calls = []
+        def fetch(app_id, app_secret):
+            calls.append(1)
+            if len(calls) > 1:
+                raise net.NetException("oauth is down")
+            return "app token"
+
+        self.assertEqual("app token", manager.get_app_token("1", "secret", fetch))
+        for i in range(10):
+            self.assertEqual("app token", manager.get_app_token("1", "secret", fetch))
+            time.sleep(0.01)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, manager.stats()["failed_refreshes"])
+
+
+class GetUsersTest(FBStubTest):
+
+    def testAsyncGetUsersIsBounded(self):
+        net.coalescer = None
+        self.server.latency = 0.1
+        ids = [str(fbstub.FIRST_FRIEND_UID + i) for i in range(40)]
+
+        t = time.time()
+        rpc = graph.get_users(ids, TOKEN, ["name"], callback=lambda users: users, chunk_size=10, max_concurrency=1)
+        self.assertEqual(set(ids), set(rpc.get_result(10).keys()))
+        self.assertTrue(time.time() - t >= 0.4)
+
+
+class BatchTest(FBStubTest):
+
+    def testFailedBatchChunkKeepsOthers(self):
+        batch = graph.Batch(TOKEN)
+        ops = [batch.get(str(fbstub.FIRST_FRIEND_UID + i)) for i in range(graph.MAX_BATCH_SIZE + 1)]
+
+        post_async = net.post_async
+        def failing_first(url, data=None, callback=None):
+            net.post_async = post_async
+            rpc = engine.RPC()
+            try:
+                raise net.NetException("batch request failed", 500, "")
+            except net.NetException:
+                rpc.set_exception(sys.exc_info())
+            return rpc
+        net.post_async = failing_first
+        try:
+            self.assertRaises(net.NetException, batch.execute)
+        finally:
+            net.post_async = post_async
+
+        self.assertRaises(net.NetException, ops[0].get_result)
+        self.assertEqual(str(fbstub.FIRST_FRIEND_UID + graph.MAX_BATCH_SIZE), ops[-1].get_result()["id"])
+
+    def testFailedCallbackKeepsOthers(self):
+        batch = graph.Batch(TOKEN)
+        called = []
+        def callback(user):
+            called.append(user["id"])
+            if len(called) == 1:
+                raise ValueError("callback failed")
+        ops = [batch.get(str(fbstub.FIRST_FRIEND_UID + i), callback=callback)
+               for i in range(graph.MAX_BATCH_SIZE + 1)]
+
+        self.assertRaises(ValueError, batch.execute)
+        self.assertEqual(graph.MAX_BATCH_SIZE + 1, len(called))
+        self.assertRaises(ValueError, ops[0].get_result)
+        self.assertEqual(str(fbstub.FIRST_FRIEND_UID + 1), ops[1].get_result()["id"])
+
+
+class FeedSyncTest(FBStubTest):
+
+    def testLongGapIsFilledByLaterSyncs(self):
+        sync = feedsync.FeedSync(page_size=5, max_pages=2)
+        first = sync.sync(fbstub.ME_UID, TOKEN)
+        self.assertEqual(5, len(first))
+
+        # 25 new posts, more than one sync takes
+        self.server.feed_time += 25 * fbstub.POST_INTERVAL
+        posts = sync.sync(fbstub.ME_UID, TOKEN)
+        self.assertEqual(10, len(posts))
+        self.assertEqual(1, len(sync.cursor(fbstub.ME_UID)["gaps"]))
+
+        while True:
+            more = sync.sync(fbstub.ME_UID, TOKEN)
+            if not more:
+                break
+            posts.extend(more)
+
+        ids = [post["id"] for post in posts]
+        self.assertEqual(25, len(set(ids)))
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertFalse(set(ids) & set([post["id"] for post in first]))
+        self.assertEqual([], sync.cursor(fbstub.ME_UID)["gaps"])
+
+
+class SQLiteBackendTest(unittest.TestCase):
+
+    def testReopensAfterFork(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+        backend = backends.SQLiteBackend(path)
+        self.addCleanup(backend.close)
+        backend.set("parent", 1)
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                if backend.get("parent") == 1:
+                    backend.set("child", 2)
+                    status = 0
+            finally:
+                os._exit(status)
+
+        (pid, status) = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        self.assertEqual(2, backend.get("child"))
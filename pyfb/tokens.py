@@ -0,0 +1,232 @@
+''' Bookkeeping for Facebook access tokens.
+
+    Application access tokens are stable, so they are fetched once per (app id, secret) and refreshed in the
+    background now and then instead of hitting /oauth/access_token on every call.  User access tokens are recorded
+    with their owner and expiry as we learn about them (authenticate_app, signed requests).  Tokens facebook has
+    rejected are marked dead, so later requests with them fail straight away rather than making a round trip to
+    find out again.
+'''
+
+import collections
+import logging
+logger = logging.getLogger("pyfb")
+import sys
+import threading
+import time
+import urlparse
+
+import engine
+
+APP_TOKEN_REFRESH_INTERVAL = 6 * 3600   # seconds before an app token is refreshed in the background
+APP_TOKEN_REFRESH_RETRY = 60            # seconds before a failed background refresh is tried again
+MAX_USER_TOKENS = 10000                 # user tokens remembered, least recently added are forgotten first
+MAX_DEAD_TOKENS = 10000                 # dead tokens remembered
+
+
+class TokenManager(object):
+    ''' Thread safe cache of app tokens plus what we know about user tokens.
+
+        refresh_interval - seconds after fetching an app token that it gets refreshed in the background.  Callers
+                           keep getting the current token while the refresh is running.
+        refresh_retry - seconds after a failed refresh that it is tried again.  Callers keep getting the current token
+                        in the meantime.
+    '''
+
+    def __init__(self, refresh_interval=APP_TOKEN_REFRESH_INTERVAL, refresh_retry=APP_TOKEN_REFRESH_RETRY):
+        self.refresh_interval = refresh_interval
+        self.refresh_retry = refresh_retry
+
+        self._app_tokens = {}                           # (app_id, app_secret) -> (token, refresh at)
+        self._user_tokens = collections.OrderedDict()   # token -> (user_id, expires epoch or None)
+        self._dead = collections.OrderedDict()          # token -> time it was marked dead
+        self._fetches = {}                              # (app_id, app_secret) -> RPC of the fetch in progress
+        self._lock = threading.Lock()
+
+        # stats
+        self.fetches = 0            # app token requests actually sent
+        self.collapsed = 0          # callers that waited on somebody else's fetch instead of sending their own
+        self.failed_refreshes = 0   # background refreshes that failed, the current token was kept
+
+    def get_app_token(self, app_id, app_secret, fetch):
+        ''' Return the application access token for this app, calling fetch(app_id, app_secret) to get one if we don't
+            have a live one.  Concurrent callers share one fetch.  A token that is due for refresh is still returned
+            while a new one is fetched in the background. '''
+
+        key = (app_id, app_secret)
+        token = None
+        owner = False
+
+        self._lock.acquire()
+        try:
+            entry = self._app_tokens.get(key)
+            if entry and entry[0] not in self._dead:
+                (token, refresh_at) = entry
+                if time.time() >= refresh_at and key not in self._fetches:
+                    logger.debug("TokenManager: refreshing app token for %s in the background" % app_id)
+                    rpc = self._new_fetch(key)
+                    engine.default_engine().submit(lambda: self._run_fetch(key, rpc, fetch))
+            else:
+                rpc = self._fetches.get(key)
+                if rpc:
+                    self.collapsed += 1
+                else:
+                    rpc = self._new_fetch(key)
+                    owner = True
+        finally:
+            self._lock.release()
+
+        if token:
+            return token
+
+        if owner:
+            # do the fetch on this thread, anybody else asking in the meantime waits for it
+            self._run_fetch(key, rpc, fetch)
+        return rpc.get_result()
+
+    def add_user_token(self, access_token, user_id=None, expires=None):
+        ''' Remember a user access token.
+
+            expires - UNIX time the token expires, or None/0 if it doesn't
+        '''
+
+        try:
+            expires = int(expires or 0) or None
+        except ValueError:
+            expires = None
+
+        self._lock.acquire()
+        try:
+            self._user_tokens.pop(access_token, None)
+            self._user_tokens[access_token] = (user_id, expires)
+            while len(self._user_tokens) > MAX_USER_TOKENS:
+                self._user_tokens.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def get_user_id(self, access_token):
+        ''' id of the user this token belongs to, or None if we don't know '''
+
+        self._lock.acquire()
+        try:
+            entry = self._user_tokens.get(access_token)
+        finally:
+            self._lock.release()
+
+        if entry:
+            return entry[0]
+        return None
+
+    def get_app_id(self, access_token):
+        ''' id of the app this token is the app access token of, or None if it isn't one get_app_token handed out '''
+
+        self._lock.acquire()
+        try:
+            for ((app_id, app_secret), (token, refresh_at)) in self._app_tokens.items():
+                if token == access_token:
+                    return app_id
+        finally:
+            self._lock.release()
+        return None
+
+    def mark_dead(self, access_token):
+        ''' Record that facebook rejected this token '''
+
+        if not access_token:
+            return
+
+        self._lock.acquire()
+        try:
+            self._dead.pop(access_token, None)
+            self._dead[access_token] = time.time()
+            while len(self._dead) > MAX_DEAD_TOKENS:
+                self._dead.popitem(last=False)
+        finally:
+            self._lock.release()
+
+        logger.info("TokenManager: marked token dead")
+
+    def is_dead(self, access_token):
+        ''' True if facebook rejected this token, or it is a user token we know has expired '''
+
+        if not access_token:
+            return False
+
+        self._lock.acquire()
+        try:
+            if access_token in self._dead:
+                return True
+            entry = self._user_tokens.get(access_token)
+        finally:
+            self._lock.release()
+
+        if entry and entry[1] and entry[1] <= time.time():
+            return True
+        return False
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "app_tokens" : len(self._app_tokens),
+                "user_tokens" : len(self._user_tokens),
+                "dead_tokens" : len(self._dead),
+                "fetches" : self.fetches,
+                "collapsed" : self.collapsed,
+                "failed_refreshes" : self.failed_refreshes,
+            }
+        finally:
+            self._lock.release()
+
+    def _new_fetch(self, key):
+        ''' register a fetch in progress for key.  called with the lock held. '''
+
+        rpc = engine.RPC()
+        self._fetches[key] = rpc
+        self.fetches += 1
+        return rpc
+
+    def _run_fetch(self, key, rpc, fetch):
+        (app_id, app_secret) = key
+        try:
+            token = fetch(app_id, app_secret)
+        except:
+            self._lock.acquire()
+            try:
+                del self._fetches[key]
+                entry = self._app_tokens.get(key)
+                if entry and entry[0] in self._dead:
+                    entry = None
+                if entry:
+                    # a background refresh.  keep the token we have, and don't try again on every call until then
+                    self._app_tokens[key] = (entry[0], time.time() + self.refresh_retry)
+                    self.failed_refreshes += 1
+            finally:
+                self._lock.release()
+            if entry:
+                logger.warning("TokenManager: refreshing app token for %s failed, retrying in %s seconds: %s"
+                               % (app_id, self.refresh_retry, sys.exc_info()[1]))
+            rpc.set_exception(sys.exc_info())
+            return
+
+        self._lock.acquire()
+        try:
+            del self._fetches[key]
+            if token:
+                self._app_tokens[key] = (token, time.time() + self.refresh_interval)
+        finally:
+            self._lock.release()
+        rpc.set_result(token)
+
+
+def token_from_url(url):
+    ''' access_token query parameter of a url, or None '''
+
+    query = urlparse.parse_qs(urlparse.urlsplit(url).query)
+    tokens = query.get("access_token")
+    if tokens:
+        return tokens[0]
+    return None
+
+
+# shared manager used by pyfb.graph, pyfb.fql and pyfb.auth
+manager = TokenManager()
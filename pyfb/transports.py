@@ -0,0 +1,256 @@
+''' Transports: the part of pyfb.net that actually puts requests on the wire.
+
+    pyfb.net does everything else (deadlines, retries, rate limiting, circuit breakers, coalescing, caching) and hands
+    the request to net.transport.  On app engine that is a URLFetchTransport, elsewhere a PooledTransport.  Set
+    net.transport to another Transport to change how requests are sent, e.g. to compare them in a benchmark.
+'''
+
+import httplib
+import logging
+logger = logging.getLogger("pyfb")
+import socket
+import time
+import urllib2
+import urlparse
+
+try:
+    from google.appengine.api import urlfetch
+except ImportError:
+    urlfetch = None
+
+import engine
+import instrument
+import pool
+
+READ_CHUNK_SIZE = pool.READ_CHUNK_SIZE
+
+
+class Transport(object):
+    ''' Interface of a transport.  Subclasses implement request, the rest have defaults built on it.
+
+        name - shows up in log and error messages
+        native_async - True if start() returns the transport's own rpcs, which only complete when waited on (app
+                       engine's urlfetch).  False if start() runs requests on the engine's worker threads.
+    '''
+
+    name = "transport"
+    native_async = False
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        ''' Send a request and read the whole response.  Returns (status, headers, content), headers being a
+            dictionary keyed by lower case header name.  Doesn't check the status.
+
+            timeout - seconds the request may take, None for the transport's default
+        '''
+        raise NotImplementedError()
+
+    def open(self, method, url, body=None, headers=None, timeout=None):
+        ''' Like request, but returns the response as soon as possible so its body can be streamed.  The response has
+            status and headers attributes, iterating over it yields the body in chunks and read() returns all of it.
+            close() releases the connection if the body isn't going to be read to the end.  By default the whole body
+            is read up front. '''
+
+        (status, response_headers, content) = self.request(method, url, body, headers, timeout)
+        return BufferedResponse(status, response_headers, content)
+
+    def start(self, method, url, body=None, headers=None, timeout=None):
+        ''' Start a request without waiting for it.  Returns an rpc whose get_result() returns what request would.
+            By default the request is run on the default engine. '''
+
+        return engine.default_engine().submit(lambda: self.request(method, url, body, headers, timeout),
+                                              host=urlparse.urlsplit(url).netloc)
+
+    def stats(self):
+        ''' transport specific counters '''
+        return {}
+
+    def close(self):
+        ''' release any connections held '''
+        pass
+
+
+class BufferedResponse(object):
+    ''' streaming response interface over a body that has already been read '''
+
+    def __init__(self, status, headers, content):
+        self.status = status
+        self.headers = headers
+        self._content = content
+
+    def __iter__(self):
+        if self._content:
+            yield self._content
+
+    def read(self):
+        return self._content
+
+    def close(self):
+        pass
+
+
+class PooledTransport(Transport):
+    ''' httplib over keep-alive connections from a pool.ConnectionPool.  Asks for gzipped responses and decompresses
+        them as they're read. '''
+
+    name = "httplib"
+
+    def __init__(self, connection_pool=None):
+        if connection_pool is None:
+            connection_pool = pool.ConnectionPool()
+        self.pool = connection_pool
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        return self.pool.request(method, url, body, _gzip_headers(headers), timeout)
+
+    def open(self, method, url, body=None, headers=None, timeout=None):
+        return self.pool.open(method, url, body, _gzip_headers(headers), timeout)
+
+    def stats(self):
+        return self.pool.stats()
+
+    def close(self):
+        self.pool.close()
+
+
+class URLLib2Transport(Transport):
+    ''' urllib2, with a brand new connection for every request.  What pyfb used before the pool, mostly useful as a
+        baseline to compare against.
+
+        ssl_context - optional ssl.SSLContext for https requests
+    '''
+
+    name = "urllib2"
+
+    def __init__(self, ssl_context=None):
+        self.ssl_context = ssl_context
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        start = time.time()
+        response = self._open(method, url, body, headers, timeout)
+        try:
+            content = response.read()
+        finally:
+            response.close()
+
+        status = response.getcode()
+        _record(url, start, status, content)
+        return (status, _lower_headers(response.info().items()), content)
+
+    def open(self, method, url, body=None, headers=None, timeout=None):
+        response = self._open(method, url, body, headers, timeout)
+        return URLLib2Response(response)
+
+    def _open(self, method, url, body, headers, timeout):
+        request = urllib2.Request(url, body, headers or {})
+        request.get_method = lambda: method
+
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        if self.ssl_context is not None:
+            kwargs["context"] = self.ssl_context
+
+        try:
+            return urllib2.urlopen(request, **kwargs)
+        except urllib2.HTTPError, e:
+            # not an error as far as a transport is concerned, the caller checks the status
+            return e
+
+
+class URLLib2Response(object):
+    ''' streaming response from URLLib2Transport.open '''
+
+    def __init__(self, response):
+        self.status = response.getcode()
+        self.headers = _lower_headers(response.info().items())
+        self._response = response
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self._response.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self._response.close()
+
+    def read(self):
+        return "".join(self)
+
+    def close(self):
+        self._response.close()
+
+
+class URLFetchTransport(Transport):
+    ''' app engine's urlfetch service.  Its asynchronous rpcs run in the background without tying up a thread. '''
+
+    name = "urlfetch"
+    native_async = True
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        start = time.time()
+        response = urlfetch.fetch(url, method=method, payload=body, headers=headers or {}, deadline=timeout)
+        _record(url, start, response.status_code, response.content)
+        return (response.status_code, _lower_headers(response.headers.items()), response.content)
+
+    def start(self, method, url, body=None, headers=None, timeout=None):
+        rpc = urlfetch.create_rpc(deadline=timeout)
+        urlfetch.make_fetch_call(rpc, url, method=method, payload=body, headers=headers or {})
+        return URLFetchRPC(rpc, url)
+
+
+class URLFetchRPC(object):
+    ''' Wraps an app engine urlfetch rpc so get_result() returns (status, headers, content) like
+        Transport.request. '''
+
+    def __init__(self, rpc, url):
+        self.rpc = rpc
+        self.url = url
+        self.started = time.time()
+
+    def wait(self, timeout=None):
+        self.rpc.wait()
+        return True
+
+    def get_result(self, timeout=None):
+        response = self.rpc.get_result()
+        _record(self.url, self.started, response.status_code, response.content)
+        return (response.status_code, _lower_headers(response.headers.items()), response.content)
+
+
+def default_transport():
+    ''' URLFetchTransport on app engine, PooledTransport elsewhere '''
+
+    if urlfetch is not None:
+        return URLFetchTransport()
+    return PooledTransport()
+
+def is_network_error(e):
+    ''' True if exception e means a request didn't get through or didn't get a response, as opposed to getting an
+        unwelcome one '''
+
+    if urlfetch is not None and isinstance(e, urlfetch.Error):
+        return True
+    return isinstance(e, (socket.error, httplib.HTTPException, urllib2.URLError))
+
+def _gzip_headers(headers):
+    request_headers = {"Accept-Encoding" : "gzip"}
+    if headers:
+        request_headers.update(headers)
+    return request_headers
+
+def _lower_headers(items):
+    return dict([(name.lower(), value) for (name, value) in items])
+
+def _record(url, start, status, content):
+    ''' instrumentation for transports that don't time themselves like the pool does '''
+
+    if not instrument.enabled:
+        return
+
+    label = instrument.endpoint(url)
+    instrument.observe("http.total", label, time.time() - start)
+    instrument.observe("http.response_bytes", label, len(content or ""))
+    if status != 200:
+        instrument.count("http.status", "%s %d" % (label, status))
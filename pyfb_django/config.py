@@ -1,6 +1,16 @@
+import logging
+logger = logging.getLogger("pyfb")
+import threading
+
 from django.conf import settings
 from django.utils.importlib import import_module
 
+from pyfb import backends
+from pyfb import cache
+from pyfb import fql
+from pyfb import graph
+from pyfb import resultcache
+
 class ConfigLoader(object):
     ''' Get configuration from Django settings.  Projects can supply a different impl to load config from an alternate source. '''
     
@@ -15,9 +25,80 @@ try:
 except AttributeError:
     _loader = ConfigLoader()
 
-def get(key):
-    return _loader.get(key)
-    
-    
-    
-    
\ No newline at end of file
+_no_default = object()
+
+def get(key, default=_no_default):
+    ''' value of setting key.  Raises AttributeError if it isn't set, unless a default is given. '''
+
+    try:
+        return _loader.get(key)
+    except AttributeError:
+        if default is _no_default:
+            raise
+        return default
+
+def configure_cache():
+    ''' Set up graph.user_cache and fql.user_cache (and optionally graph.result_cache and fql.result_cache) from the
+        settings:
+
+        PYFB_CACHE_BACKEND - "memcached" to share them between processes, "sqlite" to keep them on disk so they
+                             survive restarts, "local" for a stand-in that lives in this process (for tests), None (the
+                             default) to leave pyfb's caches alone
+        PYFB_CACHE_SERVERS - memcached "host:port" list.  Not needed on App Engine.
+        PYFB_CACHE_PATH - sqlite database file
+        PYFB_CACHE_PREFIX - memcached key prefix, default "pyfb:"
+        PYFB_CACHE_TTL - seconds user fields are cached, default cache.DEFAULT_TTL
+        PYFB_CACHE_L1_ENTRIES - users kept in each process in front of the shared cache, default 1000
+        PYFB_CACHE_L1_TTL - seconds they are kept there, default backends.DEFAULT_L1_TTL
+        PYFB_RESULT_CACHE - True to also cache FQL query and graph read results (see pyfb.resultcache) in the backend
+
+        Usually left to ensure_cache.
+    '''
+
+    backend = get("PYFB_CACHE_BACKEND", None)
+    if not backend:
+        return
+
+    if backend == "memcached":
+        l2 = backends.MemcachedBackend(get("PYFB_CACHE_SERVERS", None), prefix=get("PYFB_CACHE_PREFIX", "pyfb:"))
+    elif backend == "sqlite":
+        l2 = backends.SQLiteBackend(get("PYFB_CACHE_PATH"))
+    elif backend == "local":
+        l2 = backends.LocalBackend(serialize=True)
+    else:
+        raise ValueError("Unknown PYFB_CACHE_BACKEND %r, expected 'memcached', 'sqlite' or 'local'" % backend)
+
+    l1 = backends.LocalBackend(max_entries=get("PYFB_CACHE_L1_ENTRIES", 1000))
+    tiered = backends.TieredBackend(l1, l2, get("PYFB_CACHE_L1_TTL", backends.DEFAULT_L1_TTL))
+
+    ttl = get("PYFB_CACHE_TTL", cache.DEFAULT_TTL)
+    graph.user_cache = cache.ObjectCache(default_ttl=ttl, backend=tiered, namespace="graph.user")
+    fql.user_cache = cache.ObjectCache(default_ttl=ttl, backend=tiered, namespace="fql.user")
+
+    if get("PYFB_RESULT_CACHE", False):
+        graph.result_cache = resultcache.ResultCache(backend=tiered)
+        fql.result_cache = resultcache.ResultCache(backend=tiered)
+
+_cache_configured = False
+_cache_lock = threading.Lock()
+
+def ensure_cache():
+    ''' configure_cache() the first time it's called.  decorators.require_facebook_login calls it on every request, so
+        the caches are set up by the process serving requests, not at import time in a parent that forks workers.  If
+        configure_cache fails that is logged once and pyfb's default caches are kept, rather than trying again (and
+        failing again) on every request. '''
+
+    global _cache_configured
+    if _cache_configured:
+        return
+
+    _cache_lock.acquire()
+    try:
+        if not _cache_configured:
+            try:
+                configure_cache()
+            except Exception:
+                logger.exception("pyfb:ensure_cache: configuring the cache failed, using pyfb's default caches")
+            _cache_configured = True
+    finally:
+        _cache_lock.release()
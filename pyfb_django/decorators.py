@@ -116,6 +116,7 @@ def require_facebook_login(view_func):
     
     def enforce_login(request, *args, **kwargs):
         logger.info("pyfb:require_facebook_login: %s" % request.path)
+        config.ensure_cache()
         
         if disable_decorator:
             # skip decorator